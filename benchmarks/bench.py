@@ -0,0 +1,423 @@
+'''
+Offline benchmarks of the posting pipeline, the JSON import and the
+add-message admin flow, run against FakeClient instead of Telegram.
+
+Every scenario runs in a fresh process with its own temporary
+AUTOPOST_HOME, so memory figures don't leak between scenarios.
+
+    python benchmarks/bench.py                      # compare with the baseline
+    python benchmarks/bench.py --save               # store a new baseline
+    python benchmarks/bench.py posting --groups 500 --bots 3 --latency 0.05
+'''
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+BENCH_PATH = os.path.dirname(os.path.abspath(__file__))
+REPO_PATH = os.path.dirname(BENCH_PATH)
+
+SCENARIOS = ('posting', 'import', 'admin_flow')
+ADMIN_ID = 1
+
+# metrics compared with the baseline, and whether higher is better
+COMPARED_METRICS = {
+    'throughput': True,
+    'p50_ms': False,
+    'p99_ms': False,
+    'peak_rss_mb': False,
+}
+
+
+def percentile(samples: List[float], percent: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(percent / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(samples: List[float], count: int, seconds: float) -> Dict[str, float]:
+    '''
+    Throughput in operations per second, latencies in milliseconds
+    '''
+    return {
+        'count': count,
+        'seconds': round(seconds, 3),
+        'throughput': round(count / seconds, 2) if seconds else 0.0,
+        'p50_ms': round(percentile(samples, 50) * 1000, 3),
+        'p99_ms': round(percentile(samples, 99) * 1000, 3),
+        'mean_ms': round(statistics.fmean(samples) * 1000, 3) if samples else 0.0,
+    }
+
+
+def peak_rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    # kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return round(peak / scale, 1)
+
+
+def write_file(path: str, size: int) -> str:
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size))
+    return path
+
+
+# worker side
+def prepare_home(options: dict) -> str:
+    '''
+    Temporary AUTOPOST_HOME with a config.ini that points main.py at fake
+    bots
+    '''
+    home = tempfile.mkdtemp(prefix='autopost-bench-')
+    extra_tokens = ', '.join(f'{1001 + i}:bench' for i in range(options['bots'] - 1))
+    with open(os.path.join(home, 'config.ini'), 'wt') as f:
+        f.write(
+            '[Telegram]\n'
+            'api_id = 1\n'
+            'api_hash = bench\n'
+            'bot_token = 1000:bench\n'
+            f'extra_bot_tokens = {extra_tokens}\n'
+            'fake_telegram = yes\n'
+            '[Settings]\n'
+            f'admins = {ADMIN_ID}\n'
+            'language = en\n'
+            f'max_parallel_sends = {options["parallel"]}\n'
+            'log_level = WARNING\n'
+            'error_digest_interval = 0\n'
+            'media_gc_interval = 0\n'
+            'optimize_media = no\n'
+        )
+    os.environ['AUTOPOST_HOME'] = home
+    return home
+
+
+async def setup(main, options: dict) -> None:
+    from fakeclient import FakeClient
+    from rate_limiter import RateLimiter
+
+    main.log_listener.start()
+    for folder_path in (main.session_folder_path, main.files_folder_path):
+        os.makedirs(folder_path, exist_ok=True)
+    await main.database.run(main.migrate)
+
+    for index, shard in enumerate(main.shards):
+        shard.client = FakeClient(
+            latency=options['latency'],
+            flood_wait_rate=options['flood_rate'],
+            flood_wait_seconds=options['flood_seconds'],
+            upload_speed=options['upload_speed'],
+            seed=index
+        )
+        await shard.client.start()
+        if not options['real_limits']:
+            # measure the pipeline, not the configured Telegram limits
+            shard.rate_limiter = RateLimiter(global_rate=1e6, chat_rate=1e6, chat_burst=1e6, dc_rate=1e6)
+    main.bot = main.shards.main.client
+
+    await main.load_state()
+    main.startup.mark_ready()
+
+
+async def teardown(main) -> None:
+    pending = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+
+    main.media_processor.close()
+    main.database.close()
+    main.log_listener.stop()
+
+
+def client_stats(main) -> Dict[str, int]:
+    clients = [shard.client for shard in main.shards]
+    return {
+        'requests': sum(client.requests for client in clients),
+        'uploads': sum(client.uploads for client in clients),
+        'flood_waits': sum(client.flood_waits for client in clients),
+    }
+
+
+async def bench_posting(main, options: dict) -> dict:
+    '''
+    send_messages until every group got every message once
+    '''
+    from database import NewMessage
+
+    file_size = options['file_kb'] * 1024
+    new_messages = []
+    for index in range(options['messages']):
+        # every other message carries a photo
+        file_links = []
+        if index % 2 == 0:
+            file_links = [write_file(os.path.join(main.files_folder_path, f'bench_{index}.jpg'), file_size)]
+        new_messages.append(NewMessage(text=f'Benchmark message {index}', file_links=file_links, buttons=[]))
+    await main.message_repository.add_many(new_messages)
+    await main.render_cache.load()
+
+    for index in range(options['groups']):
+        group_id = -1001000000000 - index
+        await main.group_repository.add(group_id, f'bench_{index}')
+        for shard in main.shards:
+            await main.shards.join(group_id, shard)
+
+    messages = await main.message_repository.all()
+    groups = await main.group_repository.all()
+    target = len(messages) * len(groups)
+
+    samples: List[float] = []
+    done = asyncio.Event()
+
+    def timed(send):
+        async def send_timed(group_id, post):
+            started = time.perf_counter()
+            await send(group_id, post)
+            samples.append(time.perf_counter() - started)
+            if len(samples) >= target:
+                done.set()
+        return send_timed
+
+    for shard in main.shards:
+        shard.sender.send = timed(shard.sender.send)
+
+    main.interval.current_interval = 0
+    started = time.perf_counter()
+    posting = asyncio.create_task(main.send_messages(messages=messages, groups=groups))
+    try:
+        await asyncio.wait_for(done.wait(), options['timeout'])
+    except asyncio.TimeoutError:
+        pass
+    seconds = time.perf_counter() - started
+    main.scheduler.stop()
+    await posting
+
+    result = summarize(samples[:target], min(len(samples), target), seconds)
+    result['completed'] = round(min(len(samples), target) / target, 3) if target else 1.0
+    result.update(client_stats(main))
+    return result
+
+
+async def bench_import(main, options: dict) -> dict:
+    '''
+    Upload a generated message library through the JSON state handler
+    '''
+    library_path = os.path.join(main.home_path, 'library.json')
+    with open(library_path, 'wt', encoding='utf-8') as f:
+        json.dump({'messages': [
+            {
+                'text': [f'Imported message {index}', 'with a second line'],
+                'file': f'files/import_{index}.jpg',
+                'buttons': [{'name': 'Open', 'link': f'https://example.com/{index}'}]
+            }
+            for index in range(options['import_messages'])
+        ]}, f)
+
+    client = main.bot
+    json_button = main.bot_text['button']['add_msg_json'][main.bot_lang]
+    samples: List[float] = []
+
+    for _ in range(options['repeat']):
+        await main.router.dispatch(client.incoming(ADMIN_ID, text=json_button))
+        started = time.perf_counter()
+        await main.router.dispatch(client.incoming(ADMIN_ID, file=library_path, mime_type='application/json'))
+        samples.append(time.perf_counter() - started)
+
+    imported = len(await main.message_repository.all())
+    if imported != options['import_messages'] * options['repeat']:
+        raise RuntimeError(f'expected {options["import_messages"] * options["repeat"]} messages, got {imported}')
+
+    result = summarize(samples, imported, sum(samples))
+    result['messages_per_import'] = options['import_messages']
+    return result
+
+
+async def bench_admin_flow(main, options: dict) -> dict:
+    '''
+    The add-message conversation, one photo per message, through the
+    router and the state handlers
+    '''
+    client = main.bot
+    button, lang = main.bot_text['button'], main.bot_lang
+    file_size = options['file_kb'] * 1024
+    upload_folder = tempfile.mkdtemp(dir=main.home_path)
+    samples: List[float] = []
+
+    started = time.perf_counter()
+    for index in range(options['repeat']):
+        photo_path = write_file(os.path.join(upload_folder, f'photo_{index}.jpg'), file_size)
+        steps = [
+            client.incoming(ADMIN_ID, text='/start'),
+            client.incoming(ADMIN_ID, text=button['add_message'][lang]),
+            client.incoming(ADMIN_ID, text=f'Flow message {index}'),
+            client.incoming(ADMIN_ID, file=photo_path),
+            client.incoming(ADMIN_ID, text=button['done'][lang]),
+            client.incoming(ADMIN_ID, text=button['no'][lang]),
+        ]
+        for event in steps:
+            step_started = time.perf_counter()
+            await main.router.dispatch(event)
+            samples.append(time.perf_counter() - step_started)
+    seconds = time.perf_counter() - started
+
+    added = len(await main.message_repository.all())
+    if added != options['repeat']:
+        raise RuntimeError(f'expected {options["repeat"]} messages, got {added}')
+
+    # throughput in whole flows, latency per handled update
+    result = summarize(samples, options['repeat'], seconds)
+    result['updates'] = len(samples)
+    return result
+
+
+BENCHMARKS = {
+    'posting': bench_posting,
+    'import': bench_import,
+    'admin_flow': bench_admin_flow,
+}
+
+
+def run_worker(scenario: str, options: dict) -> dict:
+    home = prepare_home(options)
+    sys.path.insert(0, REPO_PATH)
+    import main
+
+    async def run() -> dict:
+        await setup(main, options)
+        try:
+            return await BENCHMARKS[scenario](main, options)
+        finally:
+            await teardown(main)
+
+    try:
+        result = asyncio.run(run())
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+
+# runner side
+def run_scenario(scenario: str, options: dict) -> dict:
+    process = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--worker', scenario, '--options', json.dumps(options)],
+        stdout=subprocess.PIPE, text=True
+    )
+    if process.returncode != 0:
+        raise SystemExit(f'{scenario} benchmark failed')
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def compare(results: Dict[str, dict], baseline: dict, tolerance: float) -> List[str]:
+    '''
+    Metrics that got worse than the baseline by more than `tolerance`
+    '''
+    regressions = []
+    for scenario, result in results.items():
+        previous = baseline.get('results', {}).get(scenario)
+        if previous is None:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            old, new = previous.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if (change < -tolerance) if higher_is_better else (change > tolerance):
+                regressions.append(f'{scenario}.{metric}: {old} -> {new} ({change:+.0%})')
+    return regressions
+
+
+def print_results(results: Dict[str, dict]) -> None:
+    print(f'{"scenario":<12} {"count":>8} {"seconds":>9} {"ops/s":>10} {"p50 ms":>9} {"p99 ms":>9} {"rss MB":>8}')
+    for scenario, result in results.items():
+        print(
+            f'{scenario:<12} {result["count"]:>8} {result["seconds"]:>9.2f} {result["throughput"]:>10.1f} '
+            f'{result["p50_ms"]:>9.2f} {result["p99_ms"]:>9.2f} {result["peak_rss_mb"] or 0:>8.1f}'
+        )
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scenarios', nargs='*', default=list(SCENARIOS),
+                        help=f'scenarios to run, all by default: {", ".join(SCENARIOS)}')
+    parser.add_argument('--groups', type=int, default=200, help='groups to post to')
+    parser.add_argument('--messages', type=int, default=10, help='messages in the posting rotation')
+    parser.add_argument('--bots', type=int, default=1, help='bot accounts (shards)')
+    parser.add_argument('--parallel', type=int, default=8, help='max_parallel_sends per bot')
+    parser.add_argument('--latency', type=float, default=0.02, help='mean seconds per fake request')
+    parser.add_argument('--flood-rate', type=float, default=0.0, help='share of requests answered with FloodWait')
+    parser.add_argument('--flood-seconds', type=int, default=1, help='seconds of each FloodWait')
+    parser.add_argument('--upload-speed', type=float, default=5e6, help='upload bytes per second, 0 for free')
+    parser.add_argument('--file-kb', type=int, default=256, help='size of generated media files')
+    parser.add_argument('--import-messages', type=int, default=2000, help='messages per imported library')
+    parser.add_argument('--repeat', type=int, default=20, help='imports or admin flows to run')
+    parser.add_argument('--real-limits', action='store_true', help='keep the default Telegram rate limits')
+    parser.add_argument('--timeout', type=float, default=300, help='seconds before posting gives up')
+    parser.add_argument('--baseline', default=os.path.join(BENCH_PATH, 'baseline.json'))
+    parser.add_argument('--save', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed change before a regression')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    parser.add_argument('--options', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+
+    if args.worker:
+        print(json.dumps(run_worker(args.worker, json.loads(args.options))))
+        return
+
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f'unknown scenario: {", ".join(sorted(unknown))}')
+
+    options = {
+        key: value for key, value in vars(args).items()
+        if key not in ('scenarios', 'baseline', 'save', 'tolerance', 'worker', 'options')
+    }
+    results = {scenario: run_scenario(scenario, options) for scenario in dict.fromkeys(args.scenarios)}
+    print_results(results)
+
+    if args.save:
+        with open(args.baseline, 'wt') as f:
+            json.dump({'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'options': options, 'results': results},
+                      f, indent=2)
+        print(f'Baseline saved to {args.baseline}')
+        return
+
+    if not os.path.exists(args.baseline):
+        print('No baseline yet, run with --save to create one')
+        return
+
+    with open(args.baseline, 'rt') as f:
+        baseline = json.load(f)
+    if baseline.get('options') != options:
+        print('Note: the baseline was recorded with different options')
+
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print('Regressions against the baseline:')
+        for regression in regressions:
+            print('  ' + regression)
+        sys.exit(1)
+    print('No regressions against the baseline')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+import logging
+from enum import Enum
+from typing import Callable, List, NamedTuple, Optional, Sequence, Tuple
+
+
+class ChangeKind(Enum):
+    MESSAGE_ADDED = 'message_added'
+    MESSAGES_ADDED = 'messages_added'
+    MESSAGE_REMOVED = 'message_removed'
+    MESSAGES_CLEARED = 'messages_cleared'
+    GROUP_ADDED = 'group_added'
+    GROUP_REMOVED = 'group_removed'
+
+
+class AddedMessage(NamedTuple):
+    msg_id: int
+    # the groups a targeted message is limited to, None for every group
+    group_ids: Optional[Tuple[int, ...]] = None
+    weight: float = 1.0
+    # seconds until the next post after this one, None for the default
+    interval: Optional[float] = None
+
+
+class Change(NamedTuple):
+    version: int
+    kind: ChangeKind
+    key: Optional[int] = None
+    # MESSAGES_ADDED only, e.g. a whole JSON import
+    messages: Tuple[AddedMessage, ...] = ()
+
+
+# change feed
+class ChangeFeed(object):
+    '''
+    In-process feed of message and group mutations.
+
+    Every mutation bumps `version` and is handed to the subscribers in
+    order, so running components can apply it incrementally instead of
+    reloading everything.
+    '''
+
+    def __init__(self) -> None:
+        self.version = 0
+        self._subscribers: List[Callable[[Change], None]] = []
+
+    def subscribe(self, callback: Callable[[Change], None]) -> None:
+        self._subscribers.append(callback)
+
+    def publish(self, kind: ChangeKind, key: Optional[int] = None,
+                messages: Sequence[AddedMessage] = ()) -> Change:
+        self.version += 1
+        change = Change(self.version, kind, key, tuple(messages))
+
+        for callback in self._subscribers:
+            try:
+                callback(change)
+            except Exception:
+                logging.exception('Failed to apply change %s', change)
+        return change
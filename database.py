@@ -0,0 +1,314 @@
+import asyncio
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+
+# database
+class Database(object):
+    '''
+    Long-lived SQLite connection served by one dedicated thread.
+
+    Every query runs on that thread, so the event loop never blocks on
+    disk I/O, and statements go through the connection's prepared
+    statement cache. The connection is in autocommit mode with WAL
+    journaling; `transaction` groups several statements atomically.
+    `observe` is called with the seconds each query took, queueing for
+    the thread included.
+    '''
+
+    def __init__(self, file: str, observe: Optional[Callable[[float], None]] = None) -> None:
+        self.file = file
+        self.observe = observe
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite')
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(
+                self.file, isolation_level=None, check_same_thread=False, cached_statements=256)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute('PRAGMA foreign_keys=ON')
+        return self._conn
+
+    async def run(self, fn: Callable[[sqlite3.Connection], Any]) -> Any:
+        '''
+        Run `fn(connection)` on the database thread
+        '''
+        loop = asyncio.get_running_loop()
+        if self.observe is None:
+            return await loop.run_in_executor(self._executor, lambda: fn(self._connection()))
+
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self._executor, lambda: fn(self._connection()))
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    async def transaction(self, fn: Callable[[sqlite3.Connection], Any]) -> Any:
+        '''
+        Run `fn(connection)` on the database thread inside one transaction
+        '''
+        def atomic(conn: sqlite3.Connection) -> Any:
+            conn.execute('BEGIN')
+            try:
+                result = fn(conn)
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+            return result
+
+        return await self.run(atomic)
+
+    async def execute(self, sql: str, params: Sequence = ()) -> int:
+        '''
+        Run one statement and return the id of the last inserted row
+        '''
+        return await self.run(lambda conn: conn.execute(sql, params).lastrowid)
+
+    async def executemany(self, sql: str, seq_of_params: Iterable[Sequence]) -> None:
+        rows = list(seq_of_params)
+        await self.transaction(lambda conn: conn.executemany(sql, rows))
+
+    async def fetchone(self, sql: str, params: Sequence = ()) -> Optional[sqlite3.Row]:
+        return await self.run(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql: str, params: Sequence = ()) -> List[sqlite3.Row]:
+        return await self.run(lambda conn: conn.execute(sql, params).fetchall())
+
+    def close(self) -> None:
+        def close(conn: sqlite3.Connection) -> None:
+            conn.close()
+            self._conn = None
+
+        if self._conn is not None:
+            self._executor.submit(close, self._conn).result()
+        self._executor.shutdown()
+
+
+class Group(NamedTuple):
+    id: int
+    username: str
+
+
+class ShardMember(NamedTuple):
+    '''
+    A group one shard's bot is a member of, with the bot's input peer
+    '''
+    group_id: int
+    peer_type: Optional[str]
+    access_hash: Optional[int]
+
+
+class Message(NamedTuple):
+    text: str
+    msg_id: int
+
+
+class MessageButton(NamedTuple):
+    name: str
+    link: str
+    msg_id: int
+
+
+class MessageFile(NamedTuple):
+    file_link: str
+    msg_id: int
+    position: int
+
+
+class NewMessage(NamedTuple):
+    '''
+    Message about to be stored, with its files in album order, (name,
+    link) buttons, the groups it is limited to (every group if empty;
+    ids or usernames until the import resolves them), its rotation weight
+    and its own posting interval in seconds
+    '''
+    text: str
+    file_links: List[str]
+    buttons: List[Tuple[str, str]]
+    groups: Sequence[Union[int, str]] = ()
+    weight: float = 1.0
+    interval: Optional[float] = None
+
+
+# repositories
+class GroupRepository(object):
+    def __init__(self, database: Database) -> None:
+        self.database = database
+
+    async def all(self) -> List[Group]:
+        rows = await self.database.fetchall('SELECT id, username FROM groups')
+        return [Group(*row) for row in rows]
+
+    async def add(self, group_id: int, username: str) -> None:
+        await self.database.execute(
+            'INSERT INTO groups(id, username) VALUES(?, ?) '
+            'ON CONFLICT(id) DO UPDATE SET username=excluded.username', (group_id, username))
+
+    async def intervals(self) -> Dict[int, float]:
+        rows = await self.database.fetchall(
+            'SELECT id, post_interval FROM groups WHERE post_interval IS NOT NULL')
+        return dict(rows)
+
+    async def set_interval(self, group_id: int, seconds: Optional[float]) -> None:
+        '''
+        Set or, with None, clear a group's own interval
+        '''
+        await self.database.execute('UPDATE groups SET post_interval=? WHERE id=?', (seconds, group_id))
+
+    async def remove(self, group_id: int) -> None:
+        # shard memberships go with it through ON DELETE CASCADE
+        await self.database.execute('DELETE FROM groups WHERE id=?', (group_id, ))
+
+
+class ShardMemberRepository(object):
+    def __init__(self, database: Database, shard: str) -> None:
+        self.database = database
+        self.shard = shard
+
+    async def all(self) -> List[ShardMember]:
+        rows = await self.database.fetchall(
+            'SELECT group_id, peer_type, access_hash FROM shard_members WHERE shard=?', (self.shard, ))
+        return [ShardMember(*row) for row in rows]
+
+    async def add(self, group_id: int) -> None:
+        await self.database.execute(
+            'INSERT OR IGNORE INTO shard_members(group_id, shard) VALUES(?, ?)', (group_id, self.shard))
+
+    async def remove(self, group_id: int) -> None:
+        await self.database.execute(
+            'DELETE FROM shard_members WHERE group_id=? AND shard=?', (group_id, self.shard))
+
+    async def set_peer(self, group_id: int, peer_type: Optional[str], access_hash: Optional[int]) -> None:
+        await self.database.execute(
+            'UPDATE shard_members SET peer_type=?, access_hash=? WHERE group_id=? AND shard=?',
+            (peer_type, access_hash, group_id, self.shard))
+
+
+class MessageRepository(object):
+    def __init__(self, database: Database) -> None:
+        self.database = database
+
+    async def all(self) -> List[Message]:
+        rows = await self.database.fetchall('SELECT text, msg_id FROM messages')
+        return [Message(*row) for row in rows]
+
+    async def get(self, msg_id: int) -> Optional[Message]:
+        row = await self.database.fetchone('SELECT text, msg_id FROM messages WHERE msg_id=?', (msg_id, ))
+        return Message(*row) if row is not None else None
+
+    async def add_many(self, messages: Sequence[NewMessage]) -> List[int]:
+        '''
+        Store messages in one transaction with batched inserts and return
+        their new ids
+        '''
+        def add(conn: sqlite3.Connection) -> List[int]:
+            sequence = conn.execute("SELECT seq FROM sqlite_sequence WHERE name='messages'").fetchone()
+            first_id = (sequence[0] if sequence is not None else 0) + 1
+            msg_ids = list(range(first_id, first_id + len(messages)))
+
+            conn.executemany(
+                'INSERT INTO messages(msg_id, text, weight, targeted, post_interval) VALUES(?, ?, ?, ?, ?)',
+                [(msg_id, message.text, message.weight, bool(message.groups), message.interval)
+                 for msg_id, message in zip(msg_ids, messages)])
+            conn.executemany(
+                'INSERT OR IGNORE INTO group_messages(group_id, msg_id) VALUES(?, ?)',
+                [(group_id, msg_id) for msg_id, message in zip(msg_ids, messages) for group_id in message.groups])
+            conn.executemany(
+                'INSERT INTO message_files(file_link, msg_id, position) VALUES(?, ?, ?)',
+                [(file_link, msg_id, position) for msg_id, message in zip(msg_ids, messages)
+                 for position, file_link in enumerate(message.file_links)])
+            conn.executemany(
+                'INSERT INTO buttons(name, link, msg_id) VALUES(?, ?, ?)',
+                [(name, link, msg_id) for msg_id, message in zip(msg_ids, messages) for name, link in message.buttons])
+            return msg_ids
+
+        return await self.database.transaction(add)
+
+    async def add(self, message: NewMessage) -> int:
+        return (await self.add_many([message]))[0]
+
+    async def weights(self) -> Dict[int, float]:
+        '''
+        Rotation weights of the messages that don't have the default one
+        '''
+        rows = await self.database.fetchall('SELECT msg_id, weight FROM messages WHERE weight!=1')
+        return dict(rows)
+
+    async def intervals(self) -> Dict[int, float]:
+        rows = await self.database.fetchall(
+            'SELECT msg_id, post_interval FROM messages WHERE post_interval IS NOT NULL')
+        return dict(rows)
+
+    async def set_interval(self, msg_id: int, seconds: Optional[float]) -> bool:
+        '''
+        Set or, with None, clear a message's own interval; False if there
+        is no such message
+        '''
+        updated = await self.database.run(lambda conn: conn.execute(
+            'UPDATE messages SET post_interval=? WHERE msg_id=?', (seconds, msg_id)).rowcount)
+        return updated > 0
+
+    async def delete(self, msg_id: int) -> None:
+        # buttons, files and group assignments go with it through ON DELETE CASCADE
+        await self.database.execute('DELETE FROM messages WHERE msg_id=?', (msg_id, ))
+
+    async def delete_all(self) -> None:
+        await self.database.execute('DELETE FROM messages')
+
+
+class GroupMessageRepository(object):
+    '''
+    Which groups targeted messages are limited to
+    '''
+
+    def __init__(self, database: Database) -> None:
+        self.database = database
+
+    async def targets(self) -> Dict[int, List[int]]:
+        '''
+        Group ids of every targeted message, empty once all of its groups
+        are gone
+        '''
+        rows = await self.database.fetchall(
+            'SELECT messages.msg_id, group_messages.group_id FROM messages '
+            'LEFT JOIN group_messages ON group_messages.msg_id=messages.msg_id WHERE messages.targeted=1')
+        targets: Dict[int, List[int]] = {}
+        for msg_id, group_id in rows:
+            group_ids = targets.setdefault(msg_id, [])
+            if group_id is not None:
+                group_ids.append(group_id)
+        return targets
+
+
+class ButtonRepository(object):
+    def __init__(self, database: Database) -> None:
+        self.database = database
+
+    async def all(self) -> List[MessageButton]:
+        rows = await self.database.fetchall('SELECT name, link, msg_id FROM buttons')
+        return [MessageButton(*row) for row in rows]
+
+    async def for_message(self, msg_id: int) -> List[MessageButton]:
+        rows = await self.database.fetchall('SELECT name, link, msg_id FROM buttons WHERE msg_id=?', (msg_id, ))
+        return [MessageButton(*row) for row in rows]
+
+
+class FileRepository(object):
+    def __init__(self, database: Database) -> None:
+        self.database = database
+
+    async def all(self) -> List[MessageFile]:
+        rows = await self.database.fetchall(
+            'SELECT file_link, msg_id, position FROM message_files ORDER BY msg_id, position')
+        return [MessageFile(*row) for row in rows]
+
+    async def for_message(self, msg_id: int) -> List[MessageFile]:
+        rows = await self.database.fetchall(
+            'SELECT file_link, msg_id, position FROM message_files WHERE msg_id=? ORDER BY position', (msg_id, ))
+        return [MessageFile(*row) for row in rows]
@@ -0,0 +1,125 @@
+import asyncio
+import cProfile
+import io
+import logging
+import pstats
+import sys
+import threading
+import time
+import traceback
+from typing import Callable, List, Optional
+
+
+# loop watchdog
+class LoopWatchdog(object):
+    '''
+    Measures event loop lag and reports blocking calls.
+
+    A task wakes up every `interval` seconds and passes how late it woke
+    up to `observe_lag`. A monitor thread watches that task's heartbeat;
+    once the loop hasn't come back for `block_threshold` seconds, it logs
+    the stack the loop thread is stuck in, so the blocking call shows up
+    while it is still running.
+    '''
+
+    def __init__(self, interval: float = 0.1, block_threshold: float = 0.25,
+                 observe_lag: Optional[Callable[[float], None]] = None) -> None:
+        self.interval = interval
+        self.block_threshold = block_threshold
+        self.observe_lag = observe_lag
+        self._heartbeat = time.monotonic()
+        self._loop_thread: Optional[int] = None
+        self._stopped = threading.Event()
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._stopped.clear()
+        threading.Thread(target=self._monitor, name='loop-watchdog', daemon=True).start()
+
+        try:
+            while True:
+                self._heartbeat = time.monotonic()
+                expected = loop.time() + self.interval
+                await asyncio.sleep(self.interval)
+                lag = max(0.0, loop.time() - expected)
+                if self.observe_lag is not None:
+                    self.observe_lag(lag)
+                if lag >= self.block_threshold:
+                    logging.warning('Event loop was blocked for %.2fs', lag)
+        finally:
+            self._stopped.set()
+
+    def _monitor(self) -> None:
+        reported = None
+        while not self._stopped.wait(self.interval / 2):
+            heartbeat = self._heartbeat
+            blocked = time.monotonic() - heartbeat - self.interval
+            if blocked < self.block_threshold or heartbeat == reported:
+                continue
+
+            # one stack per stall, taken while the loop is still stuck
+            reported = heartbeat
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is not None:
+                stack = ''.join(traceback.format_stack(frame))
+                logging.warning('Event loop blocked for %.2fs so far in:\n%s', blocked, stack)
+
+
+# profiling
+class Profiler(object):
+    '''
+    On-demand cProfile of everything the event loop thread runs for a
+    while, one capture at a time
+    '''
+
+    def __init__(self) -> None:
+        self._lock = asyncio.Lock()
+
+    @property
+    def busy(self) -> bool:
+        return self._lock.locked()
+
+    async def capture(self, seconds: float, limit: int = 60) -> str:
+        '''
+        Profile for `seconds` and return the top `limit` functions by
+        cumulative time
+        '''
+        async with self._lock:
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                profiler.disable()
+
+        report = io.StringIO()
+        pstats.Stats(profiler, stream=report).strip_dirs().sort_stats('cumulative').print_stats(limit)
+        return report.getvalue()
+
+
+def _await_chain(coro) -> List[str]:
+    '''
+    Where a coroutine is suspended, following what it awaits
+    '''
+    lines = []
+    while coro is not None:
+        frame = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None)
+        if frame is None:
+            break
+        lines.append(f'    {frame.f_code.co_filename}:{frame.f_lineno} in {frame.f_code.co_name}')
+        coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None)
+    return lines
+
+
+def task_snapshot() -> str:
+    '''
+    Every pending asyncio task with the chain of awaits it is suspended in
+    '''
+    tasks = sorted(asyncio.all_tasks(), key=lambda task: task.get_name())
+    lines = [f'{len(tasks)} tasks']
+    for task in tasks:
+        coro = task.get_coro()
+        lines.append(f'{task.get_name()}: {getattr(coro, "__qualname__", coro)}')
+        lines.extend(_await_chain(coro))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,248 @@
+import asyncio
+import itertools
+import os
+import random
+import shutil
+from types import SimpleNamespace
+from typing import Dict, List, Optional, Tuple
+
+from telethon import errors, types, utils
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp'}
+
+
+class FakeMessage(object):
+    '''
+    The parts of a telethon Message the bot reads back after sending
+    '''
+
+    def __init__(self, id: int, chat_id: int, text: str = '', media=None) -> None:
+        self.id = id
+        self.chat_id = chat_id
+        self.message = text
+        self.media = media
+
+    async def edit(self, text: str = '', **kwargs) -> 'FakeMessage':
+        self.message = text
+        return self
+
+
+class FakeEvent(object):
+    '''
+    A private NewMessage event from a user, as the router and the state
+    handlers read it
+    '''
+    is_group = False
+    is_private = True
+
+    def __init__(self, client: 'FakeClient', sender_id: int, message: FakeMessage, ext: Optional[str]) -> None:
+        self.client = client
+        self.sender_id = sender_id
+        self.chat_id = sender_id
+        self.chat = types.InputPeerUser(user_id=sender_id, access_hash=0)
+        self.message = message
+        self.raw_text = message.message
+        self.media = message.media
+        self.file = SimpleNamespace(ext=ext) if message.media is not None else None
+
+    async def download_media(self, file: str) -> str:
+        return await self.client.download_media(self.message, file)
+
+
+# fake client
+class FakeClient(object):
+    '''
+    In-process stand-in for the TelegramClient calls the bot makes.
+
+    Sends return messages with photo/document media, so media and peer
+    caches behave as with Telegram. Every request takes about `latency`
+    seconds, fails with a FloodWait of `flood_wait_seconds` with
+    probability `flood_wait_rate`, and uploading a local file costs its
+    size divided by `upload_speed` (bytes per second, 0 for free).
+    Nothing is sent anywhere; every sent message is kept in `sent`.
+    '''
+
+    def __init__(self, session=None, api_id=None, api_hash=None, dc_id: int = 2, latency: float = 0.0,
+                 flood_wait_rate: float = 0.0, flood_wait_seconds: int = 1, upload_speed: float = 0.0,
+                 seed: Optional[int] = None) -> None:
+        self.session = SimpleNamespace(filename=session, dc_id=dc_id)
+        self.latency = latency
+        self.flood_wait_rate = flood_wait_rate
+        self.flood_wait_seconds = flood_wait_seconds
+        self.upload_speed = upload_speed
+        self.random = random.Random(seed)
+
+        self.sent: List[FakeMessage] = []
+        self.requests = 0
+        self.flood_waits = 0
+        self.uploads = 0
+        self.uploaded_bytes = 0
+
+        self._handlers: List[Tuple[object, object]] = []
+        self._messages: Dict[Tuple[int, int], FakeMessage] = {}
+        # media id -> local file it was made from, for download_media
+        self._files: Dict[int, str] = {}
+        self._ids = itertools.count(1)
+        self._disconnected: Optional[asyncio.Future] = None
+
+    async def _request(self) -> None:
+        '''
+        One round trip to the simulated server
+        '''
+        self.requests += 1
+        if self.latency:
+            # spread around the mean, with the odd slow response
+            await asyncio.sleep(self.latency * self.random.expovariate(1))
+        if self.flood_wait_rate and self.random.random() < self.flood_wait_rate:
+            self.flood_waits += 1
+            raise errors.FloodWaitError(request=None, capture=self.flood_wait_seconds)
+
+    # connection
+    async def start(self, bot_token: Optional[str] = None, **kwargs) -> 'FakeClient':
+        self._disconnected = asyncio.get_running_loop().create_future()
+        return self
+
+    def add_event_handler(self, callback, event=None) -> None:
+        self._handlers.append((callback, event))
+
+    async def run_until_disconnected(self) -> None:
+        if self._disconnected is not None:
+            await self._disconnected
+
+    async def disconnect(self) -> None:
+        if self._disconnected is not None and not self._disconnected.done():
+            self._disconnected.set_result(None)
+
+    # entities
+    async def get_input_entity(self, peer) -> types.TypeInputPeer:
+        await self._request()
+        if isinstance(peer, int):
+            real_id, peer_type = utils.resolve_id(peer)
+            if peer_type is types.PeerChannel:
+                return types.InputPeerChannel(channel_id=real_id, access_hash=real_id)
+            if peer_type is types.PeerChat:
+                return types.InputPeerChat(chat_id=real_id)
+            return types.InputPeerUser(user_id=real_id, access_hash=real_id)
+        return utils.get_input_peer(peer)
+
+    @staticmethod
+    def _chat_id(entity) -> int:
+        if isinstance(entity, int):
+            return entity
+        return utils.get_peer_id(entity)
+
+    # media
+    async def _media(self, file):
+        '''
+        Telegram's media for an uploaded path or a reused input photo or
+        document
+        '''
+        if file is None:
+            return None
+
+        file_reference = os.urandom(8)
+        if isinstance(file, types.InputPhoto):
+            return self._photo(file.id, file.access_hash, file_reference)
+        if isinstance(file, types.InputDocument):
+            return self._document(file.id, file.access_hash, file_reference)
+
+        media_id = next(self._ids)
+        if hasattr(file, 'getbuffer'):
+            # in-memory file, e.g. a report
+            size = file.getbuffer().nbytes
+            file = getattr(file, 'name', '')
+        else:
+            size = os.path.getsize(file) if os.path.exists(file) else 0
+            self._files[media_id] = file
+        self.uploads += 1
+        self.uploaded_bytes += size
+        if self.upload_speed:
+            await asyncio.sleep(size / self.upload_speed)
+
+        if os.path.splitext(str(file))[1].lower() in IMAGE_EXTENSIONS:
+            return self._photo(media_id, media_id, file_reference)
+        return self._document(media_id, media_id, file_reference)
+
+    @staticmethod
+    def _photo(media_id: int, access_hash: int, file_reference: bytes) -> types.MessageMediaPhoto:
+        return types.MessageMediaPhoto(photo=types.Photo(
+            id=media_id, access_hash=access_hash, file_reference=file_reference,
+            date=None, sizes=[], dc_id=2))
+
+    @staticmethod
+    def _document(media_id: int, access_hash: int, file_reference: bytes,
+                  mime_type: str = 'application/octet-stream') -> types.MessageMediaDocument:
+        return types.MessageMediaDocument(document=types.Document(
+            id=media_id, access_hash=access_hash, file_reference=file_reference,
+            date=None, mime_type=mime_type, size=0, dc_id=2, attributes=[]))
+
+    def _store(self, entity, text: str = '', media=None) -> FakeMessage:
+        chat_id = self._chat_id(entity)
+        message = FakeMessage(next(self._ids), chat_id, text, media)
+        self._messages[(chat_id, message.id)] = message
+        self.sent.append(message)
+        return message
+
+    # messages
+    async def send_message(self, entity, message: str = '', file=None, thumb=None, buttons=None,
+                           **kwargs) -> FakeMessage:
+        await self._request()
+        return self._store(entity, message, await self._media(file))
+
+    async def send_file(self, entity, file, caption: str = '', **kwargs):
+        await self._request()
+        if isinstance(file, (list, tuple)):
+            media = [await self._media(f) for f in file]
+            return [self._store(entity, caption if i == 0 else '', m) for i, m in enumerate(media)]
+        return self._store(entity, caption, await self._media(file))
+
+    async def forward_messages(self, entity, messages, from_peer=None, drop_author: bool = False,
+                               **kwargs) -> List[FakeMessage]:
+        await self._request()
+        from_chat_id = self._chat_id(from_peer)
+        ids = messages if isinstance(messages, (list, tuple)) else [messages]
+        forwarded = []
+        for msg_id in ids:
+            original = self._messages.get((from_chat_id, msg_id))
+            if original is None:
+                raise errors.MessageIdInvalidError(request=None)
+            forwarded.append(self._store(entity, original.message, original.media))
+        return forwarded
+
+    async def get_messages(self, entity, ids=None):
+        await self._request()
+        chat_id = self._chat_id(entity)
+        if isinstance(ids, (list, tuple)):
+            return [self._messages.get((chat_id, msg_id)) for msg_id in ids]
+        return self._messages.get((chat_id, ids))
+
+    async def download_media(self, message=None, file=None, **kwargs) -> str:
+        await self._request()
+        media = getattr(message, 'media', message)
+        item = getattr(media, 'photo', None) or getattr(media, 'document', None)
+        source = self._files.get(getattr(item, 'id', None))
+        if source is None:
+            open(file, 'wb').close()
+        else:
+            shutil.copyfile(source, file)
+        return file
+
+    # incoming updates
+    def incoming(self, sender_id: int, text: str = '', file: Optional[str] = None,
+                 mime_type: Optional[str] = None) -> FakeEvent:
+        '''
+        A private message to the bot with optional local `file` attached,
+        to feed to the bot's handlers
+        '''
+        media, ext = None, None
+        if file is not None:
+            media_id = next(self._ids)
+            self._files[media_id] = file
+            ext = os.path.splitext(file)[1]
+            if mime_type is None and ext.lower() in IMAGE_EXTENSIONS:
+                media = self._photo(media_id, media_id, b'')
+            else:
+                media = self._document(media_id, media_id, b'', mime_type or 'application/octet-stream')
+
+        message = FakeMessage(next(self._ids), sender_id, text, media)
+        return FakeEvent(self, sender_id, message, ext)
@@ -0,0 +1,151 @@
+import sqlite3
+import time
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+from telethon import errors
+
+from change_feed import Change, ChangeKind
+from database import Database
+from rate_limiter import TRANSIENT_ERRORS
+from sender import SendResult
+
+# errors meaning the bot can't post to the group until someone fixes it
+HARD_ERRORS = (
+    errors.ChatWriteForbiddenError,
+    errors.ChatForbiddenError,
+    errors.ChatGuestSendForbiddenError,
+    errors.ChatSendPlainForbiddenError,
+    errors.ChatSendMediaForbiddenError,
+    errors.ChatSendPhotosForbiddenError,
+    errors.ChatAdminRequiredError,
+    errors.ChatRestrictedError,
+    errors.UserBannedInChannelError,
+    errors.ChannelPrivateError,
+    errors.ChannelInvalidError,
+    errors.ChatIdInvalidError,
+    errors.PeerIdInvalidError,
+    errors.UserKickedError,
+    errors.UserNotParticipantError,
+)
+
+
+class HealthState(NamedTuple):
+    group_id: int
+    # in a row, and how many of those were hard errors
+    failures: int
+    hard_failures: int
+    last_error: Optional[str]
+    last_failure: Optional[float]
+    last_success: Optional[float]
+    retry_at: float
+    quarantined: bool
+
+
+# group health
+class GroupHealth(object):
+    '''
+    Delivery health of every group.
+
+    Failures in a row push a group's next attempt back exponentially,
+    from `base_backoff` seconds up to `max_backoff`, so posting turns go
+    to groups that can receive posts. After `quarantine_after` hard
+    failures in a row (kicked, private, no write permission) a group is
+    quarantined until the bot is added to it again. Transient errors are
+    the retry queue's business and don't count.
+    '''
+
+    def __init__(self, database: Database, quarantine_after: int = 3, base_backoff: float = 60,
+                 max_backoff: float = 86400) -> None:
+        self.database = database
+        self.quarantine_after = quarantine_after
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self._states: Dict[int, HealthState] = {}
+
+    async def load(self) -> None:
+        rows = await self.database.fetchall(
+            'SELECT group_id, failures, hard_failures, last_error, last_failure, last_success, retry_at, '
+            'quarantined FROM group_health')
+        self._states = {row[0]: HealthState(*row[:7], bool(row[7])) for row in rows}
+
+    def available(self, group_id: int, now: Optional[float] = None) -> bool:
+        '''
+        Whether a group should get its post now
+        '''
+        state = self._states.get(group_id)
+        if state is None or not state.failures:
+            return True
+        if state.quarantined:
+            return False
+        return state.retry_at <= (time.time() if now is None else now)
+
+    def _next(self, state: Optional[HealthState], group_id: int, result: SendResult,
+              now: float) -> Optional[HealthState]:
+        if state is None:
+            state = HealthState(group_id, 0, 0, None, None, None, 0.0, False)
+
+        if result.ok:
+            return state._replace(failures=0, hard_failures=0, last_success=now, retry_at=0.0, quarantined=False)
+
+        if isinstance(result.error, TRANSIENT_ERRORS):
+            return None
+
+        failures = state.failures + 1
+        hard_failures = state.hard_failures + 1 if isinstance(result.error, HARD_ERRORS) else 0
+        return state._replace(
+            failures=failures,
+            hard_failures=hard_failures,
+            last_error=type(result.error).__name__,
+            last_failure=now,
+            retry_at=now + min(self.max_backoff, self.base_backoff * 2 ** (failures - 1)),
+            quarantined=hard_failures >= self.quarantine_after
+        )
+
+    async def record(self, results: Iterable[SendResult]) -> List[HealthState]:
+        '''
+        Update the groups of one posting batch and return the ones that
+        were quarantined by it
+        '''
+        now = time.time()
+        changed = []
+        quarantined = []
+        for result in results:
+            previous = self._states.get(result.group_id)
+            state = self._next(previous, result.group_id, result, now)
+            if state is None:
+                continue
+            self._states[result.group_id] = state
+            changed.append(state)
+            if state.quarantined and (previous is None or not previous.quarantined):
+                quarantined.append(state)
+
+        if changed:
+            def save(conn: sqlite3.Connection) -> None:
+                # skip groups removed while the batch was being sent
+                conn.executemany(
+                    'INSERT OR REPLACE INTO group_health(group_id, failures, hard_failures, last_error, '
+                    'last_failure, last_success, retry_at, quarantined) '
+                    'SELECT ?, ?, ?, ?, ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM groups WHERE id=?)',
+                    [tuple(state) + (state.group_id, ) for state in changed])
+
+            await self.database.transaction(save)
+        return quarantined
+
+    async def reset(self, group_id: int) -> None:
+        '''
+        Forget the failures of a group, e.g. when the bot is added back
+        '''
+        self._states.pop(group_id, None)
+        await self.database.execute('DELETE FROM group_health WHERE group_id=?', (group_id, ))
+
+    def unhealthy(self) -> List[HealthState]:
+        '''
+        Quarantined groups first, then the ones backing off, by failures
+        '''
+        states = [state for state in self._states.values() if state.failures]
+        return sorted(states, key=lambda state: (not state.quarantined, -state.failures))
+
+    def apply(self, change: Change) -> None:
+        # the rows themselves are removed by ON DELETE CASCADE
+        if change.kind == ChangeKind.GROUP_REMOVED:
+            self._states.pop(change.key, None)
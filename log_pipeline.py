@@ -0,0 +1,135 @@
+import copy
+import json
+import logging
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Dict, List, NamedTuple, Tuple
+
+# attributes every LogRecord has; anything else came in through `extra`
+_RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'template'}
+
+
+class _RecordQueueHandler(QueueHandler):
+    '''
+    Render the message and traceback in the logging thread, like
+    QueueHandler, but keep the message template and the exception type
+    for the digest
+    '''
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.template = str(record.msg)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if record.exc_info[0] is not None:
+                record.error_type = record.exc_info[0].__name__
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    '''
+    One JSON object per line, with `extra` fields kept as keys
+    '''
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DigestEntry(NamedTuple):
+    # the latest message logged with this template
+    message: str
+    error: str
+    count: int
+    first_seen: float
+    last_seen: float
+
+
+# error digest
+class ErrorDigest(logging.Handler):
+    '''
+    Counts error records by message template and exception type, so one
+    failure repeated for every group shows up once with a count
+    '''
+
+    def __init__(self, level: int = logging.ERROR) -> None:
+        super().__init__(level)
+        self._entries: Dict[Tuple[str, str, str], DigestEntry] = {}
+        self._entries_lock = threading.Lock()
+
+    def emit(self, record: logging.LogRecord) -> None:
+        error = getattr(record, 'error_type', '')
+        template = getattr(record, 'template', str(record.msg))
+        key = (record.name, template, error)
+        message = record.getMessage().split('\n', 1)[0]
+
+        with self._entries_lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._entries[key] = DigestEntry(message, error, 1, record.created, record.created)
+            else:
+                self._entries[key] = entry._replace(
+                    message=message, count=entry.count + 1, last_seen=record.created)
+
+    def drain(self) -> List[DigestEntry]:
+        '''
+        Take the collected entries, most frequent first
+        '''
+        with self._entries_lock:
+            entries, self._entries = self._entries, {}
+        return sorted(entries.values(), key=lambda entry: entry.count, reverse=True)
+
+
+def setup_logging(file: str, level: int = logging.INFO, max_bytes: int = 5 * 1024 * 1024,
+                  backup_count: int = 3) -> Tuple[QueueListener, ErrorDigest]:
+    '''
+    Route all records through a queue to a listener thread that writes the
+    console, a rotating JSON log file and the error digest, so logging
+    never blocks the event loop. The listener still has to be started.
+    '''
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter(
+        fmt='%(asctime)s - %(levelname)s - %(message)s',
+        datefmt='%d-%b-%y %H:%M:%S'
+    ))
+
+    log_file = RotatingFileHandler(file, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+    log_file.setFormatter(JsonFormatter())
+
+    digest = ErrorDigest()
+
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers = [_RecordQueueHandler(records)]
+    root.setLevel(level)
+    # telethon logs every request at DEBUG and INFO
+    logging.getLogger('telethon').setLevel(logging.WARNING)
+
+    listener = QueueListener(records, console, log_file, digest, respect_handler_level=True)
+    return listener, digest
+
+
+def format_digest(entries: List[DigestEntry], limit: int = 20) -> str:
+    lines = []
+    for entry in entries[:limit]:
+        error = f' ({entry.error})' if entry.error else ''
+        last_seen = time.strftime('%H:%M:%S', time.localtime(entry.last_seen))
+        lines.append(f'{entry.count}× {entry.message}{error}, last at {last_seen}')
+    if len(entries) > limit:
+        lines.append(f'… and {len(entries) - limit} more')
+    return '\n'.join(lines)
@@ -1,32 +1,130 @@
-from telethon.sync import TelegramClient, Button, events
+from telethon import TelegramClient, Button, events
+from telethon import errors
 from configparser import ConfigParser
 import logging
 from enum import auto
 import os
-import sqlite3
 import json
 import asyncio
-import uuid
-import traceback
+import contextlib
+import functools
+import io
+import tempfile
+import time
+from typing import Dict, Optional, Set
+
+from change_feed import AddedMessage, ChangeFeed, ChangeKind
+from database import (
+    ButtonRepository, Database, FileRepository, GroupMessageRepository, GroupRepository, MessageRepository,
+    NewMessage
+)
+from diagnostics import LoopWatchdog, Profiler, task_snapshot
+from fakeclient import FakeClient
+from group_health import HARD_ERRORS, GroupHealth
+from log_pipeline import format_digest, setup_logging
+from media_processing import MediaProcessor
+from media_store import MediaStore
+from message_import import MAX_ALBUM_FILES, ImportFormatError, ImportProgress, parse_message_file, resolve_groups
+from metrics import MetricsRegistry, MetricsServer
+from migrations import migrate
+from outbox import Outbox, Post
+from peer_cache import PEER_ERRORS
+from rate_limiter import TRANSIENT_ERRORS, RetryQueue
+from render_cache import RenderCache, RenderedMessage
+from rotation import MessageRotation
+from router import Router, translations
+from scheduler import Scheduler
+from sender import FanOutSender, SendResult
+from session_store import SessionStore
+from settings import Settings
+from sharding import MAIN_SHARD, Shard, ShardSet
+from staging import StagingChannel, StagingError
+
+
+# startup timing
+class Startup(object):
+    '''
+    Startup milestones, in seconds since the process started
+    '''
+
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.ready: Optional[float] = None
+        self.first_update: Optional[float] = None
+        self._ready = asyncio.Event()
 
+    def mark_ready(self) -> None:
+        self.ready = time.perf_counter() - self.started
+        self._ready.set()
+        logging.info('Ready to handle updates %.2fs after start', self.ready)
 
-# console logger
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    datefmt='%d-%b-%y %H:%M:%S'
-    )
+    async def wait_ready(self) -> None:
+        '''
+        Hold updates Telegram delivers while logging in, or replays from
+        the stored session, until the state is loaded
+        '''
+        await self._ready.wait()
+
+    def mark_update_handled(self) -> None:
+        if self.first_update is None:
+            self.first_update = time.perf_counter() - self.started
+            logging.info('First update handled %.2fs after start', self.first_update)
+
+startup = Startup()
+
+
+# folder with config.ini and everything the bot writes, next to the code
+# unless AUTOPOST_HOME points elsewhere (e.g. for benchmarks)
+home_path: str = os.environ.get('AUTOPOST_HOME', os.path.dirname(__file__))
 
 
 # Read config
 parser = ConfigParser()
-parser.read(os.path.join(os.path.dirname(__file__), 'config.ini'))
+parser.read(os.path.join(home_path, 'config.ini'))
 tg_api_id: int = int(parser['Telegram']['api_id'])
 tg_api_hash: str = parser['Telegram']['api_hash']
 tg_bot_token: str = parser['Telegram']['bot_token']
+# more bots to spread the groups over, each added to its own groups
+extra_bot_tokens: list = [
+    x.strip() for x in parser['Telegram'].get('extra_bot_tokens', fallback='').split(',') if x.strip()
+]
+# post through an in-process fake instead of Telegram, for local testing
+fake_telegram: bool = parser['Telegram'].getboolean('fake_telegram', fallback=False)
 
 admins: list = [ int(x) for x in parser['Settings']['admins'].split(',') ]
 bot_lang: str = parser['Settings']['language']
+max_parallel_sends: int = parser['Settings'].getint('max_parallel_sends', fallback=8)
+max_sessions: int = parser['Settings'].getint('max_sessions', fallback=1000)
+session_ttl: int = parser['Settings'].getint('session_ttl', fallback=86400)
+persist_sessions: bool = parser['Settings'].getboolean('persist_sessions', fallback=True)
+log_level: str = parser['Settings'].get('log_level', fallback='INFO')
+error_digest_interval: int = parser['Settings'].getint('error_digest_interval', fallback=3600)
+media_gc_interval: int = parser['Settings'].getint('media_gc_interval', fallback=3600)
+outbox_prune_interval: int = parser['Settings'].getint('outbox_prune_interval', fallback=3600)
+optimize_media: bool = parser['Settings'].getboolean('optimize_media', fallback=True)
+media_workers: int = parser['Settings'].getint('media_workers', fallback=2)
+# private channel messages are posted to once and forwarded from, if set
+staging_channel: str = parser['Settings'].get('staging_channel', fallback='').strip()
+staging_channel_id: Optional[int] = int(staging_channel) if staging_channel else None
+# local Prometheus endpoint, off when the port is 0
+metrics_host: str = parser['Settings'].get('metrics_host', fallback='127.0.0.1')
+metrics_port: int = parser['Settings'].getint('metrics_port', fallback=0)
+# event loop watchdog and slow handler warnings
+diagnostics: bool = parser['Settings'].getboolean('diagnostics', fallback=False)
+block_threshold: float = parser['Settings'].getfloat('block_threshold', fallback=0.25)
+slow_handler_threshold: float = parser['Settings'].getfloat('slow_handler_threshold', fallback=1.0)
+# groups back off after failures and are quarantined after this many hard ones in a row
+quarantine_after: int = parser['Settings'].getint('quarantine_after', fallback=3)
+health_backoff: int = parser['Settings'].getint('health_backoff', fallback=60)
+# round_robin, weighted or shuffle
+rotation_strategy: str = parser['Settings'].get('rotation', fallback='round_robin').strip()
+
+
+# logging
+log_listener, error_digest = setup_logging(
+    file=os.path.join(home_path, 'log.jsonl'),
+    level=logging.getLevelName(log_level.upper())
+)
     
 
 # read bot commands and messages
@@ -34,25 +132,68 @@ with open(file=os.path.join(os.path.dirname(__file__), 'bot_text.json'), mode='r
     bot_text: dict = json.loads(f.read())
 
 
-# connect database
-class SQLite():
-    def __init__(self, file: str = os.path.join(os.path.dirname(__file__), 'database.db')):
-        self.file = file
+# metrics
+metrics = MetricsRegistry()
+sends_total = metrics.counter(
+    'autopost_sends_total', 'Deliveries to groups by outcome', labels=('shard', 'result'))
+send_seconds = metrics.histogram(
+    'autopost_send_seconds', 'Time to deliver one post to a group, rate limit waits included', labels=('group', ))
+rate_limit_wait_seconds = metrics.histogram(
+    'autopost_rate_limit_wait_seconds', 'Time deliveries slept in the rate limiter', labels=('shard', ))
+flood_wait_seconds_total = metrics.counter(
+    'autopost_flood_wait_seconds_total', 'Seconds Telegram asked the bot to wait', labels=('shard', 'kind'))
+upload_bytes_total = metrics.counter(
+    'autopost_upload_bytes_total', 'Bytes of media uploaded to Telegram', labels=('shard', ))
+post_batch_seconds = metrics.histogram(
+    'autopost_post_batch_seconds', 'Time to post one message to all groups it was due for')
+db_query_seconds = metrics.histogram(
+    'autopost_db_query_seconds', 'SQLite query time, waiting for the database thread included')
+handler_seconds = metrics.histogram(
+    'autopost_handler_seconds', 'Time spent handling admin messages', labels=('handler', ))
+loop_lag_seconds = metrics.histogram(
+    'autopost_loop_lag_seconds', 'How late the event loop ran a timer, measured in diagnostics mode',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
 
-    def __enter__(self):
-        self.conn = sqlite3.connect(self.file)
-        self.conn.row_factory = sqlite3.Row
-        return self.conn.cursor()
 
-    def __exit__(self, type, value, traceback):
-        self.conn.commit()
-        self.conn.close()
+def record_handler(handler, seconds: float) -> None:
+    handler_seconds.observe(seconds, handler=handler.__name__)
+    if diagnostics and seconds >= slow_handler_threshold:
+        logging.warning('Handler %s took %.2fs', handler.__name__, seconds, extra={'handler': handler.__name__})
 
-with SQLite() as db_con:
-    db_con.execute('CREATE TABLE IF NOT EXISTS groups(id INTEGER, username TEXT)')
-    db_con.execute('CREATE TABLE IF NOT EXISTS messages(text TEXT, msg_id INTEGER)')
-    db_con.execute('CREATE TABLE IF NOT EXISTS buttons(name TEXT, link TEXT, msg_id INTEGER)')
-    db_con.execute('CREATE TABLE IF NOT EXISTS message_files(file_link TEXT, msg_id INTEGER)')
+
+watchdog = LoopWatchdog(block_threshold=block_threshold, observe_lag=loop_lag_seconds.observe)
+profiler = Profiler()
+
+
+# connect database
+database = Database(os.path.join(home_path, 'database.db'), observe=db_query_seconds.observe)
+group_repository = GroupRepository(database)
+message_repository = MessageRepository(database)
+group_message_repository = GroupMessageRepository(database)
+button_repository = ButtonRepository(database)
+file_repository = FileRepository(database)
+
+files_folder_path = os.path.join(home_path, 'files')
+
+media_store = MediaStore(database=database, folder=files_folder_path)
+media_processor = MediaProcessor(database=database, max_workers=media_workers, enabled=optimize_media)
+render_cache = RenderCache(messages=message_repository, buttons=button_repository, files=file_repository)
+outbox = Outbox(database=database)
+staging = StagingChannel(database=database, channel_id=staging_channel_id)
+settings = Settings(database=database)
+group_health = GroupHealth(database=database, quarantine_after=quarantine_after, base_backoff=health_backoff)
+
+# bot accounts, each posting to the groups it owns
+shards = ShardSet(database, [Shard(MAIN_SHARD, tg_bot_token, database)] + [
+    Shard(str(int(token.split(':', 1)[0])), token, database) for token in extra_bot_tokens
+])
+
+# message and group mutations, applied live by the running sender
+change_feed = ChangeFeed()
+change_feed.subscribe(render_cache.apply)
+change_feed.subscribe(staging.apply)
+change_feed.subscribe(shards.apply)
+change_feed.subscribe(group_health.apply)
 
 
 # interval
@@ -60,8 +201,12 @@ class Interval(object):
     def __init__(self) -> None:
         self.current_interval = 60
 
-    def set_interval(self, interval) -> None:
+    async def load(self) -> None:
+        self.current_interval = await settings.get('interval', self.current_interval)
+
+    async def set_interval(self, interval) -> None:
         self.current_interval = interval
+        await settings.set('interval', interval)
 
 interval = Interval()
 
@@ -80,9 +225,33 @@ class ChatState:
     set_run_24x7_state: auto = auto()
 
 
-chat_state: dict = dict()
+sessions = SessionStore(
+    states=ChatState,
+    max_sessions=max_sessions,
+    ttl=session_ttl,
+    database=database if persist_sessions else None
+)
+# album files each admin is still downloading, kept out of the stored session
+album_downloads: Dict[int, int] = {}
+
+# tasks running next to the bot; the loop only keeps weak references to them
+background_tasks: Set[asyncio.Task] = set()
+
 
-pending_message_data = {}
+def background_task_done(task: asyncio.Task) -> None:
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logging.error('Background task %s failed', task.get_name(), exc_info=task.exception())
+
+
+def start_background(coro) -> asyncio.Task:
+    '''
+    run a coroutine next to the bot, keeping its task until it is done
+    '''
+    task = asyncio.create_task(coro, name=coro.__qualname__)
+    background_tasks.add(task)
+    task.add_done_callback(background_task_done)
+    return task
 
 
 # Run state
@@ -92,39 +261,39 @@ class RunState:
 
     def __init__(self):
         self.current_run_state = self.STOPPED
+        self.task = None
 
-    def set_run_state(self, state):
+    async def load(self) -> None:
+        if await settings.get('running', False):
+            self.current_run_state = self.STARTED
+
+    async def set_run_state(self, state):
         self.current_run_state = state
+        await settings.set('running', state == self.STARTED)
 
 run_state = RunState()
 
 
-# start bot
-session_folder_path: str = os.path.join(os.path.dirname(__file__), 'sessions')
-if not os.path.exists(session_folder_path):
-    os.mkdir(session_folder_path)
+# telegram clients, created by start_shard
+session_folder_path: str = os.path.join(home_path, 'sessions')
 
-bot_session_path = os.path.join(session_folder_path, 'bot.session')
-if os.path.exists(bot_session_path):
-    os.remove(bot_session_path)
+# client of the main shard, the bot admins talk to
+bot: Optional[TelegramClient] = None
 
-bot = TelegramClient(
-    session=os.path.join(bot_session_path),
-    api_id=tg_api_id,
-    api_hash=tg_api_hash
-)
 
-bot.start(bot_token=tg_bot_token)
+# private message router
+router = Router(
+    is_admin=lambda sender_id: sender_id in admins,
+    get_state=sessions.state,
+    observe=record_handler
+)
 
 
-@bot.on(events.NewMessage(pattern='^/start|{}$'.format(bot_text['button']['back'][bot_lang])))
+@router.command('/start', *translations(bot_text['button'], 'back'), public=True)
 async def start_command_handler(event: events.NewMessage.Event) -> None:
     '''
     /start command handler
     '''
-    if event.is_group:
-        return
-    
     if event.sender_id in admins:
         await bot.send_message(
             entity=event.chat,
@@ -138,6 +307,10 @@ async def start_command_handler(event: events.NewMessage.Event) -> None:
                 Button.text(
                     text=bot_text['button']['remove_group'][bot_lang],
                     resize=True
+                ),
+                Button.text(
+                    text=bot_text['button']['group_health'][bot_lang],
+                    resize=True
                 )
             ],
             [
@@ -162,6 +335,10 @@ async def start_command_handler(event: events.NewMessage.Event) -> None:
                 Button.text(
                     text=bot_text['button']['run_24x7'][bot_lang],
                     resize=True
+                ),
+                Button.text(
+                    text=bot_text['button']['stats'][bot_lang],
+                    resize=True
                 )
             ]
         ])
@@ -170,25 +347,20 @@ async def start_command_handler(event: events.NewMessage.Event) -> None:
             entity=event.chat,
             message=bot_text['response']['no_bot_access'][bot_lang])
     
-    chat_state[str(event.sender_id)] = ChatState.bot_started
-    raise events.StopPropagation
+    await sessions.end(event.sender_id)
 
 
-@bot.on(events.NewMessage(pattern='^{}$'.format(bot_text['button']['get_current_setting'][bot_lang])))
+@router.command(*translations(bot_text['button'], 'get_current_setting'))
 async def get_current_settings_command_handler(event: events.NewMessage.Event) -> None:
     '''
     Get Current Settings command handler
     '''
-    if event.is_group:
-        return
-
-    with SQLite() as db_con:
-        group_usernames = db_con.execute('SELECT username FROM groups').fetchall()
+    groups = await group_repository.all()
 
     run_status = 'Turned On' if run_state.current_run_state == RunState.STARTED else 'Turned Off'
 
     message = bot_text['response']['current_setting'][bot_lang].format(
-        ' '.join(['@' + username[0] for username in group_usernames]),
+        ' '.join(['@' + group.username for group in groups]),
         run_status,
         interval.current_interval
     )
@@ -198,23 +370,18 @@ async def get_current_settings_command_handler(event: events.NewMessage.Event) -
         message=message
     )
 
-    raise events.StopPropagation
     
-@bot.on(events.NewMessage(pattern='^{}$'.format(bot_text['button']['remove_group'][bot_lang])))
+@router.command(*translations(bot_text['button'], 'remove_group'))
 async def remove_group_command_handler(event: events.NewMessage.Event) -> None:
     '''
     Remove group command handler
     '''
-    if event.is_group:
-        return
-    
     message = bot_text['response']['groups'][bot_lang]
-    with SQLite() as db_con:
-        group_usernames = db_con.execute('SELECT username FROM groups').fetchall()
+    groups = await group_repository.all()
         
-    if len(group_usernames) >= 1:
-        for username in group_usernames:
-            message = message + f"\n{group_usernames.index(username) + 1} ➖ {username[0]}"
+    if len(groups) >= 1:
+        for index, group in enumerate(groups, start=1):
+            message = message + f"\n{index} ➖ {group.username}"
             
         message = message + '\n' + bot_text['response']['enter_group_number'][bot_lang]
             
@@ -228,24 +395,53 @@ async def remove_group_command_handler(event: events.NewMessage.Event) -> None:
                 )
             ]
         )
-        chat_state[str(event.sender_id)] = ChatState.waiting_for_del_group_id
+        await sessions.set_state(event.sender_id, ChatState.waiting_for_del_group_id)
     else:
         await bot.send_message(
             entity=event.chat,
             message=bot_text['response']['no_groups_to_remove'][bot_lang]
         )
         
-    raise events.StopPropagation
 
 
-@bot.on(events.NewMessage(pattern='^{}$'.format(bot_text['button']['add_msg_json'][bot_lang])))
-async def add_message_json_command_handler(event: events.NewMessage.Event) -> None:
+@router.command(*translations(bot_text['button'], 'group_health'))
+async def group_health_command_handler(event: events.NewMessage.Event) -> None:
     '''
-    Add Message JSON command handler
+    Group health command handler
     '''
-    if event.is_group:
+    states = group_health.unhealthy()
+    if not states:
+        await bot.send_message(
+            entity=event.chat,
+            message=bot_text['response']['all_groups_healthy'][bot_lang]
+        )
         return
 
+    def when(timestamp) -> str:
+        return time.strftime('%d-%m %H:%M', time.localtime(timestamp)) if timestamp else '—'
+
+    usernames = {group.id: group.username for group in await group_repository.all()}
+    message = bot_text['response']['group_health'][bot_lang]
+    for state in states[:50]:
+        status = '⛔' if state.quarantined else f'⏳ {when(state.retry_at)}'
+        message += (
+            f"\n{status} {usernames.get(state.group_id, state.group_id)}: "
+            f"{state.failures}× {state.last_error}, ✅ {when(state.last_success)}"
+        )
+    if len(states) > 50:
+        message += f'\n… +{len(states) - 50}'
+
+    await bot.send_message(
+        entity=event.chat,
+        message=message
+    )
+
+
+@router.command(*translations(bot_text['button'], 'add_msg_json'))
+async def add_message_json_command_handler(event: events.NewMessage.Event) -> None:
+    '''
+    Add Message JSON command handler
+    '''
     await bot.send_message(
         entity=event.chat,
         message=bot_text['response']['upload_json'][bot_lang],
@@ -257,17 +453,13 @@ async def add_message_json_command_handler(event: events.NewMessage.Event) -> No
             ]
     )
 
-    chat_state[str(event.sender_id)] = ChatState.waiting_for_message_json
-    raise events.StopPropagation
+    await sessions.set_state(event.sender_id, ChatState.waiting_for_message_json)
 
-@bot.on(events.NewMessage(pattern='^{}$'.format(bot_text['button']['add_message'][bot_lang])))
+@router.command(*translations(bot_text['button'], 'add_message'))
 async def add_message_command_handler(event: events.NewMessage.Event) -> None:
     '''
     Add message command handler
     '''
-    if event.is_group:
-        return
-        
     await bot.send_message(
         entity=event.chat,
         message=bot_text['response']['enter_message_text'][bot_lang],
@@ -279,21 +471,14 @@ async def add_message_command_handler(event: events.NewMessage.Event) -> None:
             ]
     )
 
-    pending_message_data[str(event.sender_id)] = {}
-    pending_message_data[str(event.sender_id)]['buttons'] = []
-
-    chat_state[str(event.sender_id)] = ChatState.waiting_for_message_text
-    raise events.StopPropagation
+    await sessions.begin(event.sender_id, ChatState.waiting_for_message_text, buttons=[])
 
 
-@bot.on(events.NewMessage(pattern='^{}$'.format(bot_text['button']['delete_message'][bot_lang])))
+@router.command(*translations(bot_text['button'], 'delete_message'))
 async def delete_message_command_handler(event: events.NewMessage.Event) -> None:
     '''
     Delete message command handler
     ''' 
-    if event.is_group:
-        return
-        
     await bot.send_message(
         entity=event.chat,
         message=bot_text['response']['enter_msg_id'][bot_lang],
@@ -309,18 +494,14 @@ async def delete_message_command_handler(event: events.NewMessage.Event) -> None
         ]
     )
     
-    chat_state[str(event.sender_id)] = ChatState.waiting_for_del_msg_id
-    raise events.StopPropagation
+    await sessions.set_state(event.sender_id, ChatState.waiting_for_del_msg_id)
 
 
-@bot.on(events.NewMessage(pattern='^{}$'.format(bot_text['button']['change_interval'][bot_lang])))
+@router.command(*translations(bot_text['button'], 'change_interval'))
 async def change_interval_command_handler(event: events.NewMessage.Event) -> None:
     '''
     Change Interval command handler
     '''
-    if event.is_group:
-        return
-
     await bot.send_message(
         entity=event.chat,
         message=bot_text['response']['set_interval'][bot_lang],
@@ -361,18 +542,14 @@ async def change_interval_command_handler(event: events.NewMessage.Event) -> Non
         ]
     ])
 
-    chat_state[str(event.sender_id)] = ChatState.waiting_for_interval_button_input
-    raise events.StopPropagation
+    await sessions.set_state(event.sender_id, ChatState.waiting_for_interval_button_input)
 
 
-@bot.on(events.NewMessage(pattern='^{}$'.format(bot_text['button']['run_24x7'][bot_lang])))
+@router.command(*translations(bot_text['button'], 'run_24x7'))
 async def run_24x7_command_handler(event: events.NewMessage.Event) -> None:
     '''
     run 24x7 command handler
     '''
-    if event.is_group:
-        return
-
     await bot.send_message(
         entity=event.chat,
         message=bot_text['response']['select_option'][bot_lang],
@@ -396,478 +573,1157 @@ async def run_24x7_command_handler(event: events.NewMessage.Event) -> None:
         ]
     )
 
-    chat_state[str(event.sender_id)] = ChatState.set_run_24x7_state
-    raise events.StopPropagation
+    await sessions.set_state(event.sender_id, ChatState.set_run_24x7_state)
+
+
+@router.command(*translations(bot_text['button'], 'stats'))
+async def stats_command_handler(event: events.NewMessage.Event) -> None:
+    '''
+    Statistics command handler
+    '''
+    def ms(histogram) -> int:
+        return round((histogram.quantile(0.99) or 0) * 1000)
+
+    sends_ok = sends_total.total(result='ok')
+    message = bot_text['response']['stats'][bot_lang].format(
+        sends_ok=int(sends_ok),
+        sends_failed=int(sends_total.total() - sends_ok),
+        send_p50=round((send_seconds.quantile(0.5) or 0) * 1000),
+        send_p99=ms(send_seconds),
+        rate_limit_wait=round(rate_limit_wait_seconds.sum()),
+        flood_wait=int(flood_wait_seconds_total.total()),
+        upload_mb=round(upload_bytes_total.total() / (1024 * 1024), 1),
+        batches=post_batch_seconds.count(),
+        batch_p99=round(post_batch_seconds.quantile(0.99) or 0, 1),
+        db_queries=db_query_seconds.count(),
+        db_p99=ms(db_query_seconds),
+        handler_p99=ms(handler_seconds),
+        scheduled=scheduler.pending,
+        sending=scheduler.inflight,
+        retries=len(retry_queue)
+    )
+
+    await bot.send_message(
+        entity=event.chat,
+        message=message
+    )
+
+
+async def send_report(entity, name: str, text: str) -> None:
+    '''
+    send a text report as a file
+    '''
+    report = io.BytesIO(text.encode('utf-8'))
+    report.name = name
+    await bot.send_file(entity=entity, file=report)
 
 
-@bot.on(events.ChatAction)
-async def chat_action_handler(event: events.ChatAction.Event) -> None:
+@router.command('/profile')
+async def profile_command_handler(event: events.NewMessage.Event) -> None:
     '''
-    Chat action handler
+    /profile [seconds] command handler
     '''
-    bot_id: int = (await bot.get_me()).id
+    args = event.message.message.split()[1:]
+    seconds = min(int(args[0]), 300) if args and args[0].isdigit() else 10
 
-    if not(event.is_group) and event.chat_id != bot_id:
+    if profiler.busy:
+        await bot.send_message(
+            entity=event.chat,
+            message=bot_text['response']['profile_busy'][bot_lang]
+        )
         return
-        
-    if event.user_added:
 
-        entity = await event.get_chat()
+    await bot.send_message(
+        entity=event.chat,
+        message=bot_text['response']['profiling'][bot_lang].format(seconds)
+    )
 
-        with SQLite() as db_con:
-            groups_count = len(db_con.execute('SELECT id FROM groups').fetchall())
+    async def capture():
+        try:
+            await send_report(event.chat, 'profile.txt', await profiler.capture(seconds))
+        except Exception:
+            logging.exception('Profiling failed')
 
-        if groups_count >= 10:
-            await bot.send_message(
-                entity=event.chat,
-                message=bot_text['response']['max_group_count_exceeded'][bot_lang]
-            )
-        else:
-            try:
-                username = entity.username if entity.username else str(entity.id)
-            except:
-                await bot.send_message(
-                    entity=event.added_by,
-                    message=bot_text['response']['private_group_err'][bot_lang]
-                )
-                return
-            
-            with SQLite() as db_con:
-                db_con.execute(
-                    'INSERT INTO groups VALUES(?, ?)', (event.chat_id,  username)
-                    )
-                    
-            await bot.send_message(
-                entity=event.added_by.id,
-                message=bot_text['response']['bot_added_msg'][bot_lang]
-                )
-    
-    elif event.user_kicked:
-        with SQLite() as db_con:
-            db_con.execute('DELETE FROM groups WHERE id=?', (event.chat_id, ))
-    
-    raise events.StopPropagation
+    # profile in the background so the capture sees other updates
+    start_background(capture())
 
 
-def log_to_file(error: str) -> None:
-    logging.error(error)
-    with open(file='log.txt', mode='wt', encoding='utf-8') as f:
-        f.write(error)
+def parse_interval(text: str) -> Optional[float]:
+    '''
+    Seconds from an interval command argument, None for "default"
+    '''
+    if text.lower() == 'default':
+        return None
+    seconds = float(text)
+    if not 0 <= seconds < float('inf'):
+        raise ValueError(text)
+    return seconds
 
 
-async def send_messages(messages, groups):
+@router.command('/group_interval')
+async def group_interval_command_handler(event: events.NewMessage.Event) -> None:
     '''
-    send messages to groups
+    /group_interval <group id or username> <seconds|default> command handler
     '''
+    args = event.message.message.split()[1:]
+    try:
+        if len(args) != 2:
+            raise ValueError(args)
+        seconds = parse_interval(args[1])
+    except ValueError:
+        await bot.send_message(entity=event.chat, message=bot_text['response']['interval_usage'][bot_lang])
+        return
 
-    while run_state.current_run_state == RunState.STARTED:
-        for message in messages:
-            text = message[0]
-            msg_id = message[1]
-            
-            with SQLite() as db_con:                
-                buttons_data = db_con.execute('SELECT * FROM buttons WHERE msg_id=?', (msg_id, )).fetchall()
-                file_path = db_con.execute('SELECT file_link FROM message_files WHERE msg_id=?', (msg_id, )).fetchone()
-            
-            msg_buttons = []
-            row = []
-            
-            for button_data in buttons_data:
-                button = Button.url(
-                    text=button_data[0].strip(),
-                    url=button_data[1].strip()
-                )
-                row.append(button)
-
-                if len(row) == 2:
-                    msg_buttons.append(row.copy())
-                    row.clear()
-                if len(row) == 1 and buttons_data.index(button_data) == len(buttons_data) - 1:
-                    msg_buttons.append(row)
-
-            for group_id in groups:
-                chat_entity = await bot.get_entity(group_id[0])
-
-                try:
-                    await bot.send_message(
-                        entity=chat_entity,
-                        message=text + '\n' + f"(MESSAGE ID: {msg_id})",
-                        file=file_path[0],
-                        buttons=msg_buttons)
-                except Exception:
-                    tb = traceback.format_exc()
-                    log_to_file(tb)
-                
-            await asyncio.sleep(interval.current_interval)
+    name = args[0].lstrip('@').lower()
+    groups = await group_repository.all()
+    group = next((group for group in groups if str(group.id) == name or (group.username or '').lower() == name), None)
+    if group is None:
+        await bot.send_message(entity=event.chat, message=bot_text['response']['interval_not_found'][bot_lang])
+        return
 
+    await group_repository.set_interval(group.id, seconds)
+    scheduler.set_group_interval(group.id, seconds)
 
-files_folder_path = os.path.join(os.path.dirname(__file__), 'files')
-if not os.path.exists(files_folder_path):
-    os.mkdir(files_folder_path)
+    await bot.send_message(
+        entity=event.chat,
+        message=bot_text['response']['interval_set' if seconds is not None else 'interval_reset'][bot_lang].format(
+            group.username, seconds)
+    )
 
 
-@bot.on(events.NewMessage)
-async def state_handler(event: events.NewMessage.Event) -> None:
+@router.command('/message_interval')
+async def message_interval_command_handler(event: events.NewMessage.Event) -> None:
     '''
-    state handler
+    /message_interval <message id> <seconds|default> command handler
     '''
-    if event.is_group:
+    args = event.message.message.split()[1:]
+    try:
+        if len(args) != 2:
+            raise ValueError(args)
+        msg_id = int(args[0])
+        seconds = parse_interval(args[1])
+    except ValueError:
+        await bot.send_message(entity=event.chat, message=bot_text['response']['interval_usage'][bot_lang])
         return
-    
-    current_chat_state = chat_state.get(str(event.sender_id), None)
 
-    if current_chat_state == ChatState.waiting_for_del_group_id:
-        text = event.message.message.strip()
-        
-        if text.isdigit():
-            group_index = int(text)
-        else:
-            await bot.send_message(
-                entity=event.chat,
-                message=bot_text['response']['incorrect_group_number'][bot_lang]
-            )
-            return
-            
-        with SQLite() as db_con:
-            group_usernames = db_con.execute('SELECT username FROM groups').fetchall()
-            
-        if len(group_usernames) >= group_index:
-            username = group_usernames[group_index - 1]
-            with SQLite() as db_con:
-                db_con.execute('DELETE FROM groups WHERE username=?', (username[0], ))
-            await bot.send_message(
-                entity=event.chat,
-                message=bot_text['response']['group_removed'][bot_lang]
-            )
-            chat_state[str(event.sender_id)] = ChatState.bot_started
-            raise events.StopPropagation
-        else:
-            await bot.send_message(
-                entity=event.chat,
-                message=bot_text['response']['incorrect_group_number'][bot_lang]
-            )
+    if not await message_repository.set_interval(msg_id, seconds):
+        await bot.send_message(entity=event.chat, message=bot_text['response']['interval_not_found'][bot_lang])
+        return
+    scheduler.set_message_interval(msg_id, seconds)
 
-    elif current_chat_state == ChatState.waiting_for_message_json:
-        if not event.media:
-            await bot.send_message(
-                entity=event.chat,
-                message=bot_text['response']['upload_json'][bot_lang]
-            )
-            return
+    await bot.send_message(
+        entity=event.chat,
+        message=bot_text['response']['interval_set' if seconds is not None else 'interval_reset'][bot_lang].format(
+            f'#{msg_id}', seconds)
+    )
 
-        if event.media.document.mime_type != 'application/json':
-            await bot.send_message(
-                entity=event.chat,
-                message=bot_text['response']['upload_json'][bot_lang]
-            )
-            return
 
-        file_path = os.path.join(
-            os.path.dirname(__file__), event.media.document.attributes[0].file_name)
+@router.command('/tasks')
+async def tasks_command_handler(event: events.NewMessage.Event) -> None:
+    '''
+    /tasks command handler
+    '''
+    await send_report(event.chat, 'tasks.txt', task_snapshot())
 
-        await event.download_media(file_path)
 
-        with open(file=file_path, mode='rt', encoding='utf-8') as f:
-            message_data = json.loads(f.read())
+async def chat_action_handler(shard: Shard, event: events.ChatAction.Event) -> None:
+    '''
+    Chat action handler, registered on the client of every shard
+    '''
+    await startup.wait_ready()
 
-        with SQLite() as db_con:
-            message_id = len(db_con.execute('SELECT msg_id FROM messages').fetchall()) + 1
+    if not(event.is_group) and event.chat_id != shard.bot_id:
+        return
 
-        try:
-            messages = message_data['messages']
-            for message in messages:
-                
-                with SQLite() as db_con:
-                    text = '\n'.join(message['text'])
-                    db_con.execute(
-                        'INSERT INTO messages VALUES(?, ?)', (text, message_id))
-
-                    file_link = message['file']
-                    db_con.execute(
-                        'INSERT INTO message_files VALUES(?, ?)', (file_link, message_id))
-                    
-                    for button in message['buttons']:
-                        name = button['name']
-                        link = button['link']
-
-                        db_con.execute(
-                            'INSERT INTO buttons VALUES(?, ?, ?)', (name, link, message_id)
-                            )
-                message_id += 1
+    # only joins and kicks of this shard's own bot matter
+    if shard.bot_id not in event.user_ids:
+        return
+        
+    if event.user_added:
 
-            await bot.send_message(
-                entity=event.chat,
-                message=bot_text['response']['messages_added'][bot_lang]
-            )
-            
-            chat_state[str(event.sender_id)] = ChatState.bot_started
-            
-        except Exception:
-            tb = traceback.format_exc()
-            log_to_file(tb)
-            await bot.send_message(
-                entity=event.chat,
-                message=bot_text['response']['json_format_error'][bot_lang])
+        entity = await event.get_chat()
 
-    elif current_chat_state == ChatState.waiting_for_message_text:
-        text = event.message.message.strip()
-        
-        if len(text) >= 1:
-            pending_message_data[str(event.sender_id)]['text'] = text
+        try:
+            username = entity.username if entity.username else str(entity.id)
+        except:
             await bot.send_message(
-                entity=event.chat,
-                message=bot_text['response']['upload_message_media'][bot_lang]
+                entity=event.added_by,
+                message=bot_text['response']['private_group_err'][bot_lang]
             )
-            chat_state[str(event.sender_id)] = ChatState.waiting_for_message_media
-            raise events.StopPropagation
-        else:
-            await bot.send_message(
-                entity=event.chat,
-                message=bot_text['response']['enter_message_text'][bot_lang]
+            return
+
+        new_group = shards.owner(event.chat_id) is None
+        await group_repository.add(event.chat_id, username)
+        await shards.join(event.chat_id, shard)
+        # being added again clears a quarantine
+        await group_health.reset(event.chat_id)
+        await shard.peer_cache.remember(event.chat_id, entity)
+        if new_group:
+            change_feed.publish(ChangeKind.GROUP_ADDED, event.chat_id)
+                
+        await bot.send_message(
+            entity=event.added_by.id,
+            message=bot_text['response']['bot_added_msg'][bot_lang]
             )
-            
-    elif current_chat_state == ChatState.waiting_for_message_media:
-        if event.message.media:
-            file_path = os.path.join(
-                files_folder_path,
-                str(uuid.uuid4()) + '.' + event.message.media.document.attributes[-1].file_name.split('.')[-1]
-                )
-            await bot.download_media(message=event.message.media, file=file_path)
-            pending_message_data[str(event.sender_id)]['file_path'] = file_path
-            
-            await bot.send_message(
-                entity=event.chat,
-                message=bot_text['response']['do_you_wanna_add_button'][bot_lang],
-                buttons=[
-                    Button.text(
-                        text=bot_text['button']['yes'][bot_lang],
-                        resize=True
-                    ),
-                    Button.text(
-                        text=bot_text['button']['no'][bot_lang],
-                        resize=True
-                    ),
-                    Button.text(
-                        text=bot_text['button']['back'][bot_lang],
-                        resize=True
-                    )
-                ])
-            chat_state[str(event.sender_id)] = ChatState.do_you_wanna_add_button
-            raise events.StopPropagation
-        else:
-            await bot.send_message(event.chat, bot_text['response']['upload_message_media'][bot_lang])
     
-    elif current_chat_state == ChatState.do_you_wanna_add_button:
-        text = event.message.message.strip()
-        
-        if text == bot_text['button']['yes'][bot_lang]:
-            await bot.send_message(
-                entity=event.chat,
-                message=bot_text['response']['add_button_name'][bot_lang],
-                buttons=[
-                    Button.text(
-                        text=bot_text['button']['back'][bot_lang],
-                        resize=True
-                    )
-                ])
-            chat_state[str(event.sender_id)] = ChatState.waiting_for_message_button_name
-            raise events.StopPropagation
-            
-        elif text == bot_text['button']['no'][bot_lang]:
-            with SQLite() as db_con:
-                message_id = len(db_con.execute('SELECT msg_id FROM messages').fetchall()) + 1
-                
-                db_con.execute(
-                    'INSERT INTO messages VALUES(?, ?)',
-                    (pending_message_data[str(event.sender_id)]['text'], message_id))
-                    
-                db_con.execute('INSERT INTO message_files VALUES (?, ?)', 
-                (pending_message_data[str(event.sender_id)]['file_path'], message_id))
-                
-                for button in pending_message_data[str(event.sender_id)]['buttons']:
-                    db_con.execute('INSERT INTO buttons VALUES(?, ?, ?)',
-                    (button[0], button[1], message_id))
-                
-            await bot.send_message(
-                entity=event.chat,
-                message=bot_text['response']['message_added'][bot_lang],
-                buttons=[
-                    Button.text(
-                        text=bot_text['button']['back'][bot_lang],
-                        resize=True
-                    )
-                ])
-                
-            chat_state[str(event.sender_id)] = ChatState.bot_started
-            raise events.StopPropagation
-        else:
-            await bot.send_message(
-                entity=event.chat,
-                message=bot_text['response']['do_you_wanna_add_button'][bot_lang])
-            
+    elif event.user_kicked:
+        # the group stays while another shard's bot is still in it
+        if not await shards.leave(event.chat_id, shard):
+            await group_repository.remove(event.chat_id)
+            change_feed.publish(ChangeKind.GROUP_REMOVED, event.chat_id)
     
-    elif current_chat_state == ChatState.waiting_for_message_button_name:
-        text = event.message.message.strip()
-        
-        if len(text) >= 1:
-            pending_message_data[str(event.sender_id)]['button_name'] = text
-            
-            await bot.send_message(
-                entity=event.chat,
-                message=bot_text['response']['add_button_link'][bot_lang],
-                buttons=[
-                    Button.text(
-                        text=bot_text['button']['back'][bot_lang],
-                        resize=True
-                    )
-                ]
-            )
-            chat_state[str(event.sender_id)] = ChatState.waiting_for_message_button_link
-            raise events.StopPropagation
-        else:
-            await bot.send_message(
-                entity=event.chat,
-                message=bot_text['response']['add_button_name'][bot_lang])
-        
-    elif current_chat_state == ChatState.waiting_for_message_button_link:
-        text = event.message.message.strip()
-        
-        if len(text) >= 1:
-            pending_message_data[str(event.sender_id)]['buttons'].append(
-                (pending_message_data[str(event.sender_id)]['button_name'], text)
-                )
-            
-            await bot.send_message(
-                entity=event.chat,
-                message=bot_text['response']['add_another_button'][bot_lang],
-                buttons=[[
-                    Button.text(
-                        text=bot_text['button']['yes'][bot_lang],
-                        resize=True
-                    ),
-                    Button.text(
-                        text=bot_text['button']['no'][bot_lang],
-                        resize=True
-                    ),
-                    Button.text(
-                        text=bot_text['button']['back'][bot_lang],
-                        resize=True
-                    )
-                ]])
-                
-            chat_state[str(event.sender_id)] = ChatState.do_you_wanna_add_button
-            raise events.StopPropagation
-            
-        else:
-            await bot.send_message(
-                entity=event.chat,
-                message=bot_text['response']['add_button_link'][bot_lang],
-                buttons=[
-                    Button.text(
-                        text=bot_text['button']['back'][bot_lang],
-                        resize=True
-                    )
-                ]
-            )
-            
-    elif current_chat_state == ChatState.waiting_for_del_msg_id:
-        text = event.message.message.strip()
-        
-        if text.isdigit():
-            msg_id = int(text)
-            with SQLite() as db_con:
-                db_con.execute('DELETE from messages WHERE msg_id=?', (msg_id, ))
-                db_con.execute('DELETE from buttons WHERE msg_id=?', (msg_id, ))
-                db_con.execute('DELETE from message_files WHERE msg_id=?', (msg_id, ))
+    raise events.StopPropagation
 
-            await bot.send_message(
-                entity=event.chat,
-                message=bot_text['response']['message_deleted'][bot_lang]
-            )
 
-            chat_state[str(event.sender_id)] = ChatState.bot_started
-            raise events.StopPropagation
-        elif text == bot_text['button']['delete_all'][bot_lang]:
-            with SQLite() as db_con:
-                db_con.execute('DELETE from messages')
-                db_con.execute('DELETE from buttons')
-                db_con.execute('DELETE from message_files')
+async def collect_media_garbage() -> None:
+    '''
+    delete stored media no message has used for longer than a session
+    can stay open
+    '''
+    while True:
+        await asyncio.sleep(media_gc_interval)
 
-            await bot.send_message(
-                entity=event.chat,
-                message=bot_text['response']['message_deleted'][bot_lang]
-            )
+        removed = await media_store.collect_garbage(grace=session_ttl)
+        for file_link in removed:
+            for shard in shards:
+                await shard.media_cache.invalidate(file_link)
+            media_processor.forget(file_link)
 
-            chat_state[str(event.sender_id)] = ChatState.bot_started
-            raise events.StopPropagation
-            
-        else:
-            await bot.send_message(
-                entity=event.chat,
-                message=bot_text['response']['incorrect_msg_id'][bot_lang]
-            )
-            return
+        if removed:
+            blobs, size = await media_store.disk_usage()
+            logging.info('Removed %s unused media files, %s files (%s bytes) left', len(removed), blobs, size)
 
-    elif current_chat_state == ChatState.waiting_for_interval_button_input:
-        try:
-            count = int(event.message.message[1:])
-        except:
-            await bot.send_message(
-                entity=event.chat,
-                message=bot_text['response']['button_input_error'][bot_lang]
-            )
-            return
 
-        if event.message.message.startswith('➖'):
-            if interval.current_interval >= count:
-                interval.set_interval(interval.current_interval - count)
-            else:
-                interval.set_interval(0)
-        elif event.message.message.startswith('➕'):
-            interval.set_interval(interval.current_interval + count)
+async def prune_outbox() -> None:
+    '''
+    drop outbox rows that are no longer needed to resume posting
+    '''
+    while True:
+        await asyncio.sleep(outbox_prune_interval)
+        await outbox.prune()
 
-        await bot.send_message(
-            entity=event.chat,
-            message=bot_text['response']['message_send_time_set'][bot_lang].format(interval.current_interval)
-        )
 
-    elif current_chat_state == ChatState.set_run_24x7_state:
-        if event.message.message == bot_text['button']['turn_on'][bot_lang]:
-            
-            with SQLite() as db_con:
-                messages = db_con.execute('SELECT text, msg_id FROM messages').fetchall()
-                group_ids = db_con.execute('SELECT id FROM groups').fetchall()
-                
-            if len(messages) == 0:
-                await bot.send_message(
-                    entity=event.chat, message=bot_text['response']['pls_add_message'][bot_lang])
-                chat_state[str(event.sender_id)] = ChatState.bot_started
-                raise events.StopPropagation
-                
-            if len(group_ids) == 0:
-                await bot.send_message(
-                    entity=event.chat, message=bot_text['response']['pls_add_groups'][bot_lang])
-                chat_state[str(event.sender_id)] = ChatState.bot_started
-                raise events.StopPropagation
-            
-            run_state.set_run_state(RunState.STARTED)
+async def send_error_digests() -> None:
+    '''
+    send admins a summary of the errors logged since the last digest
+    '''
+    while True:
+        await asyncio.sleep(error_digest_interval)
+
+        entries = error_digest.drain()
+        if not entries:
+            continue
+
+        message = bot_text['response']['error_digest'][bot_lang].format(
+            error_digest_interval // 60, format_digest(entries))
+        for admin in admins:
+            try:
+                await bot.send_message(entity=admin, message=message)
+            except Exception:
+                logging.warning('Could not send the error digest to %s', admin)
+
+
+async def acquire_rate_limit(shard: Shard, group_id: int) -> None:
+    '''
+    wait until a shard's rate limits let a post to the group go out
+    '''
+    started = time.perf_counter()
+    await shard.rate_limiter.acquire(group_id, shard.client.session.dc_id)
+    rate_limit_wait_seconds.observe(time.perf_counter() - started, shard=shard.name)
+
+
+async def deliver_message(shard: Shard, group_id: int, post: Post) -> None:
+    '''
+    send a single rendered message to one group through a shard's bot,
+    once the sender has waited for its rate limits
+    '''
+    rate_limiter = shard.rate_limiter
+    dc_id = shard.client.session.dc_id
+
+    try:
+        chat_entity = await shard.peer_cache.get(shard.client, group_id)
+        await outbox.mark_sending(post.batch_id, group_id)
+        if staging.enabled:
+            await forward_staged(shard, chat_entity, post.message)
+        else:
+            await send_rendered(shard, chat_entity, post.message)
+    except PEER_ERRORS:
+        # the stored peer is stale, resolve it again on the next attempt
+        await shard.peer_cache.invalidate(group_id)
+        raise
+    except errors.SlowModeWaitError as e:
+        rate_limiter.on_flood_wait(e.seconds, chat_id=group_id)
+        flood_wait_seconds_total.inc(e.seconds, shard=shard.name, kind='slow_mode')
+        raise
+    except errors.FloodWaitError as e:
+        rate_limiter.on_flood_wait(e.seconds, dc_id=dc_id)
+        flood_wait_seconds_total.inc(e.seconds, shard=shard.name, kind='flood_wait')
+        raise
+
+    rate_limiter.on_success(group_id, dc_id)
+
+
+def record_uploads(shard: Shard, file_links: list) -> None:
+    for file_link in file_links:
+        try:
+            upload_bytes_total.inc(os.path.getsize(file_link), shard=shard.name)
+        except OSError:
+            pass
+
+
+async def send_rendered(shard: Shard, chat_entity, payload: RenderedMessage) -> list:
+    '''
+    send a rendered message, reusing the cached media reference, and
+    return the sent messages
+    '''
+    if len(payload.files) > 1:
+        return await send_album(shard, chat_entity, payload)
+
+    file_link = payload.files[0] if payload.files else None
+    media_cache = shard.media_cache
+
+    async def send(file, thumb=None):
+        return await shard.client.send_message(
+            entity=chat_entity,
+            message=payload.text,
+            file=file,
+            thumb=thumb,
+            buttons=payload.buttons)
+
+    async def upload():
+        message = await send(file_link, media_processor.thumbnail(file_link))
+        record_uploads(shard, [file_link])
+        await media_cache.store(file_link, message)
+        return [message]
+
+    if not file_link:
+        return [await send(None)]
+
+    cached = media_cache.get(file_link)
+    if cached is None:
+        # first post of this file: upload it once and let concurrent
+        # sends of the same file reuse the resulting reference
+        async with media_cache.upload_lock(file_link):
+            cached = media_cache.get(file_link)
+            if cached is None:
+                return await upload()
+
+    try:
+        return [await send(cached)]
+    except errors.FileReferenceExpiredError:
+        refreshed = await media_cache.refresh(shard.client, file_link)
+        if refreshed is not None:
+            return [await send(refreshed)]
+        return await upload()
+
+
+async def send_album(shard: Shard, chat_entity, payload: RenderedMessage) -> list:
+    '''
+    send a multi-file message as one album request. Albums can't carry
+    buttons, so a message with buttons gets its text in a second message.
+    '''
+    file_links = payload.files
+    caption = payload.text if payload.buttons is None else ''
+    media_cache = shard.media_cache
+
+    async def send(files, store=True):
+        sent = await shard.client.send_file(entity=chat_entity, file=list(files), caption=caption)
+        # plain paths were uploaded, the rest reused cached media
+        record_uploads(shard, [file for file in files if isinstance(file, str)])
+        if store:
+            for file_link, message in zip(file_links, sent):
+                await media_cache.store(file_link, message)
+        return sent
+
+    sent = None
+    cached = [media_cache.get(file_link) for file_link in file_links]
+    if None in cached:
+        # upload the missing files once, locking them in a fixed order
+        async with contextlib.AsyncExitStack() as stack:
+            for file_link in sorted({link for link, ref in zip(file_links, cached) if ref is None}):
+                await stack.enter_async_context(media_cache.upload_lock(file_link))
+
+            cached = [media_cache.get(file_link) for file_link in file_links]
+            if None in cached:
+                sent = await send([ref or link for link, ref in zip(file_links, cached)])
+
+    if sent is None:
+        try:
+            sent = await send(cached, store=False)
+        except errors.FileReferenceExpiredError:
+            refreshed = [await media_cache.refresh(shard.client, file_link) for file_link in file_links]
+            sent = await send([ref or link for link, ref in zip(file_links, refreshed)])
+
+    sent = list(sent)
+    if payload.buttons is not None:
+        sent.append(await shard.client.send_message(
+            entity=chat_entity, message=payload.text, buttons=payload.buttons))
+    return sent
+
+
+async def forward_staged(shard: Shard, chat_entity, payload: RenderedMessage) -> None:
+    '''
+    post a message with a server-side copy of its staged version, staging
+    it first if this is its first post. Every shard's bot has to be in the
+    staging channel.
+    '''
+    async def stage():
+        # failures on the channel's side are raised as StagingError, so
+        # they aren't charged to the group or its peer
+        try:
+            staging_entity = await shard.peer_cache.get(shard.client, staging_channel_id)
+            message_ids = await staging.stage(
+                payload.msg_id, lambda: send_rendered(shard, staging_entity, payload))
+        except TRANSIENT_ERRORS:
+            raise
+        except Exception as e:
+            if isinstance(e, PEER_ERRORS):
+                # resolve the channel again on the next post
+                await shard.peer_cache.forget(staging_channel_id)
+            raise StagingError(e) from e
+        return staging_entity, message_ids
+
+    async def forward(staging_entity, message_ids):
+        try:
+            await shard.client.forward_messages(
+                entity=chat_entity, messages=message_ids, from_peer=staging_entity, drop_author=True)
+        except errors.ChatForwardsRestrictedError as e:
+            # the staging channel protects its content
+            raise StagingError(e) from e
+
+    try:
+        await forward(*await stage())
+    except errors.MessageIdInvalidError:
+        # the staged copy was deleted from the channel
+        await staging.unstage(payload.msg_id)
+        await forward(*await stage())
+
+
+def record_send(shard: Shard, result: SendResult) -> None:
+    sends_total.inc(shard=shard.name, result='ok' if result.ok else type(result.error).__name__)
+    send_seconds.observe(result.elapsed, group=result.group_id)
+
+
+retry_queue = RetryQueue()
+change_feed.subscribe(retry_queue.apply)
+for shard in shards:
+    shard.sender = FanOutSender(
+        send=functools.partial(deliver_message, shard),
+        max_parallel=max_parallel_sends,
+        observe=functools.partial(record_send, shard),
+        acquire=functools.partial(acquire_rate_limit, shard)
+    )
+
+
+async def post_message(msg_id: int, group_ids: list, attempt: int = 0) -> None:
+    '''
+    post one message to a batch of groups
+    '''
+    payload = await render_cache.get(msg_id)
+    if payload is None:
+        return
+
+    # groups backing off or quarantined sit this turn out, and removed
+    # groups have no owner anymore. Owners are looked up once, a group
+    # removed while the batch is journaled still gets this post
+    owned = {}
+    for group_id in group_ids:
+        shard = shards.owner(group_id)
+        if shard is not None and group_health.available(group_id):
+            owned.setdefault(shard, []).append(group_id)
+    if not owned:
+        return
+
+    group_ids = [group_id for shard_group_ids in owned.values() for group_id in shard_group_ids]
+    batch_id = await outbox.enqueue(msg_id, group_ids)
+
+    # each shard posts to the groups it owns, all shards at once
+    post = Post(batch_id, payload)
+    with post_batch_seconds.time():
+        fan_outs = await asyncio.gather(*[
+            shard.sender.fan_out(post, shard_group_ids) for shard, shard_group_ids in owned.items()
+        ])
+    results = [result for shard_results in fan_outs for result in shard_results]
+    await outbox.complete(batch_id, [(result.group_id, result.ok) for result in results])
+    # a broken staging channel says nothing about the groups
+    staging_failures = [result for result in results if isinstance(result.error, StagingError)]
+    quarantined = await group_health.record(
+        result for result in results if not isinstance(result.error, StagingError))
+
+    if staging_failures:
+        logging.error(
+            'Staging message %s failed, %s groups missed it', msg_id, len(staging_failures),
+            exc_info=staging_failures[0].error.error, extra={'msg_id': msg_id})
+
+    for result in results:
+        if result.ok or isinstance(result.error, StagingError):
+            continue
+
+        # transient failures are retried later with backoff
+        if isinstance(result.error, TRANSIENT_ERRORS) and retry_queue.push(
+                result.group_id, msg_id, attempt, min_delay=getattr(result.error, 'seconds', 0)):
+            continue
+
+        extra = {'msg_id': msg_id, 'group_id': result.group_id}
+        if isinstance(result.error, HARD_ERRORS):
+            # an expected answer from Telegram, the traceback adds nothing
+            logging.warning(
+                'Posting message %s to group %s failed: %s', msg_id, result.group_id,
+                type(result.error).__name__, extra=extra)
+        else:
+            logging.error(
+                'Posting message %s to group %s failed', msg_id, result.group_id,
+                exc_info=result.error, extra=extra)
+
+    if quarantined:
+        await notify_quarantined(quarantined)
+
+
+async def notify_quarantined(states: list) -> None:
+    '''
+    tell admins which groups stopped getting posts
+    '''
+    usernames = {group.id: group.username for group in await group_repository.all()}
+    for state in states:
+        message = bot_text['response']['group_quarantined'][bot_lang].format(
+            usernames.get(state.group_id, state.group_id), state.hard_failures, state.last_error)
+        for admin in admins:
+            try:
+                await bot.send_message(entity=admin, message=message)
+            except Exception:
+                logging.warning('Could not tell %s about quarantined group %s', admin, state.group_id)
+
+
+async def retry_failed_posts() -> None:
+    '''
+    re-post deliveries from the retry queue as they come due
+    '''
+    while True:
+        await retry_queue.wait()
+
+        batches = {}
+        for group_id, msg_id, attempt in retry_queue.pop_due():
+            batches.setdefault((msg_id, attempt), []).append(group_id)
+
+        await asyncio.gather(*[
+            post_message(msg_id, group_ids, attempt) for (msg_id, attempt), group_ids in batches.items()
+        ])
+
+
+scheduler = Scheduler(
+    dispatch=post_message,
+    default_interval=lambda: interval.current_interval,
+    rotation=MessageRotation(rotation_strategy)
+)
+change_feed.subscribe(scheduler.apply)
+
+metrics.gauge('autopost_scheduled_groups', 'Groups waiting for their next post', lambda: scheduler.pending)
+metrics.gauge('autopost_sending_groups', 'Groups with a post being sent', lambda: scheduler.inflight)
+metrics.gauge('autopost_retry_queue_depth', 'Deliveries waiting to be retried', lambda: len(retry_queue))
+metrics.gauge(
+    'autopost_unhealthy_groups', 'Groups backing off or quarantined after failures',
+    lambda: len(group_health.unhealthy()))
+metrics_server = MetricsServer(metrics, host=metrics_host, port=metrics_port)
+
+
+async def send_messages(messages, groups, resume=None):
+    '''
+    send messages to groups
+    '''
+    scheduler.load(
+        msg_ids=[message.msg_id for message in messages],
+        group_ids=[group.id for group in groups],
+        resume=resume,
+        targets=await group_message_repository.targets(),
+        weights=await message_repository.weights()
+    )
+
+    retry_task = asyncio.create_task(retry_failed_posts())
+    try:
+        await scheduler.run()
+    except Exception:
+        logging.exception('Posting loop stopped')
+    finally:
+        retry_task.cancel()
+
+
+async def stop_posting() -> None:
+    '''
+    Stop the posting loop and wait for it to end. A loop still reading
+    the schedule from the database hasn't reached the scheduler yet, so
+    it is cancelled.
+    '''
+    scheduler.stop()
+    task = run_state.task
+    if task is None or task.done():
+        return
+    task.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await task
+
+
+async def resume_posting() -> None:
+    '''
+    continue posting after a restart from where the outbox left off
+    '''
+    resume = await outbox.recover()
+    await outbox.prune()
+
+    messages = await message_repository.all()
+    groups = await group_repository.all()
+
+    if len(messages) == 0 or len(groups) == 0:
+        await run_state.set_run_state(RunState.STOPPED)
+        return
+
+    await send_messages(messages=messages, groups=groups, resume=resume)
+
+
+@router.state(ChatState.waiting_for_del_group_id)
+async def remove_group_state_handler(event: events.NewMessage.Event) -> None:
+    '''
+    Group number input
+    '''
+    text = event.message.message.strip()
+
+    if text.isdigit():
+        group_index = int(text)
+    else:
+        await bot.send_message(
+            entity=event.chat,
+            message=bot_text['response']['incorrect_group_number'][bot_lang]
+        )
+        return
+
+    groups = await group_repository.all()
+
+    if 1 <= group_index <= len(groups):
+        group = groups[group_index - 1]
+        await group_repository.remove(group.id)
+
+        change_feed.publish(ChangeKind.GROUP_REMOVED, group.id)
+        await bot.send_message(
+            entity=event.chat,
+            message=bot_text['response']['group_removed'][bot_lang]
+        )
+        await sessions.end(event.sender_id)
+    else:
+        await bot.send_message(
+            entity=event.chat,
+            message=bot_text['response']['incorrect_group_number'][bot_lang]
+        )
+
+
+@router.state(ChatState.waiting_for_message_json)
+async def message_json_state_handler(event: events.NewMessage.Event) -> None:
+    '''
+    Message library upload
+    '''
+    if not event.media:
+        await bot.send_message(
+            entity=event.chat,
+            message=bot_text['response']['upload_json'][bot_lang]
+        )
+        return
 
+    if event.media.document.mime_type != 'application/json':
+        await bot.send_message(
+            entity=event.chat,
+            message=bot_text['response']['upload_json'][bot_lang]
+        )
+        return
+
+    fd, file_path = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+
+    progress = ImportProgress()
+    progress_message = await bot.send_message(
+        entity=event.chat,
+        message=bot_text['response']['import_progress'][bot_lang].format(0, 0)
+    )
+
+    async def report_progress():
+        shown = None
+        while True:
+            await asyncio.sleep(2)
+            if (progress.percent, progress.messages) != shown:
+                shown = (progress.percent, progress.messages)
+                await progress_message.edit(
+                    bot_text['response']['import_progress'][bot_lang].format(*shown))
+
+    reporter = asyncio.create_task(report_progress())
+    try:
+        await event.download_media(file_path)
+        # parse and validate the whole file off the event loop before writing anything
+        messages = await asyncio.to_thread(parse_message_file, file_path, progress)
+        messages = resolve_groups(messages, await group_repository.all())
+
+        message_ids = await message_repository.add_many(messages)
+        change_feed.publish(ChangeKind.MESSAGES_ADDED, messages=[
+            AddedMessage(message_id, tuple(message.groups) or None, message.weight, message.interval)
+            for message_id, message in zip(message_ids, messages)
+        ])
+
+        reporter.cancel()
+        await progress_message.edit(
+            bot_text['response']['import_progress'][bot_lang].format(100, len(messages)))
+        await bot.send_message(
+            entity=event.chat,
+            message=bot_text['response']['messages_added'][bot_lang]
+        )
+
+        await sessions.end(event.sender_id)
+
+    except ImportFormatError as e:
+        await bot.send_message(
+            entity=event.chat,
+            message=bot_text['response']['json_format_error'][bot_lang] + '\n' + str(e))
+    except Exception:
+        logging.exception('Importing messages failed')
+        await bot.send_message(
+            entity=event.chat,
+            message=bot_text['response']['json_format_error'][bot_lang])
+    finally:
+        reporter.cancel()
+        os.remove(file_path)
+
+
+@router.state(ChatState.waiting_for_message_text)
+async def message_text_state_handler(event: events.NewMessage.Event) -> None:
+    '''
+    New message text input
+    '''
+    text = event.message.message.strip()
+
+    if len(text) >= 1:
+        await bot.send_message(
+            entity=event.chat,
+            message=bot_text['response']['upload_message_media'][bot_lang]
+        )
+        await sessions.set_state(event.sender_id, ChatState.waiting_for_message_media, text=text)
+    else:
+        await bot.send_message(
+            entity=event.chat,
+            message=bot_text['response']['enter_message_text'][bot_lang]
+        )
+
+
+@router.state(ChatState.waiting_for_message_media)
+async def message_media_state_handler(event: events.NewMessage.Event) -> None:
+    '''
+    New message media upload; several files make an album
+    '''
+    pending = sessions.data(event.sender_id)
+    files = pending.setdefault('files', [])
+
+    if event.file is not None:
+        # files of an album arrive as separate, concurrent updates, so the
+        # ones still downloading count too
+        downloading = album_downloads.get(event.sender_id, 0)
+        if len(files) + downloading >= MAX_ALBUM_FILES:
             await bot.send_message(
                 entity=event.chat,
-                message=bot_text['response']['message_send_time_updated_24x7'][bot_lang]
+                message=bot_text['response']['album_full'][bot_lang].format(MAX_ALBUM_FILES)
             )
+            return
 
-            await send_messages(
-                messages=messages, groups=group_ids
-            )
+        album_downloads[event.sender_id] = downloading + 1
+        try:
+            fd, download_path = tempfile.mkstemp(suffix=event.file.ext)
+            os.close(fd)
+            await bot.download_media(message=event.message.media, file=download_path)
+
+            download_path, image_info = await media_processor.optimize(download_path)
+            file_path = await media_store.add(download_path)
+            if image_info is not None:
+                await media_processor.record(file_path, image_info)
+        finally:
+            album_downloads[event.sender_id] -= 1
+            if not album_downloads[event.sender_id]:
+                del album_downloads[event.sender_id]
+
+        files.append((event.message.id, file_path))
+        await sessions.set_state(event.sender_id, ChatState.waiting_for_message_media)
+
+        await bot.send_message(
+            entity=event.chat,
+            message=bot_text['response']['file_added'][bot_lang].format(len(files), MAX_ALBUM_FILES),
+            buttons=[
+                Button.text(
+                    text=bot_text['button']['done'][bot_lang],
+                    resize=True
+                ),
+                Button.text(
+                    text=bot_text['button']['back'][bot_lang],
+                    resize=True
+                )
+            ])
+
+    elif files and event.message.message.strip() == bot_text['button']['done'][bot_lang]:
+        await bot.send_message(
+            entity=event.chat,
+            message=bot_text['response']['do_you_wanna_add_button'][bot_lang],
+            buttons=[
+                Button.text(
+                    text=bot_text['button']['yes'][bot_lang],
+                    resize=True
+                ),
+                Button.text(
+                    text=bot_text['button']['no'][bot_lang],
+                    resize=True
+                ),
+                Button.text(
+                    text=bot_text['button']['back'][bot_lang],
+                    resize=True
+                )
+            ])
+        await sessions.set_state(event.sender_id, ChatState.do_you_wanna_add_button)
+    else:
+        await bot.send_message(event.chat, bot_text['response']['upload_message_media'][bot_lang])
+
+
+@router.state(ChatState.do_you_wanna_add_button)
+async def add_button_state_handler(event: events.NewMessage.Event) -> None:
+    '''
+    Add button yes/no answer
+    '''
+    text = event.message.message.strip()
+
+    if text == bot_text['button']['yes'][bot_lang]:
+        await bot.send_message(
+            entity=event.chat,
+            message=bot_text['response']['add_button_name'][bot_lang],
+            buttons=[
+                Button.text(
+                    text=bot_text['button']['back'][bot_lang],
+                    resize=True
+                )
+            ])
+        await sessions.set_state(event.sender_id, ChatState.waiting_for_message_button_name)
+
+    elif text == bot_text['button']['no'][bot_lang]:
+        pending = sessions.data(event.sender_id)
+        message_id = await message_repository.add(NewMessage(
+            text=pending['text'],
+            file_links=[file_path for _, file_path in sorted(pending['files'])],
+            buttons=[(name, link) for name, link in pending['buttons']]
+        ))
+
+        change_feed.publish(ChangeKind.MESSAGE_ADDED, message_id)
+
+        await bot.send_message(
+            entity=event.chat,
+            message=bot_text['response']['message_added'][bot_lang],
+            buttons=[
+                Button.text(
+                    text=bot_text['button']['back'][bot_lang],
+                    resize=True
+                )
+            ])
+
+        await sessions.end(event.sender_id)
+    else:
+        await bot.send_message(
+            entity=event.chat,
+            message=bot_text['response']['do_you_wanna_add_button'][bot_lang])
+
+
+@router.state(ChatState.waiting_for_message_button_name)
+async def button_name_state_handler(event: events.NewMessage.Event) -> None:
+    '''
+    Button name input
+    '''
+    text = event.message.message.strip()
+
+    if len(text) >= 1:
+        await bot.send_message(
+            entity=event.chat,
+            message=bot_text['response']['add_button_link'][bot_lang],
+            buttons=[
+                Button.text(
+                    text=bot_text['button']['back'][bot_lang],
+                    resize=True
+                )
+            ]
+        )
+        await sessions.set_state(event.sender_id, ChatState.waiting_for_message_button_link, button_name=text)
+    else:
+        await bot.send_message(
+            entity=event.chat,
+            message=bot_text['response']['add_button_name'][bot_lang])
+
+
+@router.state(ChatState.waiting_for_message_button_link)
+async def button_link_state_handler(event: events.NewMessage.Event) -> None:
+    '''
+    Button link input
+    '''
+    text = event.message.message.strip()
+
+    if len(text) >= 1:
+        pending = sessions.data(event.sender_id)
+        pending['buttons'].append((pending['button_name'], text))
+
+        await bot.send_message(
+            entity=event.chat,
+            message=bot_text['response']['add_another_button'][bot_lang],
+            buttons=[[
+                Button.text(
+                    text=bot_text['button']['yes'][bot_lang],
+                    resize=True
+                ),
+                Button.text(
+                    text=bot_text['button']['no'][bot_lang],
+                    resize=True
+                ),
+                Button.text(
+                    text=bot_text['button']['back'][bot_lang],
+                    resize=True
+                )
+            ]])
+
+        await sessions.set_state(event.sender_id, ChatState.do_you_wanna_add_button)
+
+    else:
+        await bot.send_message(
+            entity=event.chat,
+            message=bot_text['response']['add_button_link'][bot_lang],
+            buttons=[
+                Button.text(
+                    text=bot_text['button']['back'][bot_lang],
+                    resize=True
+                )
+            ]
+        )
+
+
+@router.state(ChatState.waiting_for_del_msg_id)
+async def delete_message_state_handler(event: events.NewMessage.Event) -> None:
+    '''
+    Message id input
+    '''
+    text = event.message.message.strip()
+
+    if text.isdigit():
+        msg_id = int(text)
+        await message_repository.delete(msg_id)
+
+        change_feed.publish(ChangeKind.MESSAGE_REMOVED, msg_id)
+
+        await bot.send_message(
+            entity=event.chat,
+            message=bot_text['response']['message_deleted'][bot_lang]
+        )
+
+        await sessions.end(event.sender_id)
+    elif text == bot_text['button']['delete_all'][bot_lang]:
+        await message_repository.delete_all()
+
+        change_feed.publish(ChangeKind.MESSAGES_CLEARED)
+
+        await bot.send_message(
+            entity=event.chat,
+            message=bot_text['response']['message_deleted'][bot_lang]
+        )
+
+        await sessions.end(event.sender_id)
+
+    else:
+        await bot.send_message(
+            entity=event.chat,
+            message=bot_text['response']['incorrect_msg_id'][bot_lang]
+        )
+        return
 
-        elif event.message.message == bot_text['button']['turn_off'][bot_lang]:
-            run_state.set_run_state(RunState.STOPPED)
 
+@router.state(ChatState.waiting_for_interval_button_input)
+async def interval_state_handler(event: events.NewMessage.Event) -> None:
+    '''
+    Interval button input
+    '''
+    try:
+        count = int(event.message.message[1:])
+    except:
+        await bot.send_message(
+            entity=event.chat,
+            message=bot_text['response']['button_input_error'][bot_lang]
+        )
+        return
+
+    if event.message.message.startswith('➖'):
+        if interval.current_interval >= count:
+            await interval.set_interval(interval.current_interval - count)
+        else:
+            await interval.set_interval(0)
+    elif event.message.message.startswith('➕'):
+        await interval.set_interval(interval.current_interval + count)
+
+    scheduler.reschedule()
+
+    await bot.send_message(
+        entity=event.chat,
+        message=bot_text['response']['message_send_time_set'][bot_lang].format(interval.current_interval)
+    )
+
+
+@router.state(ChatState.set_run_24x7_state)
+async def run_24x7_state_handler(event: events.NewMessage.Event) -> None:
+    '''
+    Turn on/off answer
+    '''
+    if event.message.message == bot_text['button']['turn_on'][bot_lang]:
+
+        messages = await message_repository.all()
+        groups = await group_repository.all()
+
+        if len(messages) == 0:
             await bot.send_message(
-                entity=event.chat,
-                message=bot_text['response']['message_sending_turned_off'][bot_lang]
-            )
+                entity=event.chat, message=bot_text['response']['pls_add_message'][bot_lang])
+            await sessions.end(event.sender_id)
+            return
+
+        if len(groups) == 0:
+            await bot.send_message(
+                entity=event.chat, message=bot_text['response']['pls_add_groups'][bot_lang])
+            await sessions.end(event.sender_id)
+            return
+
+        await run_state.set_run_state(RunState.STARTED)
+
+        await bot.send_message(
+            entity=event.chat,
+            message=bot_text['response']['message_send_time_updated_24x7'][bot_lang]
+        )
+
+        await stop_posting()
+
+        # run the posting loop in the background so this handler returns
+        run_state.task = asyncio.create_task(send_messages(
+            messages=messages, groups=groups
+        ))
+
+    elif event.message.message == bot_text['button']['turn_off'][bot_lang]:
+        await run_state.set_run_state(RunState.STOPPED)
+        await stop_posting()
+
+        await bot.send_message(
+            entity=event.chat,
+            message=bot_text['response']['message_sending_turned_off'][bot_lang]
+        )
+
+
+async def new_message_handler(event: events.NewMessage.Event) -> None:
+    await startup.wait_ready()
+    await router.dispatch(event)
+    startup.mark_update_handled()
+
+
+async def start_shard(shard: Shard) -> None:
+    '''
+    Connect a shard's bot with its stored session, authorizing again only
+    when it's missing, revoked or belongs to another bot token
+    '''
+    global bot
+
+    if shard.name == MAIN_SHARD:
+        session_path = os.path.join(session_folder_path, 'bot.session')
+        bot_id_key = 'bot_id'
+    else:
+        session_path = os.path.join(session_folder_path, f'bot_{shard.name}.session')
+        bot_id_key = f'bot_id:{shard.name}'
+
+    if await settings.get(bot_id_key) != shard.bot_id and os.path.exists(session_path):
+        os.remove(session_path)
+
+    client_class = FakeClient if fake_telegram else TelegramClient
+    shard.client = client_class(
+        session=session_path,
+        api_id=tg_api_id,
+        api_hash=tg_api_hash
+    )
+    # admins only talk to the main bot
+    if shard.name == MAIN_SHARD:
+        # handlers reply through `bot` as soon as updates arrive
+        bot = shard.client
+        shard.client.add_event_handler(new_message_handler, events.NewMessage)
+    shard.client.add_event_handler(functools.partial(chat_action_handler, shard), events.ChatAction)
+
+    await shard.client.start(bot_token=shard.bot_token)
+    await settings.set(bot_id_key, shard.bot_id)
+
+
+async def start_bots() -> None:
+    await asyncio.gather(*[start_shard(shard) for shard in shards])
+
+
+async def load_intervals() -> None:
+    '''
+    load the intervals of single groups and messages into the scheduler
+    '''
+    scheduler.group_intervals = await group_repository.intervals()
+    scheduler.message_intervals = await message_repository.intervals()
+
+
+async def load_state() -> None:
+    '''
+    warm the caches before handling updates
+    '''
+    await media_store.adopt_legacy_files()
+    await asyncio.gather(
+        shards.load(),
+        *[shard.load() for shard in shards],
+        media_processor.load(),
+        render_cache.load(),
+        outbox.load(),
+        interval.load(),
+        load_intervals(),
+        run_state.load(),
+        sessions.load(),
+        group_health.load(),
+        staging.load()
+    )
+
+
+async def main() -> None:
+    log_listener.start()
+
+    for folder_path in (session_folder_path, files_folder_path):
+        os.makedirs(folder_path, exist_ok=True)
+
+    await database.run(migrate)
+    # log in while the caches load; updates wait for both
+    await asyncio.gather(start_bots(), load_state())
+    startup.mark_ready()
+
+    if run_state.current_run_state == RunState.STARTED:
+        run_state.task = asyncio.create_task(resume_posting())
+
+    if media_gc_interval > 0:
+        start_background(collect_media_garbage())
+
+    if outbox_prune_interval > 0:
+        start_background(prune_outbox())
+
+    if error_digest_interval > 0:
+        start_background(send_error_digests())
+
+    if metrics_port > 0:
+        await metrics_server.start()
+
+    if diagnostics:
+        start_background(watchdog.run())
+
+    try:
+        await bot.run_until_disconnected()
+    finally:
+        await metrics_server.close()
+        for shard in shards:
+            if shard.client is not None and shard.client is not bot:
+                await shard.client.disconnect()
+        media_processor.close()
+        database.close()
+        log_listener.stop()
 
 
-bot.run_until_disconnected()
\ No newline at end of file
+if __name__ == '__main__':
+    asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,119 @@
+import asyncio
+import logging
+from typing import Dict, Optional
+
+from telethon import types
+
+from database import Database
+
+
+# media cache
+class MediaCache(object):
+    '''
+    Upload-once cache of Telegram file references.
+
+    The first time a local file is posted it is uploaded as usual and the
+    photo/document reference Telegram returns (id, access_hash and
+    file_reference) is stored in SQLite together with the message it came
+    from. Every later post reuses that reference instead of uploading the
+    file again. References only work for the bot that uploaded the file,
+    so each shard has its own entries.
+    '''
+
+    def __init__(self, database: Database, shard: str) -> None:
+        self.database = database
+        self.shard = shard
+        self._refs: Dict[str, types.TypeInputMedia] = {}
+        self._upload_locks: Dict[str, asyncio.Lock] = {}
+
+    async def load(self) -> None:
+        rows = await self.database.fetchall(
+            'SELECT file_link, kind, media_id, access_hash, file_reference FROM media_cache WHERE shard=?',
+            (self.shard, ))
+
+        for row in rows:
+            self._refs[row[0]] = self._build_ref(row[1], row[2], row[3], row[4])
+
+    @staticmethod
+    def _build_ref(kind: str, media_id: int, access_hash: int, file_reference: bytes):
+        if kind == 'photo':
+            return types.InputPhoto(id=media_id, access_hash=access_hash, file_reference=file_reference)
+        return types.InputDocument(id=media_id, access_hash=access_hash, file_reference=file_reference)
+
+    @staticmethod
+    def _extract(message) -> Optional[tuple]:
+        '''
+        Pull (kind, id, access_hash, file_reference) out of a sent message
+        '''
+        media = getattr(message, 'media', None)
+        if isinstance(media, types.MessageMediaPhoto) and isinstance(media.photo, types.Photo):
+            photo = media.photo
+            return 'photo', photo.id, photo.access_hash, photo.file_reference
+        if isinstance(media, types.MessageMediaDocument) and isinstance(media.document, types.Document):
+            document = media.document
+            return 'document', document.id, document.access_hash, document.file_reference
+        return None
+
+    def get(self, file_link: str):
+        '''
+        Cached input photo/document for `file_link`, or None
+        '''
+        return self._refs.get(file_link)
+
+    def upload_lock(self, file_link: str) -> asyncio.Lock:
+        '''
+        Lock held while a file is being uploaded for the first time, so
+        concurrent posts of the same file wait for a single upload
+        '''
+        lock = self._upload_locks.get(file_link)
+        if lock is None:
+            lock = self._upload_locks[file_link] = asyncio.Lock()
+        return lock
+
+    async def store(self, file_link: str, message) -> None:
+        '''
+        Remember the file reference of a message that was just sent
+        '''
+        extracted = self._extract(message)
+        if extracted is None:
+            return
+
+        kind, media_id, access_hash, file_reference = extracted
+        self._refs[file_link] = self._build_ref(kind, media_id, access_hash, file_reference)
+        self._upload_locks.pop(file_link, None)
+
+        await self.database.execute(
+            'INSERT OR REPLACE INTO media_cache'
+            '(shard, file_link, kind, media_id, access_hash, file_reference, origin_chat, origin_msg_id) '
+            'VALUES(?, ?, ?, ?, ?, ?, ?, ?)',
+            (self.shard, file_link, kind, media_id, access_hash, file_reference, message.chat_id, message.id)
+        )
+
+    async def invalidate(self, file_link: str) -> None:
+        self._refs.pop(file_link, None)
+        await self.database.execute(
+            'DELETE FROM media_cache WHERE shard=? AND file_link=?', (self.shard, file_link))
+
+    async def refresh(self, client, file_link: str):
+        '''
+        Fetch a fresh file_reference for an expired entry by re-reading the
+        message it was first sent in. Returns the new reference, or None if
+        the file has to be uploaded again.
+        '''
+        origin = await self.database.fetchone(
+            'SELECT origin_chat, origin_msg_id FROM media_cache WHERE shard=? AND file_link=?',
+            (self.shard, file_link))
+
+        message = None
+        if origin is not None:
+            try:
+                message = await client.get_messages(origin[0], ids=origin[1])
+            except Exception:
+                logging.warning('Could not re-read origin message of %s', file_link)
+
+        if message is None or self._extract(message) is None:
+            await self.invalidate(file_link)
+            return None
+
+        await self.store(file_link, message)
+        return self.get(file_link)
@@ -0,0 +1,166 @@
+import asyncio
+import io
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, NamedTuple, Optional, Tuple
+
+from database import Database
+from media_store import thumbnail_path
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# Telegram shows photos at most 2560px on the long side and thumbnails at 320px
+MAX_PHOTO_SIDE = 2560
+THUMBNAIL_SIDE = 320
+JPEG_QUALITY = 85
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.bmp', '.tif', '.tiff'}
+
+
+class ImageInfo(NamedTuple):
+    '''
+    Result of optimizing one image
+    '''
+    path: str
+    width: int
+    height: int
+    size: int
+    original_size: int
+    mime: str
+    thumbnail: bytes
+
+
+def optimize_image(path: str) -> Optional[ImageInfo]:
+    '''
+    Downscale and recompress the image at `path` in place, keeping the
+    original bytes when they are already smaller. Returns None for
+    anything that isn't a still image. Runs in a worker process.
+    '''
+    original_size = os.path.getsize(path)
+    try:
+        image = Image.open(path)
+        image.load()
+    except Exception:
+        return None
+    if getattr(image, 'n_frames', 1) > 1:
+        return None
+
+    source_mime = Image.MIME.get(image.format, 'application/octet-stream')
+    image = ImageOps.exif_transpose(image)
+    source_width, source_height = image.size
+    image.thumbnail((MAX_PHOTO_SIDE, MAX_PHOTO_SIDE), Image.LANCZOS)
+
+    has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+    if has_alpha:
+        ext, mime, options = '.png', 'image/png', {'format': 'PNG', 'optimize': True}
+    else:
+        image = image.convert('RGB')
+        ext, mime, options = '.jpg', 'image/jpeg', {
+            'format': 'JPEG', 'quality': JPEG_QUALITY, 'optimize': True, 'progressive': True}
+
+    optimized = io.BytesIO()
+    image.save(optimized, **options)
+
+    if optimized.tell() < original_size:
+        new_path = os.path.splitext(path)[0] + ext
+        with open(new_path, 'wb') as f:
+            f.write(optimized.getbuffer())
+        if new_path != path:
+            os.remove(path)
+        path, size, width, height = new_path, optimized.tell(), image.width, image.height
+    else:
+        size, width, height, mime = original_size, source_width, source_height, source_mime
+
+    thumbnail = image.copy()
+    thumbnail.thumbnail((THUMBNAIL_SIDE, THUMBNAIL_SIDE), Image.LANCZOS)
+    thumbnail_bytes = io.BytesIO()
+    thumbnail.convert('RGB').save(thumbnail_bytes, format='JPEG', quality=JPEG_QUALITY)
+
+    return ImageInfo(path, width, height, size, original_size, mime, thumbnail_bytes.getvalue())
+
+
+# media processing
+class MediaProcessor(object):
+    '''
+    Optional ingestion step for uploaded media.
+
+    With Pillow installed, images are downscaled to what Telegram
+    displays and recompressed in a process pool before they are stored,
+    and a thumbnail plus the optimized size are recorded in `media_meta`.
+    Other files, including videos, pass through unchanged.
+    '''
+
+    def __init__(self, database: Database, max_workers: int = 2, enabled: bool = True) -> None:
+        self.database = database
+        self.max_workers = max_workers
+        self.enabled = enabled and Image is not None
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._thumbnails: Dict[str, str] = {}
+
+        if enabled and Image is None:
+            logging.info('Pillow is not installed, media is stored without optimization')
+
+    async def load(self) -> None:
+        rows = await self.database.fetchall('SELECT path, thumb_path FROM media_meta WHERE thumb_path IS NOT NULL')
+        self._thumbnails = {row[0]: row[1] for row in rows}
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.max_workers, mp_context=multiprocessing.get_context('spawn'))
+        return self._pool
+
+    async def optimize(self, path: str) -> Tuple[str, Optional[ImageInfo]]:
+        '''
+        Optimize a downloaded file and return its (possibly new) path and
+        the image info, or the unchanged path and None
+        '''
+        if not self.enabled or os.path.splitext(path)[1].lower() not in IMAGE_EXTENSIONS:
+            return path, None
+
+        loop = asyncio.get_running_loop()
+        try:
+            info = await loop.run_in_executor(self._executor(), optimize_image, path)
+        except Exception:
+            logging.exception('Optimizing %s failed, storing it as uploaded', path)
+            return path, None
+
+        if info is None:
+            return path, None
+        return info.path, info
+
+    async def record(self, file_link: str, info: ImageInfo) -> None:
+        '''
+        Save the thumbnail and metadata of a stored image
+        '''
+        thumb_path = thumbnail_path(file_link)
+
+        def write_thumbnail() -> None:
+            with open(thumb_path, 'wb') as f:
+                f.write(info.thumbnail)
+
+        await asyncio.to_thread(write_thumbnail)
+
+        await self.database.execute(
+            'INSERT OR REPLACE INTO media_meta(path, width, height, size, original_size, mime, thumb_path) '
+            'VALUES(?, ?, ?, ?, ?, ?, ?)',
+            (file_link, info.width, info.height, info.size, info.original_size, info.mime, thumb_path))
+        self._thumbnails[file_link] = thumb_path
+
+        if info.size < info.original_size:
+            logging.info('Optimized %s from %s to %s bytes', file_link, info.original_size, info.size)
+
+    def thumbnail(self, file_link: str) -> Optional[str]:
+        return self._thumbnails.get(file_link)
+
+    def forget(self, file_link: str) -> None:
+        self._thumbnails.pop(file_link, None)
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
@@ -0,0 +1,179 @@
+import asyncio
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from database import Database
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def thumbnail_path(path: str) -> str:
+    '''
+    Where the thumbnail of a stored file goes; it's removed with the file
+    '''
+    return path + '.thumb.jpg'
+
+
+# media store
+class MediaStore(object):
+    '''
+    Content-addressed store for uploaded media.
+
+    A file is kept once under `<folder>/<first two hex digits>/<sha256><ext>`
+    no matter how often it is uploaded. Triggers on `message_files` keep
+    the `media_blobs.refcount` of each stored path up to date, and
+    `collect_garbage` deletes blobs nothing has referenced for `grace`
+    seconds. The grace period protects files of a half-finished
+    add-message flow, which aren't referenced until the message is saved.
+    '''
+
+    def __init__(self, database: Database, folder: str) -> None:
+        self.database = database
+        self.folder = folder
+
+    def _blob_path(self, sha256: str, ext: str) -> str:
+        return os.path.join(self.folder, sha256[:2], sha256 + ext.lower())
+
+    def _move_in(self, path: str, ext: str) -> Tuple[str, str, int]:
+        '''
+        Hash a file and move it to its content address, dropping it if the
+        same content is already stored. Runs in a worker thread.
+        '''
+        sha256 = file_sha256(path)
+        size = os.path.getsize(path)
+        blob_path = self._blob_path(sha256, ext)
+
+        if os.path.exists(blob_path):
+            os.remove(path)
+        else:
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            shutil.move(path, blob_path)
+        return sha256, blob_path, size
+
+    async def add(self, path: str, ext: Optional[str] = None) -> str:
+        '''
+        Move the file at `path` into the store and return its stored path,
+        the path of an earlier copy if the content is already stored
+        '''
+        if ext is None:
+            ext = os.path.splitext(path)[1]
+        sha256, blob_path, size = await asyncio.to_thread(self._move_in, path, ext)
+
+        def register(conn: sqlite3.Connection) -> str:
+            conn.execute(
+                'INSERT INTO media_blobs(sha256, path, size, refcount, touched_at) '
+                'VALUES(?, ?, ?, 0, ?) ON CONFLICT(sha256) DO UPDATE SET touched_at=excluded.touched_at',
+                (sha256, blob_path, size, time.time()))
+            return conn.execute('SELECT path FROM media_blobs WHERE sha256=?', (sha256, )).fetchone()[0]
+
+        stored_path = await self.database.transaction(register)
+        if stored_path != blob_path and os.path.exists(blob_path):
+            # same content stored earlier under another extension
+            await asyncio.to_thread(os.remove, blob_path)
+        return stored_path
+
+    def _link_paths(self, file_link: str) -> List[str]:
+        '''
+        Real paths a stored file link may mean: links can be relative to
+        another working directory or to the home folder, or point into the
+        files folder of another home
+        '''
+        paths = [os.path.realpath(file_link)]
+        if not os.path.isabs(file_link):
+            paths.append(os.path.realpath(os.path.join(os.path.dirname(self.folder), file_link)))
+        parent = os.path.basename(os.path.dirname(file_link))
+        if parent in ('', os.path.basename(self.folder)):
+            paths.append(os.path.realpath(os.path.join(self.folder, os.path.basename(file_link))))
+        return paths
+
+    def _move_aside(self, path: str) -> None:
+        aside = os.path.join(self.folder, '.unreferenced')
+        os.makedirs(aside, exist_ok=True)
+        shutil.move(path, os.path.join(aside, os.path.basename(path)))
+
+    async def adopt_legacy_files(self) -> None:
+        '''
+        Move files saved before the store existed to their content address.
+        Files no message seems to refer to are moved to `.unreferenced`
+        rather than deleted.
+        '''
+        if not os.path.isdir(self.folder):
+            return
+
+        legacy = [
+            entry.path for entry in os.scandir(self.folder)
+            if entry.is_file() and not entry.name.startswith('.')
+        ]
+        if not legacy:
+            return
+
+        links: Dict[str, Set[str]] = {}
+        for row in await self.database.fetchall('SELECT DISTINCT file_link FROM message_files'):
+            for path in self._link_paths(row[0]):
+                links.setdefault(path, set()).add(row[0])
+
+        moved_aside = 0
+        for path in legacy:
+            file_links = links.get(os.path.realpath(path))
+            if not file_links:
+                await asyncio.to_thread(self._move_aside, path)
+                moved_aside += 1
+                continue
+
+            stored_path = await self.add(path)
+
+            def relink(conn: sqlite3.Connection) -> None:
+                for file_link in file_links:
+                    conn.execute('UPDATE message_files SET file_link=? WHERE file_link=?', (stored_path, file_link))
+                    conn.execute(
+                        'UPDATE OR REPLACE media_cache SET file_link=? WHERE file_link=?', (stored_path, file_link))
+
+            await self.database.transaction(relink)
+
+        logging.info('Moved %s media files saved before the media store into it', len(legacy) - moved_aside)
+        if moved_aside:
+            logging.warning(
+                'Moved %s media files no message refers to to %s', moved_aside,
+                os.path.join(self.folder, '.unreferenced'))
+
+    async def collect_garbage(self, grace: float) -> List[str]:
+        '''
+        Delete blobs unreferenced for at least `grace` seconds and return
+        their paths
+        '''
+        def collect(conn: sqlite3.Connection) -> List[str]:
+            paths = [row[0] for row in conn.execute(
+                'SELECT path FROM media_blobs WHERE refcount<=0 AND touched_at<?', (time.time() - grace, ))]
+            conn.executemany('DELETE FROM media_blobs WHERE path=?', [(path, ) for path in paths])
+            return paths
+
+        paths = await self.database.transaction(collect)
+        await asyncio.to_thread(self._remove_files, paths)
+        return paths
+
+    @staticmethod
+    def _remove_files(paths: Iterable[str]) -> None:
+        for path in paths:
+            for file_path in (path, thumbnail_path(path)):
+                try:
+                    os.remove(file_path)
+                except FileNotFoundError:
+                    pass
+
+    async def disk_usage(self) -> Tuple[int, int]:
+        '''
+        (number of blobs, total bytes) currently stored
+        '''
+        row = await self.database.fetchone('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM media_blobs')
+        return row[0], row[1]
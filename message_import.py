@@ -0,0 +1,256 @@
+import json
+import os
+from typing import Iterable, Iterator, List, Optional, TextIO
+
+from database import Group, NewMessage
+
+# Telegram albums hold at most ten files
+MAX_ALBUM_FILES = 10
+
+
+class ImportFormatError(ValueError):
+    '''
+    The uploaded file isn't a valid message library
+    '''
+
+    def __init__(self, reason: str, index: Optional[int] = None) -> None:
+        self.reason = reason
+        self.index = index
+        super().__init__(reason if index is None else f'message #{index + 1}: {reason}')
+
+
+class ImportProgress(object):
+    '''
+    Parse progress, written by the parsing thread and read by the event loop
+    '''
+    __slots__ = ('total_bytes', 'read_bytes', 'messages')
+
+    def __init__(self, total_bytes: int = 0) -> None:
+        self.total_bytes = total_bytes
+        self.read_bytes = 0
+        self.messages = 0
+
+    @property
+    def percent(self) -> int:
+        if not self.total_bytes:
+            return 0
+        return min(100, self.read_bytes * 100 // self.total_bytes)
+
+
+# streaming parser
+class _Reader(object):
+    '''
+    Character buffer over a text file that is refilled in chunks
+    '''
+
+    def __init__(self, fp: TextIO, chunk_size: int, progress: Optional[ImportProgress]) -> None:
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self) -> bool:
+        '''
+        Read more of the file. A value that didn't fit in the buffer at
+        least doubles the unread part, so decoding it again and again
+        stays linear in its length.
+        '''
+        if self.eof:
+            return False
+        chunk = self.fp.read(max(self.chunk_size, len(self.buffer) - self.pos))
+        if not chunk:
+            self.eof = True
+            return False
+        if self.progress is not None:
+            self.progress.read_bytes += len(chunk.encode('utf-8'))
+        # drop what was read only once it is most of the buffer
+        if self.pos > len(self.buffer) // 2:
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+        self.buffer += chunk
+        return True
+
+    def peek(self) -> str:
+        '''
+        Next non-whitespace character, '' at the end of the file
+        '''
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, char: str) -> None:
+        if self.peek() != char:
+            raise ImportFormatError(f"expected '{char}'")
+        self.pos += 1
+
+    def value(self):
+        '''
+        Decode the next JSON value, reading more of the file as needed
+        '''
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError as e:
+                # the value may simply continue in the next chunk
+                if self._fill():
+                    continue
+                raise ImportFormatError(f'invalid JSON: {e.msg}') from None
+
+            # a number at the very end of the buffer may still be incomplete
+            if end == len(self.buffer) and not self.eof and self._fill():
+                continue
+            self.pos = end
+            return value
+
+
+def iter_raw_messages(fp: TextIO, chunk_size: int = 64 * 1024,
+                      progress: Optional[ImportProgress] = None) -> Iterator[dict]:
+    '''
+    Yield the entries of the top-level "messages" array one at a time,
+    without loading the whole file
+    '''
+    reader = _Reader(fp, chunk_size, progress)
+    reader.expect('{')
+    found = False
+
+    while reader.peek() != '}':
+        if reader.peek() == '':
+            raise ImportFormatError('unexpected end of file')
+        key = reader.value()
+        if not isinstance(key, str):
+            raise ImportFormatError('expected an object key')
+        reader.expect(':')
+
+        if key == 'messages':
+            if found:
+                raise ImportFormatError('more than one "messages" list')
+            found = True
+            reader.expect('[')
+            while reader.peek() != ']':
+                yield reader.value()
+                if reader.peek() == ',':
+                    reader.pos += 1
+                    if reader.peek() == ']':
+                        raise ImportFormatError("trailing ',' in the messages list")
+                elif reader.peek() != ']':
+                    raise ImportFormatError("expected ',' or ']'")
+            reader.pos += 1
+        else:
+            reader.value()
+
+        if reader.peek() == ',':
+            reader.pos += 1
+            if reader.peek() == '}':
+                raise ImportFormatError("trailing ',' in the top-level object")
+        elif reader.peek() not in ('}', ''):
+            raise ImportFormatError("expected ',' or '}'")
+    reader.pos += 1
+
+    if reader.peek() != '':
+        raise ImportFormatError('unexpected data after the top-level object')
+    if not found:
+        raise ImportFormatError('missing "messages" list')
+
+
+def validate_message(raw, index: int) -> NewMessage:
+    '''
+    Check one raw entry and turn it into a NewMessage
+    '''
+    if not isinstance(raw, dict):
+        raise ImportFormatError('expected an object', index)
+
+    text = raw.get('text')
+    if not isinstance(text, list) or not all(isinstance(line, str) for line in text):
+        raise ImportFormatError('"text" must be a list of strings', index)
+
+    file_links = raw.get('file')
+    if file_links is None:
+        file_links = []
+    elif isinstance(file_links, str):
+        file_links = [file_links]
+    elif not isinstance(file_links, list) or not all(isinstance(link, str) for link in file_links):
+        raise ImportFormatError('"file" must be a string or a list of strings', index)
+    if len(file_links) > MAX_ALBUM_FILES:
+        raise ImportFormatError(f'"file" can list at most {MAX_ALBUM_FILES} files', index)
+
+    buttons = raw.get('buttons', [])
+    if not isinstance(buttons, list):
+        raise ImportFormatError('"buttons" must be a list', index)
+
+    button_rows = []
+    for button in buttons:
+        if not isinstance(button, dict) or not isinstance(button.get('name'), str) \
+                or not isinstance(button.get('link'), str):
+            raise ImportFormatError('every button needs a "name" and a "link"', index)
+        button_rows.append((button['name'], button['link']))
+
+    groups = raw.get('groups', [])
+    if not isinstance(groups, list) or not all(
+            isinstance(group, str) or isinstance(group, int) and not isinstance(group, bool) for group in groups):
+        raise ImportFormatError('"groups" must be a list of group ids or usernames', index)
+
+    weight = raw.get('weight', 1)
+    if not _positive_number(weight):
+        raise ImportFormatError('"weight" must be a positive number', index)
+
+    interval = raw.get('interval')
+    if interval is not None and not (_positive_number(interval) or interval == 0 and not isinstance(interval, bool)):
+        raise ImportFormatError('"interval" must be a number of seconds', index)
+
+    return NewMessage(text='\n'.join(text), file_links=file_links, buttons=button_rows, groups=groups,
+                      weight=float(weight), interval=None if interval is None else float(interval))
+
+
+def _positive_number(value) -> bool:
+    return not isinstance(value, bool) and isinstance(value, (int, float)) and 0 < value < float('inf')
+
+
+def resolve_groups(messages: List[NewMessage], groups: Iterable[Group]) -> List[NewMessage]:
+    '''
+    Replace the group ids and usernames of targeted messages with the ids
+    of known groups. Raises ImportFormatError on an unknown group.
+    '''
+    ids = {}
+    for group in groups:
+        ids[group.id] = group.id
+        if group.username:
+            ids[group.username.lower()] = group.id
+
+    resolved = []
+    for index, message in enumerate(messages):
+        group_ids = []
+        for group in message.groups:
+            key = group.lstrip('@').lower() if isinstance(group, str) else group
+            if key not in ids:
+                raise ImportFormatError(f'unknown group {group!r} in "groups"', index)
+            group_ids.append(ids[key])
+        resolved.append(message._replace(groups=group_ids))
+    return resolved
+
+
+def parse_message_file(path: str, progress: Optional[ImportProgress] = None) -> List[NewMessage]:
+    '''
+    Stream and validate a whole message library. Raises ImportFormatError
+    on the first problem, before anything is written.
+    '''
+    if progress is not None:
+        progress.total_bytes = os.path.getsize(path)
+
+    messages = []
+    with open(file=path, mode='rt', encoding='utf-8') as f:
+        for index, raw in enumerate(iter_raw_messages(f, progress=progress)):
+            messages.append(validate_message(raw, index))
+            if progress is not None:
+                progress.messages = index + 1
+
+    if not messages:
+        raise ImportFormatError('the "messages" list is empty')
+    return messages
@@ -0,0 +1,254 @@
+import asyncio
+import bisect
+import contextlib
+import logging
+import math
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# seconds, from a fast SQLite query to a send stuck behind a FloodWait
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(pairs: Sequence[Tuple[str, str]]) -> str:
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value))
+
+
+class _Metric(object):
+    kind = ''
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+    def _key(self, labels: Dict[str, object]) -> Tuple[str, ...]:
+        if len(labels) != len(self.labels):
+            raise ValueError(f'{self.name} takes the labels {self.labels}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def header(self) -> List[str]:
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+
+
+class Counter(_Metric):
+    '''
+    Monotonic total, per combination of label values
+    '''
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()) -> None:
+        super().__init__(name, help, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def total(self, **labels) -> float:
+        '''
+        Sum over every combination of label values matching `labels`
+        '''
+        match = [(self.labels.index(name), str(value)) for name, value in labels.items()]
+        return sum(
+            value for key, value in self._values.items() if all(key[index] == want for index, want in match))
+
+    def render(self) -> List[str]:
+        return self.header() + [
+            f'{self.name}{_format_labels(list(zip(self.labels, key)))} {_format_value(value)}'
+            for key, value in self._values.items()
+        ]
+
+
+class Gauge(_Metric):
+    '''
+    Current value, read from `read` at scrape time
+    '''
+    kind = 'gauge'
+
+    def __init__(self, name: str, help: str, read: Callable[[], float]) -> None:
+        super().__init__(name, help)
+        self.read = read
+
+    def value(self) -> float:
+        return self.read()
+
+    def render(self) -> List[str]:
+        return self.header() + [f'{self.name} {_format_value(self.read())}']
+
+
+class _Series(object):
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self, buckets: int) -> None:
+        # per bucket, not cumulative; the last one is +Inf
+        self.counts = [0] * (buckets + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram(_Metric):
+    '''
+    Observations counted in fixed buckets, per combination of label values
+    '''
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Tuple[str, ...], _Series] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = _Series(len(self.buckets))
+        series.counts[bisect.bisect_left(self.buckets, value)] += 1
+        series.sum += value
+        series.count += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self) -> int:
+        return sum(series.count for series in self._series.values())
+
+    def sum(self) -> float:
+        return sum(series.sum for series in self._series.values())
+
+    def quantile(self, q: float) -> Optional[float]:
+        '''
+        Estimate of the `q` quantile over all label values, interpolated
+        inside the bucket it falls in; None without observations
+        '''
+        counts = [0] * (len(self.buckets) + 1)
+        for series in self._series.values():
+            for index, count in enumerate(series.counts):
+                counts[index] += count
+        total = sum(counts)
+        if not total:
+            return None
+
+        rank = q * total
+        seen = 0
+        for index, count in enumerate(counts):
+            if count and seen + count >= rank:
+                if index == len(self.buckets):
+                    # beyond the last bound there's nothing to interpolate to
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                return lower + (self.buckets[index] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for key, series in self._series.items():
+            pairs = list(zip(self.labels, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf, ), series.counts):
+                cumulative += count
+                lines.append(
+                    f'{self.name}_bucket{_format_labels(pairs + [("le", _format_value(bound))])} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(pairs)} {_format_value(series.sum)}')
+            lines.append(f'{self.name}_count{_format_labels(pairs)} {series.count}')
+        return lines
+
+
+# metrics registry
+class MetricsRegistry(object):
+    '''
+    Counters, gauges and histograms rendered in the Prometheus text
+    format. Metrics are only updated from the event loop, so they need no
+    locking.
+    '''
+
+    def __init__(self) -> None:
+        self._metrics: Dict[str, _Metric] = {}
+
+    def _register(self, metric: _Metric):
+        if metric.name in self._metrics:
+            raise ValueError(f'metric {metric.name} is already registered')
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, read: Callable[[], float]) -> Gauge:
+        return self._register(Gauge(name, help, read))
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+# metrics endpoint
+class MetricsServer(object):
+    '''
+    Minimal HTTP server answering `GET /metrics` with the registry in
+    the Prometheus text format
+    '''
+
+    def __init__(self, registry: MetricsRegistry, host: str = '127.0.0.1', port: int = 9464) -> None:
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        logging.info('Serving metrics on http://%s:%s/metrics', self.host, self.port)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            # the headers don't matter, but have to be read
+            while (await asyncio.wait_for(reader.readline(), 5)).strip():
+                pass
+
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?', 1)[0] == '/metrics':
+                status, content_type, body = '200 OK', CONTENT_TYPE, self.registry.render().encode()
+            else:
+                status, content_type, body = '404 Not Found', 'text/plain', b'Not found\n'
+
+            writer.write(
+                f'HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n'
+                f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
@@ -0,0 +1,280 @@
+import logging
+import sqlite3
+from typing import Callable, List
+
+
+def _v1_initial(conn: sqlite3.Connection) -> None:
+    '''
+    Tables as created by releases before versioned migrations
+    '''
+    conn.execute('CREATE TABLE IF NOT EXISTS groups(id INTEGER, username TEXT)')
+    conn.execute('CREATE TABLE IF NOT EXISTS messages(text TEXT, msg_id INTEGER)')
+    conn.execute('CREATE TABLE IF NOT EXISTS buttons(name TEXT, link TEXT, msg_id INTEGER)')
+    conn.execute('CREATE TABLE IF NOT EXISTS message_files(file_link TEXT, msg_id INTEGER)')
+
+    columns = [column[1] for column in conn.execute('PRAGMA table_info(groups)').fetchall()]
+    if 'peer_type' not in columns:
+        conn.execute('ALTER TABLE groups ADD COLUMN peer_type TEXT')
+    if 'access_hash' not in columns:
+        conn.execute('ALTER TABLE groups ADD COLUMN access_hash INTEGER')
+
+    conn.execute(
+        'CREATE TABLE IF NOT EXISTS media_cache('
+        'file_link TEXT PRIMARY KEY, kind TEXT, media_id INTEGER, access_hash INTEGER, '
+        'file_reference BLOB, origin_chat INTEGER, origin_msg_id INTEGER)'
+    )
+    conn.execute(
+        'CREATE TABLE IF NOT EXISTS outbox('
+        'batch_id INTEGER, group_id INTEGER, msg_id INTEGER, status TEXT, updated_at REAL, '
+        'PRIMARY KEY(batch_id, group_id))'
+    )
+    conn.execute('CREATE TABLE IF NOT EXISTS settings(key TEXT PRIMARY KEY, value TEXT)')
+
+
+def _v2_keys_and_indexes(conn: sqlite3.Connection) -> None:
+    '''
+    Primary keys, AUTOINCREMENT message ids, msg_id indexes, cascading
+    deletes and one row per group id.
+
+    Rows sharing a msg_id (ids used to be reused after deletes) keep the
+    first message, and buttons/files of deleted messages are dropped.
+    '''
+    conn.execute(
+        'CREATE TABLE groups_v2('
+        'id INTEGER PRIMARY KEY, username TEXT, peer_type TEXT, access_hash INTEGER)'
+    )
+    conn.execute(
+        'INSERT OR IGNORE INTO groups_v2(id, username, peer_type, access_hash) '
+        'SELECT id, username, peer_type, access_hash FROM groups WHERE id IS NOT NULL'
+    )
+
+    conn.execute(
+        'CREATE TABLE messages_v2('
+        'msg_id INTEGER PRIMARY KEY AUTOINCREMENT, text TEXT NOT NULL)'
+    )
+    conn.execute(
+        'INSERT INTO messages_v2(msg_id, text) '
+        'SELECT msg_id, text FROM messages WHERE msg_id IS NOT NULL GROUP BY msg_id'
+    )
+
+    conn.execute(
+        'CREATE TABLE buttons_v2('
+        'id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, link TEXT NOT NULL, '
+        'msg_id INTEGER NOT NULL REFERENCES messages(msg_id) ON DELETE CASCADE)'
+    )
+    conn.execute(
+        'INSERT INTO buttons_v2(name, link, msg_id) '
+        'SELECT name, link, msg_id FROM buttons WHERE msg_id IN (SELECT msg_id FROM messages_v2)'
+    )
+
+    conn.execute(
+        'CREATE TABLE message_files_v2('
+        'id INTEGER PRIMARY KEY AUTOINCREMENT, file_link TEXT, '
+        'msg_id INTEGER NOT NULL REFERENCES messages(msg_id) ON DELETE CASCADE)'
+    )
+    conn.execute(
+        'INSERT INTO message_files_v2(file_link, msg_id) '
+        'SELECT file_link, msg_id FROM message_files WHERE msg_id IN (SELECT msg_id FROM messages_v2)'
+    )
+
+    for table in ('groups', 'messages', 'buttons', 'message_files'):
+        conn.execute(f'DROP TABLE {table}')
+        conn.execute(f'ALTER TABLE {table}_v2 RENAME TO {table}')
+
+    conn.execute('CREATE INDEX buttons_msg_id ON buttons(msg_id)')
+    conn.execute('CREATE INDEX message_files_msg_id ON message_files(msg_id)')
+    conn.execute('CREATE INDEX outbox_group_id ON outbox(group_id, batch_id)')
+
+
+def _v3_sessions(conn: sqlite3.Connection) -> None:
+    '''
+    Conversation sessions of the admins
+    '''
+    conn.execute(
+        'CREATE TABLE sessions('
+        'user_id INTEGER PRIMARY KEY, state TEXT NOT NULL, data TEXT NOT NULL, touched REAL NOT NULL)'
+    )
+    conn.execute('CREATE INDEX sessions_touched ON sessions(touched)')
+
+
+def _v4_media_blobs(conn: sqlite3.Connection) -> None:
+    '''
+    Content-addressed media files, reference counted by triggers on
+    message_files
+    '''
+    conn.execute(
+        'CREATE TABLE media_blobs('
+        'sha256 TEXT PRIMARY KEY, path TEXT NOT NULL UNIQUE, size INTEGER NOT NULL, '
+        'refcount INTEGER NOT NULL DEFAULT 0, touched_at REAL NOT NULL)'
+    )
+    conn.execute('CREATE INDEX media_blobs_unreferenced ON media_blobs(touched_at) WHERE refcount<=0')
+
+    now = "(julianday('now') - 2440587.5) * 86400.0"
+    conn.execute(
+        'CREATE TRIGGER message_files_ref AFTER INSERT ON message_files BEGIN '
+        'UPDATE media_blobs SET refcount=refcount+1 WHERE path=NEW.file_link; END'
+    )
+    conn.execute(
+        'CREATE TRIGGER message_files_unref AFTER DELETE ON message_files BEGIN '
+        f'UPDATE media_blobs SET refcount=refcount-1, touched_at={now} WHERE path=OLD.file_link; END'
+    )
+    conn.execute(
+        'CREATE TRIGGER message_files_relink AFTER UPDATE OF file_link ON message_files BEGIN '
+        f'UPDATE media_blobs SET refcount=refcount-1, touched_at={now} WHERE path=OLD.file_link; '
+        'UPDATE media_blobs SET refcount=refcount+1 WHERE path=NEW.file_link; END'
+    )
+
+
+def _v5_media_meta(conn: sqlite3.Connection) -> None:
+    '''
+    Size and thumbnail of optimized images
+    '''
+    conn.execute(
+        'CREATE TABLE media_meta('
+        'path TEXT PRIMARY KEY REFERENCES media_blobs(path) ON DELETE CASCADE, '
+        'width INTEGER, height INTEGER, size INTEGER, original_size INTEGER, mime TEXT, thumb_path TEXT)'
+    )
+
+
+def _v6_album_positions(conn: sqlite3.Connection) -> None:
+    '''
+    Ordered attachments for album messages. Placeholder rows without a
+    file, which older releases stored for text-only messages, are dropped.
+    '''
+    conn.execute('DELETE FROM message_files WHERE file_link IS NULL')
+    conn.execute('ALTER TABLE message_files ADD COLUMN position INTEGER NOT NULL DEFAULT 0')
+    conn.execute('DROP INDEX message_files_msg_id')
+    conn.execute('CREATE INDEX message_files_msg_id ON message_files(msg_id, position)')
+
+
+def _v7_staged_messages(conn: sqlite3.Connection) -> None:
+    '''
+    Staging channel posts of messages, for forward mode
+    '''
+    conn.execute(
+        'CREATE TABLE staged_messages('
+        'msg_id INTEGER PRIMARY KEY REFERENCES messages(msg_id) ON DELETE CASCADE, '
+        'channel_id INTEGER NOT NULL, message_ids TEXT NOT NULL)'
+    )
+
+
+def _v8_shards(conn: sqlite3.Connection) -> None:
+    '''
+    Groups spread over several bot accounts. Input peers and media
+    references belong to one bot, so they move from `groups` and the
+    shared media cache to per-shard rows; existing ones belong to the
+    main bot.
+    '''
+    conn.execute(
+        'CREATE TABLE shard_members('
+        'group_id INTEGER NOT NULL REFERENCES groups(id) ON DELETE CASCADE, shard TEXT NOT NULL, '
+        'peer_type TEXT, access_hash INTEGER, PRIMARY KEY(group_id, shard))'
+    )
+    conn.execute(
+        "INSERT INTO shard_members(group_id, shard, peer_type, access_hash) "
+        "SELECT id, 'main', peer_type, access_hash FROM groups"
+    )
+    conn.execute(
+        'CREATE TABLE group_shards('
+        'group_id INTEGER PRIMARY KEY REFERENCES groups(id) ON DELETE CASCADE, shard TEXT NOT NULL)'
+    )
+    conn.execute("INSERT INTO group_shards(group_id, shard) SELECT id, 'main' FROM groups")
+
+    conn.execute('CREATE TABLE groups_v8(id INTEGER PRIMARY KEY, username TEXT)')
+    conn.execute('INSERT INTO groups_v8(id, username) SELECT id, username FROM groups')
+    conn.execute('DROP TABLE groups')
+    conn.execute('ALTER TABLE groups_v8 RENAME TO groups')
+
+    conn.execute(
+        'CREATE TABLE media_cache_v8('
+        'shard TEXT NOT NULL, file_link TEXT NOT NULL, kind TEXT, media_id INTEGER, access_hash INTEGER, '
+        'file_reference BLOB, origin_chat INTEGER, origin_msg_id INTEGER, PRIMARY KEY(shard, file_link))'
+    )
+    conn.execute(
+        "INSERT INTO media_cache_v8 SELECT 'main', file_link, kind, media_id, access_hash, file_reference, "
+        "origin_chat, origin_msg_id FROM media_cache"
+    )
+    conn.execute('DROP TABLE media_cache')
+    conn.execute('ALTER TABLE media_cache_v8 RENAME TO media_cache')
+
+
+def _v9_group_health(conn: sqlite3.Connection) -> None:
+    '''
+    Delivery failures, backoff and quarantine of groups
+    '''
+    conn.execute(
+        'CREATE TABLE group_health('
+        'group_id INTEGER PRIMARY KEY REFERENCES groups(id) ON DELETE CASCADE, '
+        'failures INTEGER NOT NULL DEFAULT 0, hard_failures INTEGER NOT NULL DEFAULT 0, last_error TEXT, '
+        'last_failure REAL, last_success REAL, retry_at REAL NOT NULL DEFAULT 0, '
+        'quarantined INTEGER NOT NULL DEFAULT 0)'
+    )
+
+
+def _v10_group_messages(conn: sqlite3.Connection) -> None:
+    '''
+    Messages limited to some groups, and rotation weights. A targeted
+    message without assignment rows (its groups were removed) goes
+    nowhere rather than everywhere.
+    '''
+    conn.execute('ALTER TABLE messages ADD COLUMN weight REAL NOT NULL DEFAULT 1')
+    conn.execute('ALTER TABLE messages ADD COLUMN targeted INTEGER NOT NULL DEFAULT 0')
+    conn.execute(
+        'CREATE TABLE group_messages('
+        'group_id INTEGER NOT NULL REFERENCES groups(id) ON DELETE CASCADE, '
+        'msg_id INTEGER NOT NULL REFERENCES messages(msg_id) ON DELETE CASCADE, '
+        'PRIMARY KEY(group_id, msg_id)) WITHOUT ROWID'
+    )
+    conn.execute('CREATE INDEX group_messages_msg_id ON group_messages(msg_id)')
+    conn.execute('CREATE INDEX messages_targeted ON messages(msg_id) WHERE targeted=1')
+
+
+def _v11_intervals(conn: sqlite3.Connection) -> None:
+    '''
+    Posting intervals of single groups and messages, NULL for the default
+    '''
+    conn.execute('ALTER TABLE groups ADD COLUMN post_interval REAL')
+    conn.execute('ALTER TABLE messages ADD COLUMN post_interval REAL')
+
+
+# schema versions, applied in order; the index + 1 is stored in user_version
+MIGRATIONS: List[Callable[[sqlite3.Connection], None]] = [
+    _v1_initial,
+    _v2_keys_and_indexes,
+    _v3_sessions,
+    _v4_media_blobs,
+    _v5_media_meta,
+    _v6_album_positions,
+    _v7_staged_messages,
+    _v8_shards,
+    _v9_group_health,
+    _v10_group_messages,
+    _v11_intervals,
+]
+
+
+def migrate(conn: sqlite3.Connection) -> None:
+    '''
+    Upgrade the database to the latest schema version
+    '''
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version >= len(MIGRATIONS):
+        return
+
+    # tables are rebuilt, so foreign keys are checked once at the end
+    conn.execute('PRAGMA foreign_keys=OFF')
+    try:
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            conn.execute('BEGIN')
+            try:
+                migration(conn)
+                if conn.execute('PRAGMA foreign_key_check').fetchone() is not None:
+                    raise sqlite3.IntegrityError(f'Foreign key violation after migration {number}')
+                conn.execute(f'PRAGMA user_version={number}')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+            logging.info('Database migrated to schema version %s', number)
+    finally:
+        conn.execute('PRAGMA foreign_keys=ON')
@@ -0,0 +1,124 @@
+import sqlite3
+import time
+from typing import Any, Dict, Iterable, NamedTuple, Set, Tuple
+
+from database import Database
+
+
+class Post(NamedTuple):
+    '''
+    A rendered message on its way to the groups of one outbox batch
+    '''
+    batch_id: int
+    message: Any
+
+
+# outbox statuses
+PENDING = 'pending'
+SENDING = 'sending'
+DONE = 'done'
+FAILED = 'failed'
+UNKNOWN = 'unknown'
+RESENT = 'resent'
+
+
+# outbox
+class Outbox(object):
+    '''
+    Durable delivery journal.
+
+    Every batch handed to the sender is written as one `pending` row per
+    group before anything is sent. A row becomes `sending` right before
+    its request goes out and `done`/`failed` when it returns. After a
+    crash, rows that never left are resent and rows caught mid-request
+    are marked `unknown` and skipped, so nothing is posted twice. A row
+    that never left stays `pending` until the batch that replaces it is
+    journaled, so a second crash before that resends it again.
+    '''
+
+    def __init__(self, database: Database) -> None:
+        self.database = database
+        self._next_batch = 1
+        # groups whose latest row never left before the restart
+        self._unsent: Set[int] = set()
+
+    async def load(self) -> None:
+        last_batch = (await self.database.fetchone('SELECT MAX(batch_id) FROM outbox'))[0]
+        self._next_batch = (last_batch or 0) + 1
+
+    async def enqueue(self, msg_id: int, group_ids: Iterable[int]) -> int:
+        '''
+        Journal a new batch and return its id
+        '''
+        batch_id = self._next_batch
+        self._next_batch += 1
+
+        now = time.time()
+        rows = [(batch_id, group_id, msg_id, PENDING, now) for group_id in group_ids]
+        replaced = [(RESENT, row[1], PENDING, batch_id) for row in rows if row[1] in self._unsent]
+        if not replaced:
+            await self.database.executemany('INSERT INTO outbox VALUES(?, ?, ?, ?, ?)', rows)
+            return batch_id
+
+        def enqueue(conn: sqlite3.Connection) -> None:
+            conn.executemany('INSERT INTO outbox VALUES(?, ?, ?, ?, ?)', rows)
+            # unsent rows from before the restart are replaced by this batch
+            conn.executemany(
+                'UPDATE outbox SET status=? WHERE group_id=? AND status=? AND batch_id<?', replaced)
+
+        await self.database.transaction(enqueue)
+        self._unsent.difference_update(row[1] for row in replaced)
+        return batch_id
+
+    async def mark_sending(self, batch_id: int, group_id: int) -> None:
+        await self.database.execute(
+            'UPDATE outbox SET status=?, updated_at=? WHERE batch_id=? AND group_id=?',
+            (SENDING, time.time(), batch_id, group_id)
+        )
+
+    async def complete(self, batch_id: int, results: Iterable[Tuple[int, bool]]) -> None:
+        '''
+        Record the (group_id, ok) outcome of every delivery in a batch
+        '''
+        now = time.time()
+        await self.database.executemany(
+            'UPDATE outbox SET status=?, updated_at=? WHERE batch_id=? AND group_id=?',
+            [(DONE if ok else FAILED, now, batch_id, group_id) for group_id, ok in results]
+        )
+
+    async def recover(self) -> Dict[int, Tuple[int, bool, float]]:
+        '''
+        Resume point of every group after a restart, as
+        {group_id: (msg_id, delivered, seconds since the last update)}.
+
+        `delivered` is False only when the group's latest row never left
+        the outbox, in which case that message is due again right away.
+        '''
+        def recover(conn: sqlite3.Connection) -> list:
+            conn.execute('UPDATE outbox SET status=? WHERE status=?', (UNKNOWN, SENDING))
+            rows = conn.execute(
+                'SELECT outbox.group_id, msg_id, status, updated_at FROM outbox '
+                'JOIN (SELECT group_id, MAX(batch_id) AS batch_id FROM outbox GROUP BY group_id) AS latest '
+                'ON outbox.group_id=latest.group_id AND outbox.batch_id=latest.batch_id'
+            ).fetchall()
+            return rows
+
+        rows = await self.database.transaction(recover)
+
+        now = time.time()
+        positions = {}
+        for group_id, msg_id, status, updated_at in rows:
+            positions[group_id] = (msg_id, status != PENDING, max(0.0, now - updated_at))
+        self._unsent = {group_id for group_id, position in positions.items() if not position[1]}
+        return positions
+
+    async def prune(self, keep_seconds: float = 24 * 60 * 60) -> None:
+        '''
+        Drop old rows, keeping the latest one of each group
+        '''
+        await self.database.execute(
+            'DELETE FROM outbox WHERE updated_at < ? AND EXISTS ('
+            'SELECT 1 FROM outbox AS later '
+            'WHERE later.group_id=outbox.group_id AND later.batch_id > outbox.batch_id)',
+            (time.time() - keep_seconds, )
+        )
@@ -0,0 +1,72 @@
+from typing import Dict
+
+from telethon import errors, types, utils
+
+from database import ShardMemberRepository
+
+
+# errors meaning the stored peer can't be used anymore
+PEER_ERRORS = (
+    errors.PeerIdInvalidError,
+    errors.ChannelInvalidError,
+    errors.ChannelPrivateError,
+    errors.ChatIdInvalidError,
+)
+
+
+# group entity cache
+class PeerCache(object):
+    '''
+    Resolved input peers of the groups one bot is a member of.
+
+    Peers are kept in memory and persisted in the bot's `shard_members`
+    rows, so posting never needs a `get_entity` round trip.
+    '''
+
+    def __init__(self, members: ShardMemberRepository) -> None:
+        self.members = members
+        self._peers: Dict[int, types.TypeInputPeer] = {}
+
+    async def load(self) -> None:
+        for member in await self.members.all():
+            if member.peer_type is not None:
+                self._peers[member.group_id] = self._build_peer(
+                    member.group_id, member.peer_type, member.access_hash)
+
+    @staticmethod
+    def _build_peer(group_id: int, peer_type: str, access_hash: int) -> types.TypeInputPeer:
+        real_id, _ = utils.resolve_id(group_id)
+        if peer_type == 'channel':
+            return types.InputPeerChannel(channel_id=real_id, access_hash=access_hash)
+        return types.InputPeerChat(chat_id=real_id)
+
+    async def remember(self, group_id: int, entity) -> None:
+        '''
+        Cache and persist the input peer of a group entity
+        '''
+        peer = utils.get_input_peer(entity)
+        self._peers[group_id] = peer
+
+        if isinstance(peer, types.InputPeerChannel):
+            peer_type, access_hash = 'channel', peer.access_hash
+        else:
+            peer_type, access_hash = 'chat', None
+
+        await self.members.set_peer(group_id, peer_type, access_hash)
+
+    async def get(self, client, group_id: int) -> types.TypeInputPeer:
+        '''
+        Input peer of a group, resolving and persisting it on a cache miss
+        '''
+        peer = self._peers.get(group_id)
+        if peer is None:
+            peer = await client.get_input_entity(group_id)
+            await self.remember(group_id, peer)
+        return peer
+
+    async def invalidate(self, group_id: int) -> None:
+        self._peers.pop(group_id, None)
+        await self.members.set_peer(group_id, None, None)
+
+    async def forget(self, group_id: int) -> None:
+        self._peers.pop(group_id, None)
@@ -0,0 +1,203 @@
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from telethon import errors
+
+from change_feed import Change, ChangeKind
+
+
+# errors worth retrying later
+TRANSIENT_ERRORS = (
+    errors.FloodWaitError,
+    errors.SlowModeWaitError,
+    errors.ServerError,
+    errors.TimedOutError,
+    asyncio.TimeoutError,
+    ConnectionError,
+)
+
+
+# token bucket
+class TokenBucket(object):
+    '''
+    Token bucket with a FloodWait-adaptive rate.
+
+    A FloodWait pauses the bucket for the requested time and halves its
+    rate. Each later success wins back a little of the rate, up to the
+    configured ceiling, so throughput settles just under the real limit.
+    '''
+    __slots__ = ('max_rate', 'rate', 'capacity', 'tokens', 'updated', 'paused_until')
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        '''
+        Seconds until a token is available, 0 if one is available now
+        '''
+        if now < self.paused_until:
+            return self.paused_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def on_flood_wait(self, seconds: float) -> None:
+        now = time.monotonic()
+        self.paused_until = max(self.paused_until, now + seconds)
+        self.rate = max(self.max_rate / 16, self.rate / 2)
+        self.tokens = 0.0
+        self.updated = max(now, self.paused_until)
+
+    def on_success(self) -> None:
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+# rate limiter
+class RateLimiter(object):
+    '''
+    Global, per-chat and per-DC token buckets.
+
+    `acquire` waits until every bucket that applies to a request has a
+    token. FloodWait responses are reported back with `on_flood_wait`.
+    '''
+
+    def __init__(self, global_rate: float = 25, chat_rate: float = 1 / 3,
+                 chat_burst: float = 3, dc_rate: float = 20) -> None:
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.dc_rate = dc_rate
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets: Dict[int, TokenBucket] = {}
+        self.dc_buckets: Dict[int, TokenBucket] = {}
+
+    def _buckets(self, chat_id: Optional[int], dc_id: Optional[int]) -> List[TokenBucket]:
+        buckets = [self.global_bucket]
+        if chat_id is not None:
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            buckets.append(bucket)
+        if dc_id is not None:
+            bucket = self.dc_buckets.get(dc_id)
+            if bucket is None:
+                bucket = self.dc_buckets[dc_id] = TokenBucket(self.dc_rate, self.dc_rate)
+            buckets.append(bucket)
+        return buckets
+
+    async def acquire(self, chat_id: Optional[int] = None, dc_id: Optional[int] = None) -> None:
+        buckets = self._buckets(chat_id, dc_id)
+        while True:
+            now = time.monotonic()
+            delay = max(bucket.delay(now) for bucket in buckets)
+            if delay <= 0:
+                for bucket in buckets:
+                    bucket.take()
+                return
+            await asyncio.sleep(delay)
+
+    def on_success(self, chat_id: Optional[int] = None, dc_id: Optional[int] = None) -> None:
+        for bucket in self._buckets(chat_id, dc_id):
+            bucket.on_success()
+
+    def on_flood_wait(self, seconds: float, chat_id: Optional[int] = None, dc_id: Optional[int] = None) -> None:
+        '''
+        Slow down the buckets a FloodWait applies to. A wait for one chat
+        (slow mode) only pauses that chat; anything else pauses the
+        account as a whole.
+        '''
+        if chat_id is not None:
+            self._buckets(chat_id, None)[-1].on_flood_wait(seconds)
+        else:
+            for bucket in self._buckets(None, dc_id):
+                bucket.on_flood_wait(seconds)
+
+
+# retry queue
+class RetryQueue(object):
+    '''
+    Deliveries that failed with a transient error, each due again after
+    an exponential backoff
+    '''
+
+    def __init__(self, base_delay: float = 5, max_delay: float = 600, max_attempts: int = 5) -> None:
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self._heap: List[Tuple[float, int, int, Any, int]] = []
+        self._seq = itertools.count()
+        self._pushed = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def push(self, group_id: int, payload: Any, attempt: int, min_delay: float = 0) -> bool:
+        '''
+        Queue another attempt. Returns False once the attempts are used up.
+        '''
+        if attempt >= self.max_attempts:
+            return False
+        delay = max(min_delay, min(self.max_delay, self.base_delay * 2 ** attempt))
+        heapq.heappush(self._heap, (time.monotonic() + delay, next(self._seq), group_id, payload, attempt + 1))
+        self._pushed.set()
+        return True
+
+    def next_due(self) -> Optional[float]:
+        '''
+        Seconds until the earliest retry is due, None if the queue is empty
+        '''
+        if not self._heap:
+            return None
+        return max(0.0, self._heap[0][0] - time.monotonic())
+
+    async def wait(self) -> None:
+        '''
+        Sleep until at least one retry is due
+        '''
+        while True:
+            self._pushed.clear()
+            timeout = self.next_due()
+            if timeout == 0:
+                return
+            try:
+                await asyncio.wait_for(self._pushed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def pop_due(self) -> List[Tuple[int, Any, int]]:
+        '''
+        Remove and return (group_id, payload, attempt) of every due retry
+        '''
+        now = time.monotonic()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            _, _, group_id, payload, attempt = heapq.heappop(self._heap)
+            due.append((group_id, payload, attempt))
+        return due
+
+    def forget(self, group_id: int) -> None:
+        '''
+        Drop every retry queued for a group
+        '''
+        self._heap = [entry for entry in self._heap if entry[2] != group_id]
+        heapq.heapify(self._heap)
+
+    def apply(self, change: Change) -> None:
+        if change.kind == ChangeKind.GROUP_REMOVED:
+            self.forget(change.key)
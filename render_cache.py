@@ -0,0 +1,106 @@
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from telethon import Button
+
+from change_feed import Change, ChangeKind
+from database import ButtonRepository, FileRepository, MessageRepository
+
+
+class RenderedMessage(NamedTuple):
+    '''
+    Ready-to-send form of a `messages` row
+    '''
+    msg_id: int
+    text: str
+    buttons: Optional[list]
+    # one file, or several sent as an album
+    files: Tuple[str, ...]
+
+
+def build_button_rows(buttons_data: list) -> list:
+    '''
+    Lay out url buttons two per row
+    '''
+    msg_buttons = []
+    for i in range(0, len(buttons_data), 2):
+        msg_buttons.append([
+            Button.url(text=name.strip(), url=link.strip()) for name, link in buttons_data[i:i + 2]
+        ])
+    return msg_buttons
+
+
+def render(msg_id: int, text: str, buttons_data: list, file_links: List[str]) -> RenderedMessage:
+    return RenderedMessage(
+        msg_id=msg_id,
+        text=text + '\n' + f"(MESSAGE ID: {msg_id})",
+        buttons=build_button_rows(buttons_data) or None,
+        files=tuple(file_links)
+    )
+
+
+# render cache
+class RenderCache(object):
+    '''
+    Rendered messages keyed by msg_id.
+
+    A message is rendered from the database once and then served from
+    memory until a change feed entry for it invalidates it.
+    '''
+
+    def __init__(self, messages: MessageRepository, buttons: ButtonRepository, files: FileRepository) -> None:
+        self.messages = messages
+        self.buttons = buttons
+        self.files = files
+        self._rendered: Dict[int, RenderedMessage] = {}
+
+    async def load(self) -> None:
+        '''
+        Render every stored message with one query per table
+        '''
+        buttons_by_msg: Dict[int, list] = {}
+        for button in await self.buttons.all():
+            buttons_by_msg.setdefault(button.msg_id, []).append((button.name, button.link))
+
+        files_by_msg: Dict[int, List[str]] = {}
+        for message_file in await self.files.all():
+            files_by_msg.setdefault(message_file.msg_id, []).append(message_file.file_link)
+
+        self._rendered = {
+            message.msg_id: render(
+                message.msg_id, message.text, buttons_by_msg.get(message.msg_id, []),
+                files_by_msg.get(message.msg_id, []))
+            for message in await self.messages.all()
+        }
+
+    async def get(self, msg_id: int) -> Optional[RenderedMessage]:
+        '''
+        Rendered message, read from the database only on a cache miss
+        '''
+        rendered = self._rendered.get(msg_id)
+        if rendered is not None:
+            return rendered
+
+        message = await self.messages.get(msg_id)
+        if message is None:
+            return None
+
+        buttons_data = [(button.name, button.link) for button in await self.buttons.for_message(msg_id)]
+        file_links = [message_file.file_link for message_file in await self.files.for_message(msg_id)]
+
+        rendered = self._rendered[msg_id] = render(msg_id, message.text, buttons_data, file_links)
+        return rendered
+
+    def invalidate(self, msg_id: int) -> None:
+        self._rendered.pop(msg_id, None)
+
+    def clear(self) -> None:
+        self._rendered.clear()
+
+    def apply(self, change: Change) -> None:
+        if change.kind in (ChangeKind.MESSAGE_ADDED, ChangeKind.MESSAGE_REMOVED):
+            self.invalidate(change.key)
+        elif change.kind == ChangeKind.MESSAGES_ADDED:
+            for message in change.messages:
+                self.invalidate(message.msg_id)
+        elif change.kind == ChangeKind.MESSAGES_CLEARED:
+            self.clear()
@@ -0,0 +1,349 @@
+import bisect
+import heapq
+import itertools
+import random
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Type
+
+from change_feed import AddedMessage
+
+
+# fraction of a stride each message starts at, spread by the golden ratio
+GOLDEN_RATIO = 0.6180339887498949
+
+
+class Batch(object):
+    '''
+    Messages handed to the cursors in one go. Their stride start offsets
+    are sorted once, on first use, and shared by every cursor.
+    '''
+
+    def __init__(self, rotation: 'MessageRotation', msg_ids: List[int]) -> None:
+        self.rotation = rotation
+        self.ids = msg_ids
+        self._starts: Optional[List[Tuple[float, int]]] = None
+
+    @property
+    def starts(self) -> List[Tuple[float, int]]:
+        if self._starts is None:
+            self._starts = sorted(
+                (self.rotation.stride(msg_id) * (msg_id * GOLDEN_RATIO % 1), msg_id) for msg_id in self.ids)
+        return self._starts
+
+
+class RoundRobin(object):
+    '''
+    A group's messages in id order, continuing after the last one it got
+    '''
+
+    def __init__(self, rotation: 'MessageRotation', group_id: int) -> None:
+        self.rotation = rotation
+        self.group_id = group_id
+
+    def add(self, batch: Batch) -> None:
+        pass
+
+    def remove(self, msg_id: int) -> None:
+        pass
+
+    def next(self, prev_msg_id: Optional[int]) -> Optional[int]:
+        # the position is the previous message itself, found by bisection
+        return self.rotation.following(self.group_id, prev_msg_id)
+
+
+class Weighted(object):
+    '''
+    Stride scheduling: every message comes up in proportion to its weight,
+    the one with the lowest pass value next. Messages start a golden ratio
+    fraction of their stride in, so lighter ones fall between the turns of
+    heavier ones instead of bunching up behind them.
+
+    A batch enters the heap as one stream, holding only its next message
+    in start order, so adding it costs one push.
+    '''
+
+    def __init__(self, rotation: 'MessageRotation', group_id: int) -> None:
+        self.rotation = rotation
+        self.group_id = group_id
+        self._clock = 0.0
+        self._seq = itertools.count()
+        # (pass, seq, msg_id, stream); stream is (base, starts, index) for
+        # messages that haven't come up yet
+        self._heap: List[tuple] = []
+        self._passes: Dict[int, float] = {}
+        self.add(rotation.common_batch())
+        self.add(rotation.own_batch(group_id))
+
+    def _push(self, pass_value: float, msg_id: int, stream: Optional[tuple]) -> None:
+        heapq.heappush(self._heap, (pass_value, next(self._seq), msg_id, stream))
+
+    def add(self, batch: Batch) -> None:
+        if batch.ids:
+            # new messages start from the current pass, without a burst of turns
+            offset, msg_id = batch.starts[0]
+            self._push(self._clock + offset, msg_id, (self._clock, batch.starts, 0))
+
+    def remove(self, msg_id: int) -> None:
+        # its heap entry is skipped once it comes up
+        self._passes.pop(msg_id, None)
+        if len(self._heap) > 2 * len(self._passes) + 64:
+            self._heap = [entry for entry in self._heap
+                          if entry[3] is not None or self._passes.get(entry[2]) == entry[0]]
+            heapq.heapify(self._heap)
+
+    def next(self, prev_msg_id: Optional[int]) -> Optional[int]:
+        while self._heap:
+            pass_value, _, msg_id, stream = heapq.heappop(self._heap)
+            if stream is not None:
+                base, starts, index = stream
+                if index + 1 < len(starts):
+                    offset, following = starts[index + 1]
+                    self._push(base + offset, following, (base, starts, index + 1))
+                if msg_id in self._passes or not self.rotation.receives(self.group_id, msg_id):
+                    continue
+            elif self._passes.get(msg_id) != pass_value:
+                continue
+
+            self._clock = pass_value
+            self._passes[msg_id] = pass_value + self.rotation.stride(msg_id)
+            self._push(self._passes[msg_id], msg_id, None)
+            return msg_id
+        return None
+
+
+class Shuffle(object):
+    '''
+    Random order without repeats: every message once per cycle, drawn at
+    random from the ones still due, and never the same message twice in
+    a row
+    '''
+
+    def __init__(self, rotation: 'MessageRotation', group_id: int) -> None:
+        self.rotation = rotation
+        self.group_id = group_id
+        self.random = rotation.random
+        # messages still due this cycle
+        self._remaining: List[int] = []
+        self._last: Optional[int] = None
+
+    def add(self, batch: Batch) -> None:
+        # batches only hold new messages; they are due in a running cycle too
+        if self._remaining:
+            self._remaining.extend(batch.ids)
+
+    def remove(self, msg_id: int) -> None:
+        # dropped once it is drawn
+        pass
+
+    def next(self, prev_msg_id: Optional[int]) -> Optional[int]:
+        while True:
+            if not self._remaining:
+                self._remaining = self.rotation.messages_for(self.group_id)
+                if not self._remaining:
+                    return None
+
+            index = self.random.randrange(len(self._remaining))
+            if self._remaining[index] == self._last and len(self._remaining) > 1:
+                # the first draw of a cycle mustn't repeat the last one
+                index = (index + 1) % len(self._remaining)
+            self._remaining[index], self._remaining[-1] = self._remaining[-1], self._remaining[index]
+            msg_id = self._remaining.pop()
+
+            if self.rotation.receives(self.group_id, msg_id):
+                self._last = msg_id
+                return msg_id
+
+
+STRATEGIES: Dict[str, Type] = {
+    'round_robin': RoundRobin,
+    'weighted': Weighted,
+    'shuffle': Shuffle,
+}
+
+
+# message rotation
+class MessageRotation(object):
+    '''
+    Which messages every group gets, and in what order.
+
+    Messages without targets go to every group; targeted messages only go
+    to their groups. Both are kept as sorted id lists (one shared, one per
+    group) and every group has a cursor of the configured strategy, so the
+    next message of a group is picked in O(log n) without rescanning the
+    messages. Cursors are built on a group's first pick and kept up to
+    date as messages come and go.
+    '''
+
+    def __init__(self, strategy: str = 'round_robin', seed: Optional[int] = None) -> None:
+        if strategy not in STRATEGIES:
+            raise ValueError(f'unknown rotation {strategy!r}, expected one of {", ".join(STRATEGIES)}')
+        self.strategy = STRATEGIES[strategy]
+        self.random = random.Random(seed)
+
+        self._common: List[int] = []
+        self._own: Dict[int, List[int]] = {}
+        self._targets: Dict[int, Set[int]] = {}
+        self._weights: Dict[int, float] = {}
+        self._cursors: Dict[int, object] = {}
+        self._common_batch: Optional[Batch] = None
+
+    def load(self, msg_ids: Iterable[int], targets: Optional[Dict[int, Iterable[int]]] = None,
+             weights: Optional[Dict[int, float]] = None) -> None:
+        '''
+        Replace the messages; `targets` maps targeted messages to their
+        group ids and `weights` holds the weights other than 1
+        '''
+        targets = targets or {}
+        self._targets = {msg_id: set(group_ids) for msg_id, group_ids in targets.items()}
+        self._common = sorted(set(msg_ids) - self._targets.keys())
+        self._own = {}
+        for msg_id, group_ids in self._targets.items():
+            for group_id in group_ids:
+                self._own.setdefault(group_id, []).append(msg_id)
+        for own in self._own.values():
+            own.sort()
+        self._weights = dict(weights or {})
+        self._cursors.clear()
+        self._common_batch = None
+
+    def has(self, msg_id: int) -> bool:
+        return msg_id in self._targets or _contains(self._common, msg_id)
+
+    def receives(self, group_id: int, msg_id: int) -> bool:
+        if msg_id in self._targets:
+            return group_id in self._targets[msg_id]
+        return _contains(self._common, msg_id)
+
+    def stride(self, msg_id: int) -> float:
+        return 1 / self._weights.get(msg_id, 1.0)
+
+    def common_batch(self) -> Batch:
+        '''
+        The messages for every group, shared by the cursors built until it
+        changes
+        '''
+        if self._common_batch is None:
+            self._common_batch = Batch(self, list(self._common))
+        return self._common_batch
+
+    def own_batch(self, group_id: int) -> Batch:
+        return Batch(self, list(self._own.get(group_id, [])))
+
+    def messages_for(self, group_id: int) -> List[int]:
+        return self._common + self._own.get(group_id, [])
+
+    def following(self, group_id: int, msg_id: Optional[int]) -> Optional[int]:
+        '''
+        Message of `group_id` with the next higher id, wrapping around
+        '''
+        found = None
+        first = None
+        for ids in (self._common, self._own.get(group_id, [])):
+            if not ids:
+                continue
+            first = ids[0] if first is None else min(first, ids[0])
+            if msg_id is not None:
+                index = bisect.bisect_right(ids, msg_id)
+                if index < len(ids):
+                    found = ids[index] if found is None else min(found, ids[index])
+        return found if found is not None else first
+
+    def next(self, group_id: int, msg_id: Optional[int]) -> Optional[int]:
+        '''
+        Message `group_id` gets after `msg_id`, None if it has none
+        '''
+        cursor = self._cursors.get(group_id)
+        if cursor is None:
+            cursor = self._cursors[group_id] = self.strategy(self, group_id)
+        return cursor.next(msg_id)
+
+    # mutations
+    def add(self, msg_id: int, group_ids: Optional[Iterable[int]] = None, weight: float = 1.0) -> None:
+        '''
+        Add a message for every group, or only for `group_ids`
+        '''
+        self.add_many([AddedMessage(msg_id, None if group_ids is None else tuple(group_ids), weight)])
+
+    def add_many(self, messages: Iterable[AddedMessage]) -> None:
+        '''
+        Add messages in one pass: every cursor takes the new messages for
+        all groups as one batch, and targeted groups their own
+        '''
+        common = []
+        own: Dict[int, List[int]] = {}
+        for message in messages:
+            msg_id = message.msg_id
+            if self.has(msg_id):
+                continue
+            if message.weight != 1:
+                self._weights[msg_id] = message.weight
+            if message.group_ids is None:
+                common.append(msg_id)
+            else:
+                self._targets[msg_id] = set(message.group_ids)
+                for group_id in self._targets[msg_id]:
+                    own.setdefault(group_id, []).append(msg_id)
+
+        if common:
+            _insert(self._common, common)
+            self._common_batch = None
+            batch = Batch(self, common)
+            for cursor in self._cursors.values():
+                cursor.add(batch)
+
+        for group_id, msg_ids in own.items():
+            _insert(self._own.setdefault(group_id, []), msg_ids)
+            if group_id in self._cursors:
+                self._cursors[group_id].add(Batch(self, msg_ids))
+
+    def remove(self, msg_id: int) -> None:
+        if msg_id in self._targets:
+            group_ids = self._targets.pop(msg_id)
+            for group_id in group_ids:
+                _discard(self._own[group_id], msg_id)
+            cursors = [self._cursors[group_id] for group_id in group_ids if group_id in self._cursors]
+        elif _contains(self._common, msg_id):
+            _discard(self._common, msg_id)
+            self._common_batch = None
+            cursors = self._cursors.values()
+        else:
+            return
+
+        self._weights.pop(msg_id, None)
+        for cursor in cursors:
+            cursor.remove(msg_id)
+
+    def clear(self) -> None:
+        self.load([])
+
+    def remove_group(self, group_id: int) -> None:
+        # its targeted messages stay targeted, so they don't start going everywhere
+        for msg_id in self._own.pop(group_id, []):
+            self._targets[msg_id].discard(group_id)
+        self._cursors.pop(group_id, None)
+
+
+def _contains(ids: List[int], msg_id: int) -> bool:
+    index = bisect.bisect_left(ids, msg_id)
+    return index < len(ids) and ids[index] == msg_id
+
+
+def _insert(ids: List[int], new_ids: List[int]) -> None:
+    '''
+    Add `new_ids` to the sorted list `ids`. New messages usually have the
+    highest ids, so they are appended; otherwise a few are insorted and
+    many are merged in one pass.
+    '''
+    new_ids = sorted(new_ids)
+    if not ids or ids[-1] < new_ids[0]:
+        ids.extend(new_ids)
+    elif len(new_ids) <= 8:
+        for msg_id in new_ids:
+            bisect.insort(ids, msg_id)
+    else:
+        ids[:] = heapq.merge(ids, new_ids)
+
+
+def _discard(ids: List[int], msg_id: int) -> None:
+    index = bisect.bisect_left(ids, msg_id)
+    if index < len(ids) and ids[index] == msg_id:
+        del ids[index]
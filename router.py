@@ -0,0 +1,90 @@
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, Optional, Tuple
+
+Handler = Callable[[Any], Awaitable[None]]
+
+
+def command_key(text: str) -> str:
+    '''
+    Lookup key of a message: the bare command for "/start@bot args",
+    otherwise the whole stripped text
+    '''
+    text = text.strip()
+    if text.startswith('/'):
+        return text.split(maxsplit=1)[0].split('@', 1)[0]
+    return text
+
+
+# router
+class Router(object):
+    '''
+    Constant-time dispatcher for private messages.
+
+    Keyboard button texts (in every language) and slash commands are
+    looked up in one dictionary; anything else goes to the handler
+    registered for the sender's current chat state. Group messages are
+    dropped and non-admins only reach handlers marked public.
+    `observe` is called with each handler and the seconds it took.
+    '''
+
+    def __init__(self, is_admin: Callable[[int], bool], get_state: Callable[[int], Optional[Hashable]],
+                 observe: Optional[Callable[[Handler, float], None]] = None) -> None:
+        self.is_admin = is_admin
+        self.get_state = get_state
+        self.observe = observe
+        self._commands: Dict[str, Tuple[Handler, bool]] = {}
+        self._states: Dict[Hashable, Handler] = {}
+
+    def command(self, *texts: str, public: bool = False) -> Callable[[Handler], Handler]:
+        '''
+        Register a handler for exact command/button texts
+        '''
+        def register(handler: Handler) -> Handler:
+            for text in texts:
+                self._commands[command_key(text)] = (handler, public)
+            return handler
+        return register
+
+    def state(self, *states: Hashable) -> Callable[[Handler], Handler]:
+        '''
+        Register a handler for messages sent while in one of `states`
+        '''
+        def register(handler: Handler) -> Handler:
+            for state in states:
+                self._states[state] = handler
+            return handler
+        return register
+
+    def resolve(self, sender_id: int, text: str) -> Optional[Handler]:
+        handler, public = self._commands.get(command_key(text), (None, False))
+        is_admin = self.is_admin(sender_id)
+
+        if handler is not None and (public or is_admin):
+            return handler
+        if is_admin:
+            return self._states.get(self.get_state(sender_id))
+        return None
+
+    async def dispatch(self, event) -> None:
+        if event.is_group:
+            return
+
+        handler = self.resolve(event.sender_id, event.raw_text or '')
+        if handler is None:
+            return
+        if self.observe is None:
+            await handler(event)
+            return
+
+        started = time.perf_counter()
+        try:
+            await handler(event)
+        finally:
+            self.observe(handler, time.perf_counter() - started)
+
+
+def translations(texts: Dict[str, Dict[str, str]], key: str) -> Iterable[str]:
+    '''
+    Every language variant of a bot_text entry
+    '''
+    return texts[key].values()
@@ -0,0 +1,276 @@
+import asyncio
+import heapq
+import itertools
+import logging
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from change_feed import Change, ChangeKind
+from rotation import MessageRotation
+
+
+class Job(object):
+    '''
+    Next post due for one group
+    '''
+    __slots__ = ('fire_time', 'seq', 'group_id', 'msg_id', 'base_time', 'prev_msg_id')
+
+    def __init__(self, fire_time: float, seq: int, group_id: int, msg_id: int,
+                 base_time: float, prev_msg_id: Optional[int]) -> None:
+        self.fire_time = fire_time
+        self.seq = seq
+        self.group_id = group_id
+        self.msg_id = msg_id
+        self.base_time = base_time
+        self.prev_msg_id = prev_msg_id
+
+    def __lt__(self, other: 'Job') -> bool:
+        return (self.fire_time, self.seq) < (other.fire_time, other.seq)
+
+
+# scheduler
+class Scheduler(object):
+    '''
+    Heap-based posting scheduler.
+
+    Every group has exactly one pending job, (next_fire_time, group,
+    message), in a priority queue. A single task sleeps until the earliest
+    job is due, hands all due jobs for the same message to `dispatch` as
+    one batch, and queues each group's next message, picked by
+    `rotation`, once its batch is done. The delay after a message comes from the per-message interval,
+    then the per-group interval, then the global default, and interval
+    changes re-time every queued job immediately.
+
+    Message and group mutations arrive through `apply` and are folded into
+    the running schedule without restarting it.
+    '''
+
+    def __init__(self, dispatch: Callable[[int, List[int]], Awaitable[None]],
+                 default_interval: Callable[[], float], rotation: Optional[MessageRotation] = None) -> None:
+        self.dispatch = dispatch
+        self.default_interval = default_interval
+        self.rotation = rotation if rotation is not None else MessageRotation()
+        self.group_intervals: Dict[int, float] = {}
+        self.message_intervals: Dict[int, float] = {}
+
+        self._heap: List[Job] = []
+        self._jobs: Dict[int, Job] = {}
+        self._groups: Set[int] = set()
+        self._inflight: Set[int] = set()
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._running = False
+        # set by stop, also before run starts; cleared by a new schedule
+        # or once run has returned
+        self._stopped = False
+        self._generation = 0
+        self._batches: set = set()
+
+    # messages and groups
+    def load(self, msg_ids: Iterable[int], group_ids: Iterable[int],
+             resume: Optional[Dict[int, Tuple[int, bool, float]]] = None,
+             targets: Optional[Dict[int, Iterable[int]]] = None, weights: Optional[Dict[int, float]] = None) -> None:
+        '''
+        Replace the schedule. Groups in `resume`, given as
+        {group_id: (msg_id, delivered, seconds ago)}, pick up where they
+        left off; every other group starts at its first message now.
+        `targets` and `weights` go to the rotation.
+        '''
+        self.rotation.load(msg_ids, targets, weights)
+        self._groups = set(group_ids)
+        self._heap.clear()
+        self._jobs.clear()
+        self._inflight.clear()
+        self._stopped = False
+        # batches still in flight belong to the old schedule
+        self._generation += 1
+
+        if resume:
+            now = asyncio.get_running_loop().time()
+            for group_id, (msg_id, delivered, elapsed) in resume.items():
+                if group_id not in self._groups:
+                    continue
+                if delivered:
+                    next_msg_id = self.next_message(group_id, msg_id)
+                    if next_msg_id is not None:
+                        self._push(group_id, next_msg_id, base_time=now - elapsed, prev_msg_id=msg_id)
+                elif self.rotation.receives(group_id, msg_id):
+                    self._push(group_id, msg_id, base_time=now, prev_msg_id=None)
+
+        self._start_idle_groups()
+
+    def _start_idle_groups(self) -> None:
+        '''
+        Queue the first message for groups that have no pending job
+        '''
+        now = asyncio.get_running_loop().time()
+        for group_id in self._groups:
+            if group_id not in self._jobs and group_id not in self._inflight:
+                msg_id = self.next_message(group_id, None)
+                if msg_id is not None:
+                    self._push(group_id, msg_id, base_time=now, prev_msg_id=None)
+        self._wakeup.set()
+
+    def apply(self, change: Change) -> None:
+        '''
+        Fold a change feed entry into the schedule
+        '''
+        if change.kind == ChangeKind.MESSAGE_ADDED:
+            self.rotation.add(change.key)
+            self._start_idle_groups()
+
+        elif change.kind == ChangeKind.MESSAGES_ADDED:
+            # no queued job follows a new message yet, so nothing to re-time
+            for message in change.messages:
+                if message.interval is not None:
+                    self.message_intervals[message.msg_id] = message.interval
+            # one pass over the cursors and idle groups for the whole batch
+            self.rotation.add_many(change.messages)
+            self._start_idle_groups()
+
+        elif change.kind == ChangeKind.MESSAGE_REMOVED:
+            # jobs still pointing at it move on to the next message when due
+            self.rotation.remove(change.key)
+            self.message_intervals.pop(change.key, None)
+
+        elif change.kind == ChangeKind.MESSAGES_CLEARED:
+            self.rotation.clear()
+            self.message_intervals.clear()
+
+        elif change.kind == ChangeKind.GROUP_ADDED:
+            self._groups.add(change.key)
+            self._start_idle_groups()
+
+        elif change.kind == ChangeKind.GROUP_REMOVED:
+            self._groups.discard(change.key)
+            self.rotation.remove_group(change.key)
+            self.group_intervals.pop(change.key, None)
+            # the heap entry is skipped lazily once it comes due
+            self._jobs.pop(change.key, None)
+
+    def next_message(self, group_id: int, msg_id: Optional[int]) -> Optional[int]:
+        '''
+        Message that follows `msg_id` in the group's rotation
+        '''
+        return self.rotation.next(group_id, msg_id)
+
+    # intervals
+    def interval_for(self, group_id: int, msg_id: Optional[int]) -> float:
+        if msg_id is None:
+            return 0
+        if msg_id in self.message_intervals:
+            return self.message_intervals[msg_id]
+        if group_id in self.group_intervals:
+            return self.group_intervals[group_id]
+        return self.default_interval()
+
+    def set_group_interval(self, group_id: int, seconds: Optional[float]) -> None:
+        if seconds is None:
+            self.group_intervals.pop(group_id, None)
+        else:
+            self.group_intervals[group_id] = seconds
+        self.reschedule()
+
+    def set_message_interval(self, msg_id: int, seconds: Optional[float]) -> None:
+        if seconds is None:
+            self.message_intervals.pop(msg_id, None)
+        else:
+            self.message_intervals[msg_id] = seconds
+        self.reschedule()
+
+    def reschedule(self) -> None:
+        '''
+        Re-time all queued jobs after an interval change
+        '''
+        for job in self._jobs.values():
+            job.fire_time = job.base_time + self.interval_for(job.group_id, job.prev_msg_id)
+        self._heap = list(self._jobs.values())
+        heapq.heapify(self._heap)
+        self._wakeup.set()
+
+    # queue
+    def _push(self, group_id: int, msg_id: int, base_time: float, prev_msg_id: Optional[int]) -> None:
+        fire_time = base_time + self.interval_for(group_id, prev_msg_id)
+        job = Job(fire_time, next(self._seq), group_id, msg_id, base_time, prev_msg_id)
+        self._jobs[group_id] = job
+        heapq.heappush(self._heap, job)
+
+    def _pop_due(self, now: float) -> Dict[int, List[Job]]:
+        due: Dict[int, List[Job]] = {}
+        while self._heap and self._heap[0].fire_time <= now:
+            job = heapq.heappop(self._heap)
+            if self._jobs.get(job.group_id) is not job:
+                continue
+            del self._jobs[job.group_id]
+
+            if not self.rotation.receives(job.group_id, job.msg_id):
+                # the message was removed while queued
+                job.msg_id = self.next_message(job.group_id, job.msg_id)
+                if job.msg_id is None:
+                    continue
+
+            self._inflight.add(job.group_id)
+            due.setdefault(job.msg_id, []).append(job)
+        return due
+
+    async def _run_batch(self, msg_id: int, jobs: List[Job]) -> None:
+        generation = self._generation
+        try:
+            await self.dispatch(msg_id, [job.group_id for job in jobs])
+        except Exception:
+            logging.exception('Posting batch for message %s failed', msg_id)
+        finally:
+            if generation == self._generation:
+                for job in jobs:
+                    self._inflight.discard(job.group_id)
+                    if not self._running or job.group_id not in self._groups:
+                        continue
+                    next_msg_id = self.next_message(job.group_id, msg_id)
+                    if next_msg_id is not None:
+                        self._push(job.group_id, next_msg_id, job.fire_time, msg_id)
+                self._wakeup.set()
+
+    @property
+    def pending(self) -> int:
+        '''
+        Groups waiting for their next post
+        '''
+        return len(self._jobs)
+
+    @property
+    def inflight(self) -> int:
+        '''
+        Groups with a post being sent right now
+        '''
+        return len(self._inflight)
+
+    # run loop
+    async def run(self) -> None:
+        '''
+        Fire jobs as they come due until `stop` is called, returning at once
+        if it was called after the last `load`
+        '''
+        loop = asyncio.get_running_loop()
+        if self._stopped:
+            self._stopped = False
+            return
+        self._running = True
+
+        while self._running:
+            now = loop.time()
+            for msg_id, jobs in self._pop_due(now).items():
+                batch = loop.create_task(self._run_batch(msg_id, jobs))
+                self._batches.add(batch)
+                batch.add_done_callback(self._batches.discard)
+
+            self._wakeup.clear()
+            timeout = self._heap[0].fire_time - now if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        self._stopped = False
+
+    def stop(self) -> None:
+        self._running = False
+        self._stopped = True
+        self._wakeup.set()
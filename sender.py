@@ -0,0 +1,80 @@
+import asyncio
+import time
+import traceback
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, NamedTuple, Optional
+
+
+class SendResult(NamedTuple):
+    '''
+    Outcome of a single group delivery
+    '''
+    group_id: int
+    ok: bool
+    error: Optional[BaseException] = None
+    traceback: Optional[str] = None
+    elapsed: float = 0.0
+
+
+# fan-out sender
+class FanOutSender(object):
+    '''
+    Sends one payload to many groups at once.
+
+    At most `max_parallel` requests are in flight at any moment and
+    deliveries to the same chat always go out in the order they were
+    submitted, so a slow or failing group never holds up the others.
+    `acquire`, e.g. a rate limiter, is awaited before a delivery takes a
+    parallelism slot, so a chat waiting for its turn doesn't hold one.
+    `observe` is called with the result of every delivery.
+    '''
+
+    def __init__(self, send: Callable[[int, Any], Awaitable[Any]], max_parallel: int = 8,
+                 observe: Optional[Callable[[SendResult], None]] = None,
+                 acquire: Optional[Callable[[int], Awaitable[None]]] = None) -> None:
+        self.send = send
+        self.observe = observe
+        self.acquire = acquire
+        self.max_parallel = max(1, max_parallel)
+        self._semaphore = asyncio.Semaphore(self.max_parallel)
+        # group id -> [lock, number of deliveries holding or waiting for it]
+        self._chat_locks: Dict[int, list] = {}
+
+    async def _deliver(self, group_id: int, payload: Any) -> SendResult:
+        entry = self._chat_locks.get(group_id)
+        if entry is None:
+            entry = self._chat_locks[group_id] = [asyncio.Lock(), 0]
+        lock = entry[0]
+        entry[1] += 1
+        try:
+            # take the chat lock before a parallelism slot, so that waiting
+            # for an earlier post to the same chat doesn't block other chats
+            async with lock:
+                started = time.perf_counter()
+                try:
+                    if self.acquire is not None:
+                        await self.acquire(group_id)
+                    async with self._semaphore:
+                        started = time.perf_counter()
+                        await self.send(group_id, payload)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    result = SendResult(
+                        group_id, False, e, traceback.format_exc(), time.perf_counter() - started)
+                else:
+                    result = SendResult(group_id, True, elapsed=time.perf_counter() - started)
+
+            if self.observe is not None:
+                self.observe(result)
+            return result
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._chat_locks[group_id]
+
+    async def fan_out(self, payload: Any, group_ids: Iterable[int]) -> List[SendResult]:
+        '''
+        Deliver `payload` to every group and return the per-group results
+        in the same order as `group_ids`
+        '''
+        return await asyncio.gather(*[self._deliver(group_id, payload) for group_id in group_ids])
@@ -0,0 +1,146 @@
+import json
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional
+
+from database import Database
+
+
+class Session(object):
+    '''
+    Conversation state of one admin: the chat state and the data of a
+    half-finished flow
+    '''
+    __slots__ = ('user_id', 'state', 'data', 'touched')
+
+    def __init__(self, user_id: int, state: Hashable, data: Dict[str, Any], touched: float) -> None:
+        self.user_id = user_id
+        self.state = state
+        self.data = data
+        self.touched = touched
+
+
+# session store
+class SessionStore(object):
+    '''
+    Bounded store of conversation sessions.
+
+    Sessions are kept in least recently used order; the oldest are
+    evicted once there are more than `max_sessions`, and a session not
+    touched for `ttl` seconds expires. With a database, every change is
+    written to the `sessions` table so flows survive a restart. States
+    are persisted by their attribute name on the `states` class.
+    '''
+
+    def __init__(self, states: type, max_sessions: int = 1000, ttl: float = 86400,
+                 database: Optional[Database] = None) -> None:
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.database = database
+        self._names = {name: value for name, value in vars(states).items() if not name.startswith('_')}
+        self._states = {value: name for name, value in self._names.items()}
+        self._sessions: 'OrderedDict[int, Session]' = OrderedDict()
+        # sessions dropped in memory whose rows haven't been deleted yet
+        self._dropped: List[int] = []
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    async def load(self) -> None:
+        if self.database is None:
+            return
+
+        expired_before = time.time() - self.ttl
+        await self.database.execute('DELETE FROM sessions WHERE touched<?', (expired_before, ))
+        rows = await self.database.fetchall(
+            'SELECT user_id, state, data, touched FROM sessions ORDER BY touched DESC LIMIT ?',
+            (self.max_sessions, ))
+
+        for user_id, state, data, touched in reversed(rows):
+            if state in self._names:
+                self._sessions[user_id] = Session(user_id, self._names[state], json.loads(data), touched)
+        await self.database.execute(
+            'DELETE FROM sessions WHERE user_id NOT IN (SELECT user_id FROM sessions '
+            'ORDER BY touched DESC LIMIT ?)', (self.max_sessions, ))
+
+    def get(self, user_id: int) -> Optional[Session]:
+        session = self._sessions.get(user_id)
+        if session is None:
+            return None
+        if session.touched < time.time() - self.ttl:
+            del self._sessions[user_id]
+            self._dropped.append(user_id)
+            return None
+        return session
+
+    def state(self, user_id: int) -> Optional[Hashable]:
+        session = self.get(user_id)
+        return session.state if session is not None else None
+
+    def data(self, user_id: int) -> Dict[str, Any]:
+        session = self.get(user_id)
+        return session.data if session is not None else {}
+
+    async def begin(self, user_id: int, state: Hashable, **data: Any) -> Session:
+        '''
+        Start a new flow, discarding the data of the previous one
+        '''
+        self._sessions.pop(user_id, None)
+        return await self.set_state(user_id, state, **data)
+
+    async def set_state(self, user_id: int, state: Hashable, **data: Any) -> Session:
+        '''
+        Move to `state`, merging `data` into the session data
+        '''
+        session = self.get(user_id)
+        if session is None:
+            session = Session(user_id, state, {}, 0)
+            self._sessions[user_id] = session
+
+        session.state = state
+        session.data.update(data)
+        session.touched = time.time()
+        self._sessions.move_to_end(user_id)
+        self._evict(session.touched)
+
+        await self._flush(session)
+        return session
+
+    async def end(self, user_id: int) -> None:
+        '''
+        Finish the flow and forget the session
+        '''
+        if self._sessions.pop(user_id, None) is not None:
+            self._dropped.append(user_id)
+        await self._flush()
+
+    def _evict(self, now: float) -> None:
+        # least recently used first, so expired sessions are at the front
+        while self._sessions:
+            user_id, oldest = next(iter(self._sessions.items()))
+            if len(self._sessions) <= self.max_sessions and oldest.touched >= now - self.ttl:
+                break
+            self._sessions.popitem(last=False)
+            self._dropped.append(user_id)
+
+    async def _flush(self, session: Optional[Session] = None) -> None:
+        if self.database is None:
+            self._dropped.clear()
+            return
+        if session is None and not self._dropped:
+            return
+
+        dropped, self._dropped = self._dropped, []
+        row = None
+        if session is not None:
+            row = (session.user_id, self._states[session.state], json.dumps(session.data), session.touched)
+
+        def write(conn: sqlite3.Connection) -> None:
+            if dropped:
+                conn.executemany('DELETE FROM sessions WHERE user_id=?', [(user_id, ) for user_id in dropped])
+            if row is not None:
+                conn.execute('INSERT OR REPLACE INTO sessions VALUES(?, ?, ?, ?)', row)
+
+        await self.database.transaction(write)
+
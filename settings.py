@@ -0,0 +1,21 @@
+import json
+from typing import Any
+
+from database import Database
+
+
+# persisted settings
+class Settings(object):
+    '''
+    Small key/value store for settings that must survive a restart
+    '''
+
+    def __init__(self, database: Database) -> None:
+        self.database = database
+
+    async def get(self, key: str, default: Any = None) -> Any:
+        row = await self.database.fetchone('SELECT value FROM settings WHERE key=?', (key, ))
+        return json.loads(row[0]) if row is not None else default
+
+    async def set(self, key: str, value: Any) -> None:
+        await self.database.execute('INSERT OR REPLACE INTO settings VALUES(?, ?)', (key, json.dumps(value)))
@@ -0,0 +1,162 @@
+import bisect
+import hashlib
+import sqlite3
+from typing import Dict, Iterable, Iterator, List, Optional, Set
+
+from change_feed import Change, ChangeKind
+from database import Database, ShardMemberRepository
+from media_cache import MediaCache
+from peer_cache import PeerCache
+from rate_limiter import RateLimiter
+
+# shard of the bot from `bot_token`, the one that also serves the admins
+MAIN_SHARD = 'main'
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing(object):
+    '''
+    Consistent hash ring with `replicas` virtual nodes per shard, so adding
+    or removing a shard only moves the groups next to it on the ring
+    '''
+
+    def __init__(self, shards: Iterable[str], replicas: int = 64) -> None:
+        points = sorted((_hash(f'{shard}#{replica}'), shard) for shard in shards for replica in range(replicas))
+        self._hashes = [point for point, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    def walk(self, key: str) -> Iterator[str]:
+        '''
+        Distinct shards in ring order, starting at the position of `key`
+        '''
+        if not self._hashes:
+            return
+        start = bisect.bisect(self._hashes, _hash(key))
+        seen: Set[str] = set()
+        for i in range(len(self._shards)):
+            shard = self._shards[(start + i) % len(self._shards)]
+            if shard not in seen:
+                seen.add(shard)
+                yield shard
+
+    def owner(self, key: str, eligible: Optional[Set[str]] = None) -> Optional[str]:
+        for shard in self.walk(key):
+            if eligible is None or shard in eligible:
+                return shard
+        return None
+
+
+class Shard(object):
+    '''
+    One bot account with its own client, peer and media caches, rate
+    limits and sender. Access hashes and file references only work for the
+    account that received them, so none of these are shared.
+    '''
+
+    def __init__(self, name: str, bot_token: str, database: Database) -> None:
+        self.name = name
+        self.bot_token = bot_token
+        # the token starts with the bot's user id
+        self.bot_id = int(bot_token.split(':', 1)[0])
+        self.client = None
+        self.members = ShardMemberRepository(database, name)
+        self.peer_cache = PeerCache(members=self.members)
+        self.media_cache = MediaCache(database=database, shard=name)
+        self.rate_limiter = RateLimiter()
+        self.sender = None
+
+    async def load(self) -> None:
+        await self.peer_cache.load()
+        await self.media_cache.load()
+
+
+# shards
+class ShardSet(object):
+    '''
+    Spreads groups over the configured bot accounts.
+
+    A group can only be posted to by bots that are members of it, so each
+    group is owned by the first member shard on the hash ring. Owners are
+    kept in `group_shards`, where other processes sharing the database
+    can read them.
+    '''
+
+    def __init__(self, database: Database, shards: List[Shard]) -> None:
+        self.database = database
+        self.shards: Dict[str, Shard] = {shard.name: shard for shard in shards}
+        self.ring = HashRing(self.shards)
+        self._members: Dict[int, Set[str]] = {}
+        self._owners: Dict[int, str] = {}
+
+    def __iter__(self) -> Iterator[Shard]:
+        return iter(self.shards.values())
+
+    @property
+    def main(self) -> Shard:
+        return self.shards[MAIN_SHARD]
+
+    async def load(self) -> None:
+        '''
+        Read memberships and reassign groups whose owner changed, e.g.
+        after a shard was added to or removed from the config
+        '''
+        self._members = {}
+        for row in await self.database.fetchall('SELECT group_id, shard FROM shard_members'):
+            self._members.setdefault(row[0], set()).add(row[1])
+        self._owners = {
+            row[0]: row[1] for row in await self.database.fetchall('SELECT group_id, shard FROM group_shards')
+        }
+        await self._assign(list(self._members))
+
+    def owner(self, group_id: int) -> Optional[Shard]:
+        name = self._owners.get(group_id)
+        return self.shards.get(name) if name is not None else None
+
+    async def join(self, group_id: int, shard: Shard) -> None:
+        '''
+        Record that a shard's bot was added to a group
+        '''
+        await shard.members.add(group_id)
+        self._members.setdefault(group_id, set()).add(shard.name)
+        await self._assign([group_id])
+
+    async def leave(self, group_id: int, shard: Shard) -> bool:
+        '''
+        Record that a shard's bot left a group. Returns whether any of the
+        bots is still a member.
+        '''
+        await shard.members.remove(group_id)
+        await shard.peer_cache.forget(group_id)
+        members = self._members.get(group_id, set())
+        members.discard(shard.name)
+        if not members:
+            self._members.pop(group_id, None)
+            self._owners.pop(group_id, None)
+            return False
+        await self._assign([group_id])
+        return True
+
+    async def _assign(self, group_ids: List[int]) -> None:
+        changed = []
+        for group_id in group_ids:
+            owner = self.ring.owner(str(group_id), self._members.get(group_id, set()) & set(self.shards))
+            if owner is None:
+                continue
+            if self._owners.get(group_id) != owner:
+                self._owners[group_id] = owner
+                changed.append((group_id, owner))
+
+        if changed:
+            def save(conn: sqlite3.Connection) -> None:
+                conn.executemany('INSERT OR REPLACE INTO group_shards(group_id, shard) VALUES(?, ?)', changed)
+
+            await self.database.transaction(save)
+
+    def apply(self, change: Change) -> None:
+        # memberships and owners of removed groups cascade in the database
+        if change.kind == ChangeKind.GROUP_REMOVED:
+            self._members.pop(change.key, None)
+            self._owners.pop(change.key, None)
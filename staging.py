@@ -0,0 +1,84 @@
+import asyncio
+import json
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from change_feed import Change, ChangeKind
+from database import Database
+
+
+class StagingError(Exception):
+    '''
+    Posting to or forwarding from the staging channel failed, which is
+    not the fault of the group being posted to
+    '''
+
+    def __init__(self, error: BaseException) -> None:
+        self.error = error
+        super().__init__(f'staging channel: {type(error).__name__}: {error}')
+
+
+# staging channel
+class StagingChannel(object):
+    '''
+    Forward mode: every message is posted once to a private staging
+    channel, and groups receive a server-side copy of that post
+    (`forward_messages` with `drop_author`) instead of their own upload.
+
+    The ids of each staged post are kept in `staged_messages`; rows go
+    away with their message, and rows staged in another channel are
+    dropped when the configured channel changes.
+    '''
+
+    def __init__(self, database: Database, channel_id: Optional[int]) -> None:
+        self.database = database
+        self.channel_id = channel_id
+        self._staged: Dict[int, List[int]] = {}
+        self._locks: Dict[int, asyncio.Lock] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.channel_id is not None
+
+    async def load(self) -> None:
+        if not self.enabled:
+            return
+
+        await self.database.execute('DELETE FROM staged_messages WHERE channel_id<>?', (self.channel_id, ))
+        rows = await self.database.fetchall('SELECT msg_id, message_ids FROM staged_messages')
+        self._staged = {row[0]: json.loads(row[1]) for row in rows}
+
+    async def stage(self, msg_id: int, post: Callable[[], Awaitable[list]]) -> List[int]:
+        '''
+        Channel message ids of the staged copy of `msg_id`, calling `post`
+        to post it to the channel the first time
+        '''
+        message_ids = self._staged.get(msg_id)
+        if message_ids is not None:
+            return message_ids
+
+        lock = self._locks.get(msg_id)
+        if lock is None:
+            lock = self._locks[msg_id] = asyncio.Lock()
+
+        async with lock:
+            message_ids = self._staged.get(msg_id)
+            if message_ids is None:
+                message_ids = [message.id for message in await post()]
+                await self.database.execute(
+                    'INSERT OR REPLACE INTO staged_messages VALUES(?, ?, ?)',
+                    (msg_id, self.channel_id, json.dumps(message_ids)))
+                self._staged[msg_id] = message_ids
+
+        self._locks.pop(msg_id, None)
+        return message_ids
+
+    async def unstage(self, msg_id: int) -> None:
+        self._staged.pop(msg_id, None)
+        await self.database.execute('DELETE FROM staged_messages WHERE msg_id=?', (msg_id, ))
+
+    def apply(self, change: Change) -> None:
+        # the rows themselves are removed by ON DELETE CASCADE
+        if change.kind == ChangeKind.MESSAGE_REMOVED:
+            self._staged.pop(change.key, None)
+        elif change.kind == ChangeKind.MESSAGES_CLEARED:
+            self._staged.clear()
@@ -0,0 +1,142 @@
+import asyncio
+import time
+
+import pytest
+from telethon import errors
+
+from change_feed import Change, ChangeKind
+from database import Database
+from group_health import GroupHealth
+from migrations import migrate
+from sender import SendResult
+
+
+def ok(group_id: int) -> SendResult:
+    return SendResult(group_id, True)
+
+
+def failed(group_id: int, error: BaseException) -> SendResult:
+    return SendResult(group_id, False, error)
+
+
+def kicked() -> BaseException:
+    return errors.ChatWriteForbiddenError(request=None)
+
+
+async def new_health(group_ids=(1, 2, 3), **kwargs) -> GroupHealth:
+    database = Database(':memory:')
+    await database.run(migrate)
+    await database.executemany('INSERT INTO groups(id) VALUES(?)', [(group_id, ) for group_id in group_ids])
+    health = GroupHealth(database, **kwargs)
+    await health.load()
+    return health
+
+
+def test_failures_back_off_exponentially():
+    async def run():
+        health = await new_health(base_backoff=60, max_backoff=200)
+        retry_after = []
+        for _ in range(4):
+            before = time.time()
+            await health.record([failed(1, ValueError('bad request'))])
+            retry_after.append(health._states[1].retry_at - before)
+
+        assert retry_after == [pytest.approx(delay, abs=1) for delay in (60, 120, 200, 200)]
+        now = time.time()
+        assert not health.available(1, now)
+        assert health.available(1, now + 201)
+        assert health.available(2, now)
+
+    asyncio.run(run())
+
+
+def test_transient_errors_do_not_count():
+    async def run():
+        health = await new_health()
+        await health.record([
+            failed(1, errors.FloodWaitError(request=None, capture=5)),
+            failed(2, asyncio.TimeoutError()),
+        ])
+
+        assert health.unhealthy() == []
+
+    asyncio.run(run())
+
+
+def test_hard_failures_in_a_row_quarantine_a_group():
+    async def run():
+        health = await new_health(quarantine_after=3)
+        assert await health.record([failed(1, kicked())]) == []
+        # another kind of failure breaks the run of hard ones
+        await health.record([failed(1, ValueError('bad request'))])
+        await health.record([failed(1, kicked())])
+        await health.record([failed(1, kicked())])
+        assert not health._states[1].quarantined
+
+        quarantined = await health.record([failed(1, kicked())])
+        assert [state.group_id for state in quarantined] == [1]
+        assert quarantined[0].last_error == 'ChatWriteForbiddenError'
+        assert not health.available(1, time.time() + 10 ** 9)
+
+        # reported only when it happens
+        assert await health.record([failed(1, kicked())]) == []
+
+    asyncio.run(run())
+
+
+def test_success_and_reset_recover_a_group():
+    async def run():
+        health = await new_health(quarantine_after=1)
+        await health.record([failed(1, kicked()), failed(2, ValueError('bad request'))])
+
+        await health.record([ok(2)])
+        await health.reset(1)
+
+        assert health.available(1) and health.available(2)
+        assert health.unhealthy() == []
+        assert await health.database.fetchall('SELECT group_id FROM group_health WHERE failures>0') == []
+
+    asyncio.run(run())
+
+
+def test_unhealthy_lists_quarantined_groups_first():
+    async def run():
+        health = await new_health(quarantine_after=1)
+        for _ in range(3):
+            await health.record([failed(1, ValueError('bad request'))])
+        await health.record([failed(2, ValueError('bad request'))])
+        await health.record([failed(3, kicked())])
+
+        assert [state.group_id for state in health.unhealthy()] == [3, 1, 2]
+
+    asyncio.run(run())
+
+
+def test_health_survives_a_restart():
+    async def run():
+        health = await new_health(quarantine_after=1)
+        await health.record([failed(1, kicked()), failed(2, ValueError('bad request'))])
+
+        restarted = GroupHealth(health.database, quarantine_after=1)
+        await restarted.load()
+
+        assert restarted.unhealthy() == health.unhealthy()
+
+    asyncio.run(run())
+
+
+def test_removed_groups_are_forgotten():
+    async def run():
+        health = await new_health(group_ids=(1, ))
+        await health.record([failed(1, kicked())])
+
+        await health.database.execute('DELETE FROM groups WHERE id=1')
+        health.apply(Change(1, ChangeKind.GROUP_REMOVED, 1))
+        # a batch still in flight doesn't bring it back
+        await health.record([failed(1, kicked())])
+
+        restarted = GroupHealth(health.database)
+        await restarted.load()
+        assert restarted.unhealthy() == []
+
+    asyncio.run(run())
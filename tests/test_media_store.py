@@ -0,0 +1,138 @@
+import asyncio
+import hashlib
+import os
+
+import pytest
+
+from database import Database
+from media_store import MediaStore, file_sha256, thumbnail_path
+from migrations import migrate
+
+
+def write(path, content: bytes) -> str:
+    os.makedirs(os.path.dirname(str(path)), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+    return str(path)
+
+
+async def new_store(tmp_path) -> MediaStore:
+    database = Database(':memory:')
+    await database.run(migrate)
+    await database.execute("INSERT INTO messages(msg_id, text) VALUES(1, 'with files')")
+    return MediaStore(database=database, folder=str(tmp_path / 'files'))
+
+
+async def refcount(store: MediaStore, path: str) -> int:
+    return (await store.database.fetchone('SELECT refcount FROM media_blobs WHERE path=?', (path, )))[0]
+
+
+async def link(store: MediaStore, file_link: str) -> None:
+    await store.database.execute('INSERT INTO message_files(file_link, msg_id) VALUES(?, 1)', (file_link, ))
+
+
+def test_file_sha256_reads_in_chunks(tmp_path):
+    content = os.urandom(3 * (1 << 20) + 5)
+    path = write(tmp_path / 'big.bin', content)
+
+    assert file_sha256(path) == hashlib.sha256(content).hexdigest()
+
+
+def test_same_content_is_stored_once(tmp_path):
+    async def run():
+        store = await new_store(tmp_path)
+        first = await store.add(write(tmp_path / 'upload' / 'a.JPG', b'photo'))
+        second = await store.add(write(tmp_path / 'upload' / 'b.jpg', b'photo'))
+        other = await store.add(write(tmp_path / 'upload' / 'c.jpg', b'other photo'))
+
+        sha256 = hashlib.sha256(b'photo').hexdigest()
+        assert first == second == os.path.join(store.folder, sha256[:2], sha256 + '.jpg')
+        assert other != first
+        assert os.listdir(tmp_path / 'upload') == []
+        assert await store.disk_usage() == (2, len(b'photo') + len(b'other photo'))
+
+    asyncio.run(run())
+
+
+def test_same_content_under_another_extension(tmp_path):
+    async def run():
+        store = await new_store(tmp_path)
+        first = await store.add(write(tmp_path / 'upload' / 'a.jpg', b'photo'))
+        second = await store.add(write(tmp_path / 'upload' / 'a.jpeg', b'photo'))
+
+        assert second == first
+        assert sorted(os.listdir(os.path.dirname(first))) == [os.path.basename(first)]
+
+    asyncio.run(run())
+
+
+def test_triggers_count_references(tmp_path):
+    async def run():
+        store = await new_store(tmp_path)
+        path = await store.add(write(tmp_path / 'upload' / 'a.jpg', b'photo'))
+        other = await store.add(write(tmp_path / 'upload' / 'b.jpg', b'other photo'))
+
+        await link(store, path)
+        await link(store, path)
+        assert await refcount(store, path) == 2
+
+        await store.database.execute(
+            'UPDATE message_files SET file_link=? WHERE id=(SELECT MIN(id) FROM message_files)', (other, ))
+        assert (await refcount(store, path), await refcount(store, other)) == (1, 1)
+
+        # deleting the message drops its files through the cascade
+        await store.database.execute('DELETE FROM messages WHERE msg_id=1')
+        assert (await refcount(store, path), await refcount(store, other)) == (0, 0)
+
+    asyncio.run(run())
+
+
+def test_garbage_collection_waits_for_the_grace_period(tmp_path):
+    async def run():
+        store = await new_store(tmp_path)
+        kept = await store.add(write(tmp_path / 'upload' / 'a.jpg', b'photo'))
+        unused = await store.add(write(tmp_path / 'upload' / 'b.jpg', b'other photo'))
+        write(thumbnail_path(unused), b'thumb')
+        await link(store, kept)
+
+        assert await store.collect_garbage(grace=60) == []
+
+        await store.database.execute('UPDATE media_blobs SET touched_at=touched_at-120')
+        assert await store.collect_garbage(grace=60) == [unused]
+        assert os.path.exists(kept)
+        assert not os.path.exists(unused) and not os.path.exists(thumbnail_path(unused))
+        assert await store.disk_usage() == (1, len(b'photo'))
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize('file_link', [
+    'files/legacy.jpg',
+    '{home}/./files/legacy.jpg',
+    '/another/home/files/legacy.jpg',
+])
+def test_legacy_files_are_adopted(tmp_path, file_link):
+    async def run():
+        store = await new_store(tmp_path)
+        legacy = write(tmp_path / 'files' / 'legacy.jpg', b'legacy photo')
+        unreferenced = write(tmp_path / 'files' / 'unused.jpg', b'unused photo')
+        stored_link = file_link.format(home=tmp_path)
+        await link(store, stored_link)
+        await store.database.execute(
+            "INSERT INTO media_cache(shard, file_link, kind) VALUES('main', ?, 'photo')", (stored_link, ))
+
+        await store.adopt_legacy_files()
+
+        sha256 = hashlib.sha256(b'legacy photo').hexdigest()
+        stored_path = os.path.join(store.folder, sha256[:2], sha256 + '.jpg')
+        assert [row[0] for row in await store.database.fetchall('SELECT file_link FROM message_files')] == [
+            stored_path]
+        assert [row[0] for row in await store.database.fetchall('SELECT file_link FROM media_cache')] == [
+            stored_path]
+        assert await refcount(store, stored_path) == 1
+        assert not os.path.exists(legacy)
+        # files nothing refers to are kept aside, not deleted
+        assert not os.path.exists(unreferenced)
+        assert os.listdir(tmp_path / 'files' / '.unreferenced') == ['unused.jpg']
+
+    asyncio.run(run())
@@ -0,0 +1,131 @@
+import io
+import json
+
+import pytest
+
+from message_import import ImportFormatError, MAX_ALBUM_FILES, iter_raw_messages, parse_message_file, validate_message
+
+LIBRARY = {
+    'version': 2,
+    'meta': {'note': 'ignored', 'list': [1, 2.5e3, None, True]},
+    'messages': [
+        {'text': ['Plain line', 'café ☕ \U0001F680'], 'file': 'files/a.jpg'},
+        {'text': ['Escapes: \\ " \n \t \u0001 /'], 'buttons': [{'name': 'Site', 'link': 'https://a.example'}]},
+        {'text': ['Numbers'], 'weight': 12345.678, 'interval': 0, 'groups': [-1001234567890, '@group']},
+    ],
+    'trailer': 'x' * 100,
+}
+
+
+class CountingReader(io.StringIO):
+    '''
+    StringIO that counts the reads the parser makes
+    '''
+    reads = 0
+
+    def read(self, size=-1):
+        self.reads += 1
+        return super().read(size)
+
+
+def raw_messages(text: str, chunk_size: int = 64 * 1024) -> list:
+    return list(iter_raw_messages(io.StringIO(text), chunk_size=chunk_size))
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 5, 7, 16, 4096])
+@pytest.mark.parametrize('ensure_ascii', [True, False])
+def test_chunk_boundaries_anywhere(chunk_size, ensure_ascii):
+    # ensure_ascii splits \uXXXX escapes and surrogate pairs over chunks
+    text = json.dumps(LIBRARY, ensure_ascii=ensure_ascii, indent=1)
+
+    assert raw_messages(text, chunk_size) == LIBRARY['messages']
+
+
+def test_number_at_the_end_of_a_chunk():
+    text = '{"messages": [{"text": ["a"], "weight": 1234567}]}'
+    chunk_size = text.index('1234567') + 3
+
+    assert raw_messages(text, chunk_size)[0]['weight'] == 1234567
+
+
+def test_long_values_are_read_in_growing_chunks():
+    text = json.dumps({'messages': [{'text': ['x' * 200000]}]})
+    fp = CountingReader(text)
+
+    assert list(iter_raw_messages(fp, chunk_size=16))[0]['text'][0] == 'x' * 200000
+    # doubling reads, not one per chunk
+    assert fp.reads < 40
+
+
+@pytest.mark.parametrize('text', [
+    '',
+    '[]',
+    '{"messages": [{"text": ["a"]}',
+    '{"messages": [{"text": ["a"]},]}',
+    '{"messages": [{"text": ["a"]}], }',
+    '{"messages": [{"text": ["a"]} {"text": ["b"]}]}',
+    '{"other": 1 "messages": []}',
+    '{"messages": [{"text": ["unterminated]}]}',
+    '{"messages": [{"text": ["bad \\x escape"]}]}',
+    '{1: []}',
+    '{"version": 1}',
+])
+def test_invalid_json_is_rejected(text):
+    with pytest.raises(ImportFormatError):
+        raw_messages(text, chunk_size=4)
+
+
+@pytest.mark.parametrize('text', [
+    '{"messages": [{"text": ["a"]}]} garbage',
+    '{"messages": [{"text": ["a"]}]}{}',
+    '{"messages": [{"text": ["a"]}]}]',
+])
+def test_trailing_data_is_rejected(text):
+    with pytest.raises(ImportFormatError, match='after the top-level object'):
+        raw_messages(text)
+
+
+def test_trailing_whitespace_is_fine():
+    assert raw_messages('{"messages": [{"text": ["a"]}]}\r\n\n  ') == [{'text': ['a']}]
+
+
+def test_duplicate_messages_list_is_rejected():
+    with pytest.raises(ImportFormatError, match='more than one'):
+        raw_messages('{"messages": [{"text": ["a"]}], "messages": [{"text": ["b"]}]}')
+
+
+@pytest.mark.parametrize('raw, reason', [
+    ('text', 'expected an object'),
+    ({'text': 'not a list'}, '"text"'),
+    ({'text': ['a'], 'file': 5}, '"file"'),
+    ({'text': ['a'], 'file': ['f'] * (MAX_ALBUM_FILES + 1)}, 'at most'),
+    ({'text': ['a'], 'buttons': [{'name': 'no link'}]}, 'button'),
+    ({'text': ['a'], 'groups': [True]}, '"groups"'),
+    ({'text': ['a'], 'weight': 0}, '"weight"'),
+    ({'text': ['a'], 'interval': False}, '"interval"'),
+    ({'text': ['a'], 'interval': -1}, '"interval"'),
+])
+def test_invalid_messages_are_rejected(raw, reason):
+    with pytest.raises(ImportFormatError, match=reason) as error:
+        validate_message(raw, 4)
+    assert error.value.index == 4
+
+
+def test_parse_message_file(tmp_path):
+    path = tmp_path / 'library.json'
+    path.write_text(json.dumps(LIBRARY), encoding='utf-8')
+
+    messages = parse_message_file(str(path))
+
+    assert [message.text for message in messages] == ['\n'.join(raw['text']) for raw in LIBRARY['messages']]
+    assert messages[0].file_links == ['files/a.jpg']
+    assert messages[1].buttons == [('Site', 'https://a.example')]
+    assert (messages[2].weight, messages[2].interval) == (12345.678, 0.0)
+
+
+def test_empty_library_is_rejected(tmp_path):
+    path = tmp_path / 'library.json'
+    path.write_text('{"messages": []}', encoding='utf-8')
+
+    with pytest.raises(ImportFormatError, match='empty'):
+        parse_message_file(str(path))
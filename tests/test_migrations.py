@@ -0,0 +1,91 @@
+import sqlite3
+
+import pytest
+
+from migrations import MIGRATIONS, migrate
+
+
+def connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(':memory:', isolation_level=None)
+    conn.execute('PRAGMA foreign_keys=ON')
+    return conn
+
+
+def legacy_database() -> sqlite3.Connection:
+    '''
+    Tables as the releases before versioned migrations left them, with
+    their duplicate and dangling rows
+    '''
+    conn = connect()
+    conn.execute('CREATE TABLE groups(id INTEGER, username TEXT, peer_type TEXT, access_hash INTEGER)')
+    conn.execute('CREATE TABLE messages(text TEXT, msg_id INTEGER)')
+    conn.execute('CREATE TABLE buttons(name TEXT, link TEXT, msg_id INTEGER)')
+    conn.execute('CREATE TABLE message_files(file_link TEXT, msg_id INTEGER)')
+    conn.executemany('INSERT INTO groups VALUES(?, ?, ?, ?)', [
+        (-100, '@first', 'channel', 11),
+        (-100, '@first', 'channel', 11),
+        (-200, '@second', None, None),
+        (None, '@broken', None, None),
+    ])
+    conn.executemany('INSERT INTO messages VALUES(?, ?)', [('one', 1), ('two', 2), ('reused', 2), ('none', None)])
+    conn.executemany('INSERT INTO buttons VALUES(?, ?, ?)', [('site', 'https://a', 1), ('gone', 'https://b', 3)])
+    conn.executemany('INSERT INTO message_files VALUES(?, ?)', [('files/a.jpg', 1), ('files/b.jpg', 3)])
+    return conn
+
+
+def test_new_database_reaches_latest_version():
+    conn = connect()
+    migrate(conn)
+
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == len(MIGRATIONS)
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(messages)')}
+    assert {'msg_id', 'text', 'weight', 'targeted', 'post_interval'} <= columns
+
+
+def test_migrate_twice_is_a_no_op():
+    conn = connect()
+    migrate(conn)
+    schema = conn.execute('SELECT sql FROM sqlite_master ORDER BY name').fetchall()
+
+    migrate(conn)
+
+    assert conn.execute('SELECT sql FROM sqlite_master ORDER BY name').fetchall() == schema
+
+
+def test_legacy_rows_are_deduplicated_and_kept():
+    conn = legacy_database()
+    migrate(conn)
+
+    assert conn.execute('SELECT id, username FROM groups ORDER BY id').fetchall() == [
+        (-200, '@second'), (-100, '@first')]
+    assert conn.execute('SELECT msg_id, text FROM messages ORDER BY msg_id').fetchall() == [(1, 'one'), (2, 'two')]
+    assert conn.execute('SELECT name, msg_id FROM buttons').fetchall() == [('site', 1)]
+    assert conn.execute('SELECT file_link, msg_id FROM message_files').fetchall() == [('files/a.jpg', 1)]
+
+
+def test_legacy_peers_move_to_the_main_shard():
+    conn = legacy_database()
+    migrate(conn)
+
+    assert conn.execute(
+        'SELECT group_id, shard, peer_type, access_hash FROM shard_members ORDER BY group_id'
+    ).fetchall() == [(-200, 'main', None, None), (-100, 'main', 'channel', 11)]
+    assert conn.execute('SELECT group_id, shard FROM group_shards ORDER BY group_id').fetchall() == [
+        (-200, 'main'), (-100, 'main')]
+
+
+def test_failed_migration_rolls_back(monkeypatch):
+    def broken(conn: sqlite3.Connection) -> None:
+        conn.execute('CREATE TABLE half_done(id INTEGER)')
+        raise RuntimeError('broken migration')
+
+    conn = connect()
+    migrate(conn)
+    monkeypatch.setattr('migrations.MIGRATIONS', MIGRATIONS + [broken])
+
+    with pytest.raises(RuntimeError):
+        migrate(conn)
+
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == len(MIGRATIONS)
+    assert conn.execute("SELECT 1 FROM sqlite_master WHERE name='half_done'").fetchone() is None
+    assert conn.execute('PRAGMA foreign_keys').fetchone()[0] == 1
@@ -0,0 +1,100 @@
+import asyncio
+import time
+
+from database import Database
+from migrations import migrate
+from outbox import PENDING, RESENT, UNKNOWN, Outbox
+
+
+async def new_outbox() -> Outbox:
+    database = Database(':memory:')
+    await database.run(migrate)
+    outbox = Outbox(database)
+    await outbox.load()
+    return outbox
+
+
+async def statuses(outbox: Outbox) -> dict:
+    rows = await outbox.database.fetchall('SELECT batch_id, group_id, status FROM outbox')
+    return {(batch_id, group_id): status for batch_id, group_id, status in rows}
+
+
+def test_recover_resumes_every_group():
+    async def run():
+        outbox = await new_outbox()
+        first = await outbox.enqueue(10, [1, 2, 3])
+        await outbox.complete(first, [(1, True)])
+        await outbox.mark_sending(first, 2)
+        second = await outbox.enqueue(20, [1])
+        await outbox.complete(second, [(1, False)])
+
+        positions = await outbox.recover()
+
+        # a failed post still counts as this group's turn
+        assert positions[1][:2] == (20, True)
+        # caught mid-request: it may have gone out, so it is not sent again
+        assert positions[2][:2] == (10, True)
+        # never left: due again right away
+        assert positions[3][:2] == (10, False)
+        assert all(0 <= elapsed < 5 for _, _, elapsed in positions.values())
+
+        rows = await statuses(outbox)
+        assert rows[(first, 2)] == UNKNOWN
+        # replaced only once the resend is journaled
+        assert rows[(first, 3)] == PENDING
+        resend = await outbox.enqueue(10, [3])
+        rows = await statuses(outbox)
+        assert (rows[(first, 3)], rows[(resend, 3)]) == (RESENT, PENDING)
+
+    asyncio.run(run())
+
+
+def test_crash_before_the_resend_keeps_the_post():
+    async def run():
+        outbox = await new_outbox()
+        await outbox.enqueue(10, [1])
+        assert (await outbox.recover())[1][:2] == (10, False)
+
+        # crashed again before the resend was journaled
+        restarted = Outbox(outbox.database)
+        await restarted.load()
+        assert (await restarted.recover())[1][:2] == (10, False)
+
+        await restarted.enqueue(10, [1])
+        again = Outbox(outbox.database)
+        await again.load()
+        # the resend itself never left either, and it is the only one due
+        assert (await again.recover())[1][:2] == (10, False)
+        assert list((await statuses(again)).values()).count(PENDING) == 1
+
+    asyncio.run(run())
+
+
+def test_batch_ids_continue_after_a_restart():
+    async def run():
+        outbox = await new_outbox()
+        await outbox.enqueue(10, [1])
+        await outbox.enqueue(10, [1])
+
+        restarted = Outbox(outbox.database)
+        await restarted.load()
+
+        assert await restarted.enqueue(10, [1]) == 3
+
+    asyncio.run(run())
+
+
+def test_prune_keeps_the_latest_row_of_each_group():
+    async def run():
+        outbox = await new_outbox()
+        for msg_id in (10, 20, 30):
+            batch_id = await outbox.enqueue(msg_id, [1, 2])
+            await outbox.complete(batch_id, [(1, True), (2, True)])
+        await outbox.database.execute('UPDATE outbox SET updated_at=?', (time.time() - 3600, ))
+
+        await outbox.prune(keep_seconds=60)
+
+        assert await statuses(outbox) == {(3, 1): 'done', (3, 2): 'done'}
+        assert {group_id: position[0] for group_id, position in (await outbox.recover()).items()} == {1: 30, 2: 30}
+
+    asyncio.run(run())
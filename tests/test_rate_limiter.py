@@ -0,0 +1,139 @@
+import asyncio
+import time
+
+import pytest
+
+from change_feed import Change, ChangeKind
+from rate_limiter import RateLimiter, RetryQueue, TokenBucket
+from sender import FanOutSender
+
+
+def test_bucket_allows_a_burst_then_paces():
+    bucket = TokenBucket(rate=2, capacity=3)
+    now = bucket.updated
+
+    for _ in range(3):
+        assert bucket.delay(now) == 0
+        bucket.take()
+
+    assert bucket.delay(now) == pytest.approx(0.5)
+    assert bucket.delay(now + 0.5) == 0
+
+
+def test_flood_wait_pauses_and_slows_the_bucket():
+    bucket = TokenBucket(rate=16, capacity=16)
+    bucket.on_flood_wait(10)
+
+    assert bucket.delay(time.monotonic()) == pytest.approx(10, abs=0.1)
+    assert bucket.rate == 8
+
+    # never slower than a sixteenth of the configured rate
+    for _ in range(10):
+        bucket.on_flood_wait(0)
+    assert bucket.rate == 1
+
+    # successes win the rate back, up to the ceiling
+    for _ in range(100):
+        bucket.on_success()
+    assert bucket.rate == 16
+
+
+def test_chat_limit_only_delays_that_chat():
+    async def run():
+        limiter = RateLimiter(global_rate=1000, chat_rate=10, chat_burst=1, dc_rate=1000)
+        await limiter.acquire(1, dc_id=2)
+
+        started = time.monotonic()
+        await limiter.acquire(3, dc_id=2)
+        assert time.monotonic() - started < 0.05
+
+        await limiter.acquire(1, dc_id=2)
+        assert time.monotonic() - started >= 0.09
+
+    asyncio.run(run())
+
+
+def test_slow_mode_pauses_only_its_chat():
+    limiter = RateLimiter(global_rate=10, chat_rate=10, chat_burst=10, dc_rate=10)
+    limiter.on_flood_wait(30, chat_id=1)
+    now = time.monotonic()
+
+    assert limiter.chat_buckets[1].delay(now) > 29
+    assert limiter.global_bucket.delay(now) == 0
+
+
+def test_flood_wait_pauses_the_account():
+    limiter = RateLimiter(global_rate=10, chat_rate=10, chat_burst=10, dc_rate=10)
+    limiter.on_flood_wait(30, dc_id=2)
+    now = time.monotonic()
+
+    assert limiter.global_bucket.delay(now) > 29
+    assert limiter.dc_buckets[2].delay(now) > 29
+    assert limiter._buckets(1, None)[-1].delay(now) == 0
+
+
+def test_paused_chat_does_not_hold_a_parallel_slot():
+    async def run():
+        limiter = RateLimiter(global_rate=1000, chat_rate=1000, chat_burst=10, dc_rate=1000)
+        limiter.on_flood_wait(0.5, chat_id=1)
+        sent = []
+
+        async def send(group_id, payload):
+            sent.append(group_id)
+
+        sender = FanOutSender(send, max_parallel=1, acquire=limiter.acquire)
+        started = time.monotonic()
+        results = await asyncio.wait_for(sender.fan_out('post', [1, 2, 3]), 2)
+
+        assert all(result.ok for result in results)
+        # the other chats went out while chat 1 was paused
+        assert sent == [2, 3, 1]
+        assert time.monotonic() - started >= 0.45
+
+    asyncio.run(run())
+
+
+def test_retry_backoff_doubles_up_to_the_limit():
+    queue = RetryQueue(base_delay=5, max_delay=30, max_attempts=5)
+    now = time.monotonic()
+
+    for attempt in range(4):
+        assert queue.push(attempt, 'post', attempt)
+
+    due_times = sorted(entry[0] - now for entry in queue._heap)
+    assert due_times == pytest.approx([5, 10, 20, 30], abs=0.1)
+    assert not queue.push(9, 'post', 5)
+    assert len(queue) == 4
+
+
+def test_retry_waits_at_least_the_flood_wait():
+    queue = RetryQueue(base_delay=1)
+    queue.push(1, 'post', 0, min_delay=60)
+
+    assert queue.next_due() == pytest.approx(60, abs=0.1)
+
+
+def test_due_retries_come_back_with_their_attempt():
+    async def run():
+        queue = RetryQueue(base_delay=0.01)
+        queue.push(1, 'first', 0)
+        queue.push(2, 'second', 1)
+
+        await asyncio.wait_for(queue.wait(), 1)
+        await asyncio.sleep(0.03)
+
+        assert queue.pop_due() == [(1, 'first', 1), (2, 'second', 2)]
+        assert queue.next_due() is None
+
+    asyncio.run(run())
+
+
+def test_removed_group_loses_its_retries():
+    queue = RetryQueue()
+    queue.push(1, 'post', 0)
+    queue.push(2, 'post', 0)
+    queue.push(1, 'other', 1)
+
+    queue.apply(Change(1, ChangeKind.GROUP_REMOVED, 1))
+
+    assert [entry[2] for entry in queue._heap] == [2]
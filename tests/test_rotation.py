@@ -0,0 +1,142 @@
+import itertools
+from collections import Counter
+from typing import List
+
+import pytest
+
+from change_feed import AddedMessage
+from rotation import MessageRotation
+
+
+def picks(rotation: MessageRotation, group_id: int, count: int) -> List[int]:
+    msg_ids = []
+    msg_id = None
+    for _ in range(count):
+        msg_id = rotation.next(group_id, msg_id)
+        msg_ids.append(msg_id)
+    return msg_ids
+
+
+def longest_run(msg_ids: List[int], msg_id: int) -> int:
+    return max((len(list(run)) for key, run in itertools.groupby(msg_ids) if key == msg_id), default=0)
+
+
+def test_unknown_strategy():
+    with pytest.raises(ValueError):
+        MessageRotation('fastest')
+
+
+def test_round_robin_wraps_around():
+    rotation = MessageRotation()
+    rotation.load([30, 10, 20])
+
+    assert picks(rotation, 1, 5) == [10, 20, 30, 10, 20]
+    assert rotation.next(1, 25) == 30
+
+
+def test_targeted_messages_only_reach_their_groups():
+    rotation = MessageRotation()
+    rotation.load([1, 2, 3], targets={2: [7]})
+
+    assert picks(rotation, 7, 3) == [1, 2, 3]
+    assert picks(rotation, 8, 3) == [1, 3, 1]
+    assert rotation.receives(7, 2) and not rotation.receives(8, 2)
+
+
+def test_empty_rotation():
+    for strategy in ('round_robin', 'weighted', 'shuffle'):
+        rotation = MessageRotation(strategy)
+        rotation.load([])
+        assert rotation.next(1, None) is None
+
+
+def test_add_many_and_remove():
+    rotation = MessageRotation()
+    rotation.load([1])
+    rotation.add_many([AddedMessage(2), AddedMessage(3, group_ids=(5, ))])
+
+    assert picks(rotation, 5, 3) == [1, 2, 3]
+    assert picks(rotation, 6, 2) == [1, 2]
+
+    rotation.remove(2)
+    rotation.remove(3)
+    assert picks(rotation, 5, 2) == [1, 1]
+
+
+def test_removed_group_keeps_its_messages_targeted():
+    rotation = MessageRotation()
+    rotation.load([1, 2], targets={2: [5]})
+    rotation.remove_group(5)
+
+    assert rotation.has(2)
+    assert picks(rotation, 6, 3) == [1, 1, 1]
+
+
+def test_weighted_follows_the_weights():
+    rotation = MessageRotation('weighted')
+    rotation.load([1, 2, 3, 4], weights={1: 3})
+
+    counts = Counter(picks(rotation, 1, 600))
+
+    assert counts[1] == pytest.approx(300, abs=3)
+    for msg_id in (2, 3, 4):
+        assert counts[msg_id] == pytest.approx(100, abs=3)
+
+
+def test_weighted_interleaves_heavy_messages():
+    rotation = MessageRotation('weighted')
+    rotation.load([1, 2, 3, 4], weights={1: 3})
+
+    assert longest_run(picks(rotation, 1, 60), 1) <= 2
+
+
+def test_weighted_new_messages_start_without_a_burst():
+    rotation = MessageRotation('weighted')
+    rotation.load([1, 2])
+    picks(rotation, 1, 50)
+    rotation.add_many([AddedMessage(3, weight=2)])
+
+    counts = Counter(picks(rotation, 1, 40))
+
+    assert counts[3] == pytest.approx(20, abs=2)
+
+
+def test_shuffle_posts_every_message_once_per_cycle():
+    rotation = MessageRotation('shuffle', seed=1)
+    rotation.load(range(1, 11))
+
+    msg_ids = picks(rotation, 1, 30)
+
+    for cycle in range(3):
+        assert sorted(msg_ids[cycle * 10:(cycle + 1) * 10]) == list(range(1, 11))
+    assert all(first != second for first, second in zip(msg_ids, msg_ids[1:]))
+
+
+def test_shuffle_takes_changes_within_a_cycle():
+    rotation = MessageRotation('shuffle', seed=2)
+    rotation.load(range(1, 6))
+    first = picks(rotation, 1, 2)
+    removed = next(msg_id for msg_id in range(1, 6) if msg_id not in first)
+    rotation.remove(removed)
+    rotation.add(6)
+
+    rest = picks(rotation, 1, 3)
+
+    assert sorted(first + rest) == sorted({1, 2, 3, 4, 5, 6} - {removed})
+
+
+def test_ids_stay_sorted_through_changes():
+    rotation = MessageRotation()
+    rotation.load([10, 20, 30], targets={25: [7]})
+
+    rotation.add(15)
+    rotation.add_many([AddedMessage(msg_id) for msg_id in (40, 5, 12, 18, 22, 24, 26, 28, 33, 35)])
+    rotation.add_many([AddedMessage(msg_id, group_ids=(7, )) for msg_id in (21, 50)])
+    rotation.remove(20)
+    rotation.remove(21)
+    rotation.remove(99)
+
+    common = [5, 10, 12, 15, 18, 22, 24, 26, 28, 30, 33, 35, 40]
+    assert rotation.messages_for(8) == common
+    assert rotation.messages_for(7) == common + [25, 50]
+    assert picks(rotation, 7, 16) == sorted(common + [25, 50]) + [5]
@@ -0,0 +1,102 @@
+import asyncio
+from types import SimpleNamespace
+
+from router import Router, command_key, translations
+
+ADMIN = 1
+USER = 2
+BUTTONS = {'start': {'en': '▶ Start', 'he': '▶ התחל'}}
+
+
+def event(sender_id: int, text: str, is_group: bool = False) -> SimpleNamespace:
+    return SimpleNamespace(sender_id=sender_id, raw_text=text, is_group=is_group)
+
+
+def new_router(states=None, observed=None):
+    states = states if states is not None else {}
+    router = Router(
+        is_admin=lambda sender_id: sender_id == ADMIN,
+        get_state=states.get,
+        observe=None if observed is None else lambda handler, seconds: observed.append(handler.__name__)
+    )
+    calls = []
+
+    @router.command('/start', *translations(BUTTONS, 'start'))
+    async def start(e):
+        calls.append(('start', e.sender_id))
+
+    @router.command('/help', public=True)
+    async def help(e):
+        calls.append(('help', e.sender_id))
+
+    @router.state('waiting_for_text', 'waiting_for_other_text')
+    async def text(e):
+        calls.append(('text', e.raw_text))
+
+    return router, calls
+
+
+def test_command_key():
+    assert command_key('  /start@autopost_bot now ') == '/start'
+    assert command_key('/stats') == '/stats'
+    assert command_key(' ▶ Start \n') == '▶ Start'
+
+
+def test_commands_and_buttons_in_every_language():
+    async def run():
+        router, calls = new_router()
+        for text in ('/start', '/start@bot', '▶ Start', '▶ התחל'):
+            await router.dispatch(event(ADMIN, text))
+
+        assert calls == [('start', ADMIN)] * 4
+
+    asyncio.run(run())
+
+
+def test_other_text_goes_to_the_state_handler():
+    async def run():
+        states = {ADMIN: 'waiting_for_other_text'}
+        router, calls = new_router(states)
+        await router.dispatch(event(ADMIN, 'Hello'))
+        # commands win over the state
+        await router.dispatch(event(ADMIN, '/start'))
+
+        states[ADMIN] = None
+        await router.dispatch(event(ADMIN, 'ignored'))
+
+        assert calls == [('text', 'Hello'), ('start', ADMIN)]
+
+    asyncio.run(run())
+
+
+def test_non_admins_only_reach_public_handlers():
+    async def run():
+        router, calls = new_router({USER: 'waiting_for_text'})
+        for text in ('/start', 'Hello', '/help'):
+            await router.dispatch(event(USER, text))
+
+        assert calls == [('help', USER)]
+
+    asyncio.run(run())
+
+
+def test_group_messages_are_dropped():
+    async def run():
+        router, calls = new_router()
+        await router.dispatch(event(ADMIN, '/start', is_group=True))
+
+        assert calls == []
+
+    asyncio.run(run())
+
+
+def test_handlers_are_observed():
+    async def run():
+        observed = []
+        router, _ = new_router(observed=observed)
+        await router.dispatch(event(ADMIN, '/start'))
+        await router.dispatch(event(ADMIN, None))
+
+        assert observed == ['start']
+
+    asyncio.run(run())
@@ -0,0 +1,167 @@
+import asyncio
+from typing import List, Tuple
+
+from change_feed import AddedMessage, ChangeFeed, ChangeKind
+from rotation import MessageRotation
+from scheduler import Scheduler
+
+
+class Recorder(object):
+    '''
+    Dispatch target that records the batches the scheduler fires
+    '''
+
+    def __init__(self) -> None:
+        self.batches: List[Tuple[int, List[int]]] = []
+
+    async def __call__(self, msg_id: int, group_ids: List[int]) -> None:
+        self.batches.append((msg_id, sorted(group_ids)))
+
+
+def new_scheduler(interval: float = 0.0, strategy: str = 'round_robin') -> Tuple[Scheduler, Recorder, ChangeFeed]:
+    recorder = Recorder()
+    scheduler = Scheduler(recorder, lambda: interval, MessageRotation(strategy))
+    feed = ChangeFeed()
+    feed.subscribe(scheduler.apply)
+    return scheduler, recorder, feed
+
+
+async def run_until(scheduler: Scheduler, recorder: Recorder, count: int, timeout: float = 1.0) -> None:
+    '''
+    Run the scheduler until `count` batches were dispatched, or `timeout`
+    '''
+    task = asyncio.create_task(scheduler.run())
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while len(recorder.batches) < count and loop.time() < deadline:
+        await asyncio.sleep(0.001)
+    scheduler.stop()
+    await task
+
+
+def test_groups_get_their_messages_in_turn():
+    async def run():
+        scheduler, recorder, _ = new_scheduler()
+        scheduler.load([1, 2], [10, 20])
+
+        await run_until(scheduler, recorder, 4)
+
+        assert recorder.batches[:4] == [(1, [10, 20]), (2, [10, 20]), (1, [10, 20]), (2, [10, 20])]
+
+    asyncio.run(run())
+
+
+def test_resume_continues_after_the_last_post():
+    async def run():
+        scheduler, recorder, _ = new_scheduler(interval=60)
+        scheduler.load([1, 2, 3], [10, 20, 30, 40], resume={
+            # delivered an interval ago: the next message is due now
+            10: (1, True, 60),
+            # delivered just now: the next message waits a whole interval
+            20: (1, True, 0),
+            # never left the outbox: sent again right away
+            30: (2, False, 0),
+        })
+
+        await run_until(scheduler, recorder, 2, timeout=0.2)
+
+        assert sorted(recorder.batches) == [(1, [40]), (2, [10, 30])]
+
+    asyncio.run(run())
+
+
+def test_resume_skips_removed_groups_and_messages():
+    async def run():
+        scheduler, recorder, _ = new_scheduler(interval=60)
+        scheduler.load([1, 2], [10], resume={10: (3, False, 0), 99: (1, True, 60)})
+
+        await run_until(scheduler, recorder, 1, timeout=0.2)
+
+        assert recorder.batches == [(1, [10])]
+
+    asyncio.run(run())
+
+
+def test_messages_added_start_idle_groups_with_their_intervals():
+    async def run():
+        scheduler, recorder, feed = new_scheduler(interval=60)
+        scheduler.load([], [10, 20])
+        assert scheduler.pending == 0
+
+        feed.publish(ChangeKind.MESSAGES_ADDED, messages=[
+            AddedMessage(1, interval=0), AddedMessage(2, group_ids=(20, ), interval=30)])
+
+        await run_until(scheduler, recorder, 3, timeout=0.2)
+
+        # after message 1 group 10 is due right away; message 2 only goes to group 20
+        assert recorder.batches[0] == (1, [10, 20])
+        assert sorted(recorder.batches[1:3]) == [(1, [10]), (2, [20])]
+        assert scheduler.message_intervals == {1: 0, 2: 30}
+        assert scheduler.interval_for(20, 2) == 30
+
+    asyncio.run(run())
+
+
+def test_removed_message_and_group_are_skipped():
+    async def run():
+        scheduler, recorder, feed = new_scheduler()
+        scheduler.load([1, 2], [10, 20])
+
+        feed.publish(ChangeKind.MESSAGE_REMOVED, 1)
+        feed.publish(ChangeKind.GROUP_REMOVED, 20)
+        await run_until(scheduler, recorder, 2)
+
+        assert recorder.batches[:2] == [(2, [10]), (2, [10])]
+        assert scheduler.pending + scheduler.inflight <= 1
+
+    asyncio.run(run())
+
+
+def test_intervals_fall_back_from_message_to_group_to_default():
+    async def run():
+        scheduler, _, _ = new_scheduler(interval=60)
+        scheduler.load([1, 2], [10, 20])
+        scheduler.set_group_interval(10, 30)
+        scheduler.set_message_interval(1, 5)
+
+        assert scheduler.interval_for(10, 1) == 5
+        assert scheduler.interval_for(10, 2) == 30
+        assert scheduler.interval_for(20, 2) == 60
+
+        scheduler.set_group_interval(10, None)
+        assert scheduler.interval_for(10, 2) == 60
+
+    asyncio.run(run())
+
+
+def test_interval_change_retimes_queued_jobs():
+    async def run():
+        scheduler, recorder, _ = new_scheduler(interval=60)
+        scheduler.load([1, 2], [10], resume={10: (1, True, 0)})
+
+        await run_until(scheduler, recorder, 1, timeout=0.05)
+        assert recorder.batches == []
+
+        scheduler.set_group_interval(10, 0)
+        await run_until(scheduler, recorder, 1, timeout=0.2)
+        assert recorder.batches[0] == (2, [10])
+
+    asyncio.run(run())
+
+
+def test_stop_before_run_is_kept():
+    async def run():
+        scheduler, recorder, _ = new_scheduler()
+        scheduler.load([1], [10])
+        scheduler.stop()
+
+        await asyncio.wait_for(scheduler.run(), 1)
+
+        assert recorder.batches == []
+
+        # a new schedule runs again
+        scheduler.load([1], [10])
+        await run_until(scheduler, recorder, 1)
+        assert recorder.batches[0] == (1, [10])
+
+    asyncio.run(run())
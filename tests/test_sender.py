@@ -0,0 +1,96 @@
+import asyncio
+from typing import List
+
+from sender import FanOutSender, SendResult
+
+
+def test_results_follow_the_group_order():
+    async def run():
+        async def send(group_id, payload):
+            # later groups finish first
+            await asyncio.sleep(0.01 * (5 - group_id))
+
+        results = await FanOutSender(send, max_parallel=5).fan_out('post', [1, 2, 3, 4])
+
+        assert [result.group_id for result in results] == [1, 2, 3, 4]
+        assert all(result.ok and result.error is None for result in results)
+
+    asyncio.run(run())
+
+
+def test_parallel_requests_are_bounded():
+    async def run():
+        running = 0
+        peak = 0
+
+        async def send(group_id, payload):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+        await FanOutSender(send, max_parallel=3).fan_out('post', range(20))
+
+        assert peak == 3
+
+    asyncio.run(run())
+
+
+def test_one_failing_group_does_not_stop_the_others():
+    async def run():
+        observed: List[SendResult] = []
+
+        async def send(group_id, payload):
+            if group_id == 2:
+                raise ValueError('chat is gone')
+
+        sender = FanOutSender(send, max_parallel=2, observe=observed.append)
+        results = await sender.fan_out('post', [1, 2, 3])
+
+        assert [result.ok for result in results] == [True, False, True]
+        assert isinstance(results[1].error, ValueError)
+        assert 'chat is gone' in results[1].traceback
+        assert sorted(result.group_id for result in observed) == [1, 2, 3]
+
+    asyncio.run(run())
+
+
+def test_posts_to_one_chat_keep_their_order():
+    async def run():
+        sent = []
+
+        async def send(group_id, payload):
+            # the first post is the slowest
+            await asyncio.sleep(0.03 if payload == 'first' else 0)
+            sent.append((group_id, payload))
+
+        sender = FanOutSender(send, max_parallel=4)
+        await asyncio.gather(
+            sender.fan_out('first', [1, 2]),
+            sender.fan_out('second', [1]),
+            sender.fan_out('third', [1, 3]),
+        )
+
+        assert [payload for group_id, payload in sent if group_id == 1] == ['first', 'second', 'third']
+        # a chat's lock is dropped once nothing waits for it
+        assert sender._chat_locks == {}
+
+    asyncio.run(run())
+
+
+def test_waiting_for_a_chat_does_not_hold_a_slot():
+    async def run():
+        sent = []
+
+        async def send(group_id, payload):
+            await asyncio.sleep(0.05 if group_id == 1 else 0)
+            sent.append((group_id, payload))
+
+        sender = FanOutSender(send, max_parallel=2)
+        await asyncio.gather(sender.fan_out('first', [1]), sender.fan_out('second', [1, 2, 3]))
+
+        # groups 2 and 3 went out while the second post to chat 1 waited
+        assert sent.index((3, 'second')) < sent.index((1, 'first'))
+
+    asyncio.run(run())
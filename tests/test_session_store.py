@@ -0,0 +1,136 @@
+import asyncio
+
+import pytest
+
+from database import Database
+from migrations import migrate
+from session_store import SessionStore
+
+
+class States:
+    idle = object()
+    waiting_for_text = object()
+
+
+class Clock(object):
+    def __init__(self) -> None:
+        self.now = 1_000_000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr('session_store.time.time', clock)
+    return clock
+
+
+async def new_database() -> Database:
+    database = Database(':memory:')
+    await database.run(migrate)
+    return database
+
+
+async def stored_users(database: Database) -> list:
+    return sorted(row[0] for row in await database.fetchall('SELECT user_id FROM sessions'))
+
+
+def test_least_recently_used_sessions_are_evicted(clock):
+    async def run():
+        store = SessionStore(States, max_sessions=2)
+        await store.set_state(1, States.idle)
+        clock.now += 1
+        await store.set_state(2, States.idle)
+        clock.now += 1
+        # using the first session again makes the second the oldest
+        await store.set_state(1, States.waiting_for_text)
+        clock.now += 1
+        await store.set_state(3, States.idle)
+
+        assert len(store) == 2
+        assert store.state(1) is States.waiting_for_text
+        assert store.state(2) is None
+
+    asyncio.run(run())
+
+
+def test_sessions_expire(clock):
+    async def run():
+        store = SessionStore(States, ttl=60)
+        await store.set_state(1, States.waiting_for_text, text='draft')
+        await store.set_state(2, States.idle)
+
+        clock.now += 30
+        await store.set_state(2, States.idle)
+        clock.now += 31
+
+        assert store.state(1) is None
+        assert store.data(1) == {}
+        assert store.state(2) is States.idle
+
+        # expired sessions also go once another session changes
+        await store.set_state(3, States.idle)
+        assert len(store) == 2
+
+    asyncio.run(run())
+
+
+def test_flow_data(clock):
+    async def run():
+        store = SessionStore(States)
+        await store.begin(1, States.idle, text='first')
+        await store.set_state(1, States.waiting_for_text, files=[1])
+        assert store.data(1) == {'text': 'first', 'files': [1]}
+
+        await store.begin(1, States.idle)
+        assert store.data(1) == {}
+
+        await store.end(1)
+        assert store.get(1) is None
+
+    asyncio.run(run())
+
+
+def test_sessions_survive_a_restart(clock):
+    async def run():
+        database = await new_database()
+        store = SessionStore(States, max_sessions=2, ttl=60, database=database)
+        await store.set_state(1, States.waiting_for_text, text='draft')
+        await store.set_state(2, States.idle)
+        await store.set_state(3, States.idle)
+        await store.set_state(4, States.idle)
+        await store.end(4)
+
+        # evicted and ended sessions are deleted from the table too
+        assert await stored_users(database) == [3]
+
+        clock.now += 30
+        restarted = SessionStore(States, max_sessions=2, ttl=60, database=database)
+        await restarted.load()
+        assert restarted.state(3) is States.idle
+
+        await store.set_state(1, States.waiting_for_text, text='again')
+        clock.now += 40
+        restarted = SessionStore(States, max_sessions=1, ttl=60, database=database)
+        await restarted.load()
+
+        assert (restarted.state(1), restarted.data(1)) == (States.waiting_for_text, {'text': 'again'})
+        assert await stored_users(database) == [1]
+
+    asyncio.run(run())
+
+
+def test_unknown_stored_states_are_skipped(clock):
+    async def run():
+        database = await new_database()
+        await database.execute(
+            'INSERT INTO sessions VALUES(?, ?, ?, ?)', (1, 'removed_state', '{}', clock.now))
+
+        store = SessionStore(States, database=database)
+        await store.load()
+
+        assert store.get(1) is None
+
+    asyncio.run(run())
@@ -0,0 +1,129 @@
+import asyncio
+from collections import Counter
+
+from change_feed import Change, ChangeKind
+from database import Database
+from migrations import migrate
+from sharding import MAIN_SHARD, HashRing, Shard, ShardSet
+
+KEYS = [str(-1000000000000 - index) for index in range(3000)]
+
+
+def test_ring_spreads_keys_evenly():
+    ring = HashRing(['main', 'second', 'third'])
+
+    counts = Counter(ring.owner(key) for key in KEYS)
+
+    assert set(counts) == {'main', 'second', 'third'}
+    assert all(600 < count < 1400 for count in counts.values())
+
+
+def test_new_shard_only_takes_keys_over():
+    before = HashRing(['main', 'second', 'third'])
+    after = HashRing(['main', 'second', 'third', 'fourth'])
+
+    moved = [key for key in KEYS if before.owner(key) != after.owner(key)]
+
+    assert all(after.owner(key) == 'fourth' for key in moved)
+    assert 400 < len(moved) < 1200
+
+
+def test_walk_and_eligible_shards():
+    ring = HashRing(['main', 'second', 'third'])
+
+    for key in KEYS[:50]:
+        order = list(ring.walk(key))
+        assert sorted(order) == ['main', 'second', 'third']
+        assert ring.owner(key) == order[0]
+        assert ring.owner(key, eligible={order[2]}) == order[2]
+        assert ring.owner(key, eligible=set()) is None
+
+    assert HashRing([]).owner('key') is None
+
+
+async def new_shards(database: Database, names) -> ShardSet:
+    shards = ShardSet(database, [Shard(name, f'{index + 1}00:token', database) for index, name in enumerate(names)])
+    await shards.load()
+    return shards
+
+
+async def new_database(group_ids) -> Database:
+    database = Database(':memory:')
+    await database.run(migrate)
+    await database.executemany(
+        'INSERT INTO groups(id, username) VALUES(?, NULL)', [(group_id, ) for group_id in group_ids])
+    return database
+
+
+async def stored_owners(database: Database) -> dict:
+    return dict(await database.fetchall('SELECT group_id, shard FROM group_shards'))
+
+
+def test_groups_are_owned_by_member_shards():
+    async def run():
+        group_ids = list(range(1, 201))
+        database = await new_database(group_ids)
+        shards = await new_shards(database, [MAIN_SHARD, 'second'])
+
+        for group_id in group_ids:
+            await shards.join(group_id, shards.main)
+        # only the main bot is in group 1
+        for group_id in group_ids[1:]:
+            await shards.join(group_id, shards.shards['second'])
+
+        owners = {group_id: shards.owner(group_id).name for group_id in group_ids}
+        assert owners[1] == MAIN_SHARD
+        assert 50 < list(owners.values()).count('second') < 150
+        assert await stored_owners(database) == owners
+
+    asyncio.run(run())
+
+
+def test_leaving_moves_the_group_to_another_member():
+    async def run():
+        database = await new_database([1])
+        shards = await new_shards(database, [MAIN_SHARD, 'second'])
+        await shards.join(1, shards.main)
+        await shards.join(1, shards.shards['second'])
+        owner = shards.owner(1)
+        other = next(shard for shard in shards if shard is not owner)
+
+        assert await shards.leave(1, owner)
+        assert shards.owner(1) is other
+        assert await stored_owners(database) == {1: other.name}
+
+        assert not await shards.leave(1, other)
+        assert shards.owner(1) is None
+
+    asyncio.run(run())
+
+
+def test_removing_a_shard_from_the_config_rebalances():
+    async def run():
+        group_ids = list(range(1, 101))
+        database = await new_database(group_ids)
+        shards = await new_shards(database, [MAIN_SHARD, 'second'])
+        for group_id in group_ids:
+            await shards.join(group_id, shards.main)
+            await shards.join(group_id, shards.shards['second'])
+        assert any(shards.owner(group_id).name == 'second' for group_id in group_ids)
+
+        restarted = await new_shards(database, [MAIN_SHARD])
+
+        assert all(restarted.owner(group_id) is restarted.main for group_id in group_ids)
+        assert set((await stored_owners(database)).values()) == {MAIN_SHARD}
+
+    asyncio.run(run())
+
+
+def test_removed_group_has_no_owner():
+    async def run():
+        database = await new_database([1])
+        shards = await new_shards(database, [MAIN_SHARD])
+        await shards.join(1, shards.main)
+
+        shards.apply(Change(1, ChangeKind.GROUP_REMOVED, 1))
+
+        assert shards.owner(1) is None
+
+    asyncio.run(run())